@@ -55,6 +55,8 @@ export const BookChatScreen: React.FC<BookChatScreenProps> = ({ route, navigatio
   const scrollViewRef = useRef<ScrollView>(null);
   const translateXRefs = useRef<Animated.Value[]>([]);
   const syncIntervalRef = useRef<any>(null);
+  // Messages already fetched from the database, used as the incremental sync cursor
+  const syncedMessagesRef = useRef<Message[]>([]);
 
   useEffect(() => {
     navigation.setOptions({
@@ -146,6 +148,7 @@ export const BookChatScreen: React.FC<BookChatScreenProps> = ({ route, navigatio
               isUser: m.is_user_message,
               timestamp: new Date(m.created_at),
             }));
+            syncedMessagesRef.current = parsed;
             setMessages(parsed);
             console.log(`Loaded ${parsed.length} messages from database for book ${book.title}`);
           } else {
@@ -174,39 +177,74 @@ export const BookChatScreen: React.FC<BookChatScreenProps> = ({ route, navigatio
     loadHistory();
   }, [book.id]);
 
-  // Sync messages every 5 seconds to keep all devices in sync
+  // Stream new messages to keep all devices in sync, falling back to polling every 5 seconds
   useEffect(() => {
     if (!conversationId) return;
 
-    const syncMessages = async () => {
-      try {
-        const dbMessages = await apiClient.getMessages(conversationId);
-        const parsed: Message[] = dbMessages.map((m: any) => ({
+    const getLastSyncedId = () => {
+      const synced = syncedMessagesRef.current;
+      return synced.length > 0 ? parseInt(synced[synced.length - 1].id, 10) : undefined;
+    };
+
+    const appendMessages = (dbMessages: any[]) => {
+      const lastId = getLastSyncedId();
+      const parsed: Message[] = dbMessages
+        .filter((m: any) => lastId === undefined || m.id > lastId)
+        .map((m: any) => ({
           id: m.id.toString(),
           text: m.message_text,
           isUser: m.is_user_message,
           timestamp: new Date(m.created_at),
         }));
-        
-        // Only update if messages changed
-        setMessages(prev => {
-          if (JSON.stringify(prev) !== JSON.stringify(parsed)) {
-            console.log('Book chat messages synced from database');
-            return parsed;
-          }
-          return prev;
-        });
+      if (parsed.length === 0) return;
+
+      syncedMessagesRef.current = [...syncedMessagesRef.current, ...parsed];
+      console.log('Book chat messages synced from database');
+      setMessages(syncedMessagesRef.current);
+    };
+
+    const syncMessages = async () => {
+      try {
+        // Only fetch messages newer than the last one we already have
+        const dbMessages = await apiClient.getMessages(conversationId, { afterId: getLastSyncedId() });
+        appendMessages(dbMessages);
       } catch (error) {
         console.log('Sync failed, will retry');
       }
     };
 
-    // Start syncing every 5 seconds
-    syncIntervalRef.current = setInterval(syncMessages, 5000);
+    const startPolling = () => {
+      if (!syncIntervalRef.current) {
+        syncIntervalRef.current = setInterval(syncMessages, 5000);
+      }
+    };
+
+    let closeStream: (() => void) | null = null;
+    let cancelled = false;
+    const openStream = () => {
+      const openedAt = Date.now();
+      closeStream = apiClient.openChatStream(conversationId, getLastSyncedId(), appendMessages, (ok) => {
+        closeStream = null;
+        if (cancelled) return;
+        // The server ends healthy streams periodically; resume from the last message id
+        if (ok && Date.now() - openedAt > 1000) {
+          openStream();
+        } else {
+          console.log('Chat stream unavailable, falling back to polling');
+          startPolling();
+        }
+      });
+    };
+    openStream();
 
     return () => {
+      cancelled = true;
+      if (closeStream) {
+        closeStream();
+      }
       if (syncIntervalRef.current) {
         clearInterval(syncIntervalRef.current);
+        syncIntervalRef.current = null;
       }
     };
   }, [conversationId]);
@@ -334,7 +372,8 @@ export const BookChatScreen: React.FC<BookChatScreenProps> = ({ route, navigatio
           description: '',
           category: '',
         },
-        messageText
+        messageText,
+        { conversationId, userId: user?.id }
       );
 
       const botResponse: Message = {
@@ -412,7 +451,8 @@ export const BookChatScreen: React.FC<BookChatScreenProps> = ({ route, navigatio
           description: '',
           category: '',
         },
-        messageText
+        messageText,
+        { conversationId, userId: user?.id }
       );
 
       const botResponse: Message = {
@@ -72,6 +72,12 @@ export const BookSearchScreen: React.FC<BookSearchScreenProps> = ({ user, naviga
           `"${title}" is ready for pickup. Please collect it within 2 days.`,
           { type: 'reservation', bookId, bookTitle: title, userId: user.id }
         );
+      } else if (result.status === 'waitlisted') {
+        Alert.alert(
+          '⏳ Added to Waitlist',
+          result.message || `"${title}" is not available right now. You will be notified when a copy is reserved for you.`,
+          [{ text: 'OK' }]
+        );
       } else if (result.status === 'rejected') {
         Alert.alert(
           '❌ Reservation Rejected', 
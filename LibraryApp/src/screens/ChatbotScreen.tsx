@@ -44,6 +44,8 @@ export const ChatbotScreen: React.FC<ChatbotScreenProps> = ({ user, navigation }
   // Create refs for message animations
   const messageAnimations = useRef<{[key: string]: Animated.Value}>({})
   const syncIntervalRef = useRef<any>(null);
+  // Messages already fetched from the database, used as the incremental sync cursor
+  const syncedMessagesRef = useRef<Message[]>([]);
 
   // Initialize and sync messages from database
   useEffect(() => {
@@ -90,6 +92,7 @@ export const ChatbotScreen: React.FC<ChatbotScreenProps> = ({ user, navigation }
               isUser: m.is_user_message,
               timestamp: new Date(m.created_at),
             }));
+            syncedMessagesRef.current = parsed;
             setMessages(parsed);
             console.log(`Loaded ${parsed.length} messages from database`);
           } else {
@@ -126,39 +129,74 @@ export const ChatbotScreen: React.FC<ChatbotScreenProps> = ({ user, navigation }
     loadHistory();
   }, [user.id]);
 
-  // Sync messages every 5 seconds to keep all devices in sync
+  // Stream new messages to keep all devices in sync, falling back to polling every 5 seconds
   useEffect(() => {
     if (!conversationId) return;
 
-    const syncMessages = async () => {
-      try {
-        const dbMessages = await apiClient.getMessages(conversationId);
-        const parsed: Message[] = dbMessages.map((m: any) => ({
+    const getLastSyncedId = () => {
+      const synced = syncedMessagesRef.current;
+      return synced.length > 0 ? parseInt(synced[synced.length - 1].id, 10) : undefined;
+    };
+
+    const appendMessages = (dbMessages: any[]) => {
+      const lastId = getLastSyncedId();
+      const parsed: Message[] = dbMessages
+        .filter((m: any) => lastId === undefined || m.id > lastId)
+        .map((m: any) => ({
           id: m.id.toString(),
           text: m.message_text,
           isUser: m.is_user_message,
           timestamp: new Date(m.created_at),
         }));
-        
-        // Only update if messages changed
-        setMessages(prev => {
-          if (JSON.stringify(prev) !== JSON.stringify(parsed)) {
-            console.log('Messages synced from database');
-            return parsed;
-          }
-          return prev;
-        });
+      if (parsed.length === 0) return;
+
+      syncedMessagesRef.current = [...syncedMessagesRef.current, ...parsed];
+      console.log('Messages synced from database');
+      setMessages(syncedMessagesRef.current);
+    };
+
+    const syncMessages = async () => {
+      try {
+        // Only fetch messages newer than the last one we already have
+        const dbMessages = await apiClient.getMessages(conversationId, { afterId: getLastSyncedId() });
+        appendMessages(dbMessages);
       } catch (error) {
         console.log('Sync failed, will retry');
       }
     };
 
-    // Start syncing every 5 seconds
-    syncIntervalRef.current = setInterval(syncMessages, 5000);
+    const startPolling = () => {
+      if (!syncIntervalRef.current) {
+        syncIntervalRef.current = setInterval(syncMessages, 5000);
+      }
+    };
+
+    let closeStream: (() => void) | null = null;
+    let cancelled = false;
+    const openStream = () => {
+      const openedAt = Date.now();
+      closeStream = apiClient.openChatStream(conversationId, getLastSyncedId(), appendMessages, (ok) => {
+        closeStream = null;
+        if (cancelled) return;
+        // The server ends healthy streams periodically; resume from the last message id
+        if (ok && Date.now() - openedAt > 1000) {
+          openStream();
+        } else {
+          console.log('Chat stream unavailable, falling back to polling');
+          startPolling();
+        }
+      });
+    };
+    openStream();
 
     return () => {
+      cancelled = true;
+      if (closeStream) {
+        closeStream();
+      }
       if (syncIntervalRef.current) {
         clearInterval(syncIntervalRef.current);
+        syncIntervalRef.current = null;
       }
     };
   }, [conversationId]);
@@ -176,7 +214,7 @@ export const ChatbotScreen: React.FC<ChatbotScreenProps> = ({ user, navigation }
   const generateResponse = async (userMessage: string): Promise<string> => {
     try {
       // Use the AI-powered library assistant
-      const response = await askLibraryAssistant(user.id, userMessage);
+      const response = await askLibraryAssistant(user.id, userMessage, conversationId);
 
       // Store recommendations if available
       if (response.has_recommendations && response.recommendations.length > 0) {
@@ -69,7 +69,9 @@ export const apiClient = {
         totalCopies: book.total_copies || 1,
         publishDate: book.publish_date || '',
         avg_rating: book.avg_rating || 0,
-        rating_count: book.rating_count || 0
+        rating_count: book.rating_count || 0,
+        coverImage: book.cover_image || '',
+        coverThumbUrl: book.cover_thumb_url ? API_BASE.replace(/\/api$/, '') + book.cover_thumb_url : undefined
       }));
     } catch (error) {
       return this.getDemoBooks();
@@ -169,7 +171,7 @@ export const apiClient = {
     }
   },
 
-  async reserveBook(bookId: string, userId: number): Promise<{ status: string; message?: string; reason?: string }> {
+  async reserveBook(bookId: string, userId: number): Promise<{ status: string; message?: string; reason?: string; position?: number }> {
     try {
       console.log(`API Request: Reserving book ${bookId} for user ${userId}`);
       
@@ -197,6 +199,49 @@ export const apiClient = {
     }
   },
 
+  async getWaitlist(userId: number): Promise<any[]> {
+    try {
+      const response = await fetch(`${API_BASE}/users/${userId}/waitlist`);
+      return response.ok ? await response.json() : [];
+    } catch (error) {
+      console.log('Waitlist error:', error);
+      return [];
+    }
+  },
+
+  async leaveWaitlist(bookId: string, userId: number): Promise<{ message?: string; error?: string }> {
+    const response = await fetch(`${API_BASE}/books/${bookId}/waitlist?user_id=${userId}`, { method: 'DELETE' });
+    return response.json();
+  },
+
+  // Search-as-you-type suggestions (answered from the server's in-memory index)
+  async suggestBooks(query: string, limit: number = 8): Promise<{ id: number; title: string; author: string; matched: 'title' | 'author' }[]> {
+    if (!query.trim()) return [];
+    try {
+      const response = await fetch(`${API_BASE}/books/suggest?q=${encodeURIComponent(query)}&limit=${limit}`);
+      const data = await response.json();
+      return data.suggestions || [];
+    } catch (error) {
+      console.log('Suggest error:', error);
+      return [];
+    }
+  },
+
+  // Filter counts for the browse screen, e.g. { category: 'Science', is_free: true }
+  async getBookFacets(filters: { category?: string; is_ebook?: boolean; is_free?: boolean; available?: boolean } = {}): Promise<any> {
+    const params = new URLSearchParams();
+    Object.entries(filters).forEach(([key, value]) => {
+      if (value !== undefined && value !== '') params.append(key, String(value));
+    });
+    const response = await fetch(`${API_BASE}/books/facets?${params.toString()}`);
+    return response.json();
+  },
+
+  // PDF URL for a reader; the server answers Range requests so pages are fetched on demand
+  getEbookUrl(bookId: string, userId: number): string {
+    return `${API_BASE}/books/${bookId}/ebook?user_id=${userId}`;
+  },
+
   async cancelReservation(reservationId: number): Promise<{ message: string }> {
     try {
       const response = await fetch(`${API_BASE}/reservations/${reservationId}/cancel`, {
@@ -422,12 +467,59 @@ export const apiClient = {
     return response.json();
   },
 
-  async getMessages(conversationId: number) {
-    const response = await fetch(`${API_BASE}/chat/messages/${conversationId}`);
+  async getMessages(
+    conversationId: number,
+    options: { afterId?: number; beforeId?: number; limit?: number } = {}
+  ) {
+    const params = new URLSearchParams();
+    if (options.afterId !== undefined) params.append('after_id', options.afterId.toString());
+    if (options.beforeId !== undefined) params.append('before_id', options.beforeId.toString());
+    if (options.limit !== undefined) params.append('limit', options.limit.toString());
+    const query = params.toString();
+    const response = await fetch(`${API_BASE}/chat/messages/${conversationId}${query ? `?${query}` : ''}`);
     if (!response.ok) throw new Error('Failed to fetch messages');
     return response.json();
   },
 
+  // Opens a Server-Sent Events stream of new messages after `lastId`.
+  // `onClose(ok)` fires when the server ends the stream (ok = true, reconnect)
+  // or on error (ok = false, fall back to polling). Returns a function that closes the stream.
+  openChatStream(
+    conversationId: number,
+    lastId: number | undefined,
+    onMessages: (messages: any[]) => void,
+    onClose: (ok: boolean) => void
+  ): () => void {
+    const xhr = new XMLHttpRequest();
+    let readOffset = 0;
+    let buffer = '';
+
+    xhr.open('GET', `${API_BASE}/chat/stream/${conversationId}${lastId !== undefined ? `?last_id=${lastId}` : ''}`);
+    xhr.setRequestHeader('Accept', 'text/event-stream');
+    xhr.onprogress = () => {
+      buffer += xhr.responseText.slice(readOffset);
+      readOffset = xhr.responseText.length;
+      const events = buffer.split('\n\n');
+      buffer = events.pop() || '';
+
+      const messages: any[] = [];
+      for (const event of events) {
+        const lines = event.split('\n');
+        if (!lines.includes('event: message')) continue;
+        const data = lines.filter(line => line.startsWith('data: ')).map(line => line.slice(6)).join('\n');
+        if (data) messages.push(JSON.parse(data));
+      }
+      if (messages.length > 0) onMessages(messages);
+    };
+    xhr.onloadend = () => onClose(xhr.status === 200);
+    xhr.send();
+
+    return () => {
+      xhr.onloadend = null;
+      xhr.abort();
+    };
+  },
+
   async saveMessage(
     conversationId: number,
     userId: number,
@@ -467,7 +559,12 @@ export interface AiBookContext {
   category?: string;
 }
 
-export async function askBookAssistant(book: AiBookContext, question: string): Promise<string> {
+// Passing the conversation lets the server include earlier turns of the chat in the prompt
+export async function askBookAssistant(
+  book: AiBookContext,
+  question: string,
+  conversation?: { conversationId: number | null; userId?: number }
+): Promise<string> {
   try {
     // Create a timeout controller
     const controller = new AbortController();
@@ -476,7 +573,12 @@ export async function askBookAssistant(book: AiBookContext, question: string): P
     const response = await fetch(`${API_BASE}/ai/book-assistant`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ book, question }),
+      body: JSON.stringify({
+        book,
+        question,
+        conversation_id: conversation?.conversationId ?? undefined,
+        user_id: conversation?.userId,
+      }),
       signal: controller.signal,
     });
     
@@ -512,7 +614,7 @@ export async function askBookAssistant(book: AiBookContext, question: string): P
   }
 }
 
-export async function askLibraryAssistant(userId: number | null, question: string): Promise<{
+export async function askLibraryAssistant(userId: number | null, question: string, conversationId?: number | null): Promise<{
   answer: string;
   has_recommendations: boolean;
   recommendations: any[];
@@ -526,7 +628,7 @@ export async function askLibraryAssistant(userId: number | null, question: strin
     const response = await fetch(`${API_BASE}/ai/library-assistant`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ user_id: userId, question }),
+      body: JSON.stringify({ user_id: userId, question, conversation_id: conversationId ?? undefined }),
       signal: controller.signal,
     });
 
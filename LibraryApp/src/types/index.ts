@@ -22,6 +22,7 @@ export interface Book {
   rating?: number;
   estimatedTime?: number;
   coverImage?: string;
+  coverThumbUrl?: string; // Small WebP thumbnail for grid cards
   reading_time_minutes?: number;
   score?: number; // ML recommendation score
 }
@@ -0,0 +1,146 @@
+"""
+AI Response Cache for Library App
+SQLite-backed cache of AI assistant answers keyed by (book, normalized question, model),
+with a TTL and size-bounded least-recently-used eviction so repeated questions about
+the same book skip the upstream Gemini call.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional, Dict, Any
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace so trivially different questions share a key"""
+    text = re.sub(r'[^\w\s]', ' ', (text or '').lower())
+    return ' '.join(text.split())
+
+
+class AIResponseCache:
+    def __init__(self, db_path: str, ttl_seconds: int = 7 * 24 * 3600, max_entries: int = 5000):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get_db_connection(self):
+        """Get SQLite database connection"""
+        return sqlite3.connect(self.db_path)
+
+    def ensure_schema(self, cursor) -> None:
+        """Create the cache table (called from init_db)"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_response_cache (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                hits INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_response_cache_last_used ON ai_response_cache(last_used_at)')
+
+    @staticmethod
+    def book_key(book: Dict[str, Any]) -> str:
+        """Identify a book by id when the client sends one, otherwise by its normalized context"""
+        if book.get('id'):
+            return f"book:{book['id']}"
+        parts = [book.get(field, '') or '' for field in ('title', 'author', 'category', 'description')]
+        return 'ctx:' + '|'.join(normalize_text(str(part)) for part in parts)
+
+    @staticmethod
+    def make_key(scope: str, question: str, model: str) -> str:
+        raw = f'{scope}\n{normalize_text(question)}\n{model}'
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Return {'answer', 'model'} for a fresh entry, or None on a miss"""
+        now = time.time()
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT answer, model, created_at FROM ai_response_cache WHERE cache_key = ?', (cache_key,))
+            row = cursor.fetchone()
+            if row and now - row[2] <= self.ttl_seconds:
+                cursor.execute('''
+                    UPDATE ai_response_cache SET last_used_at = ?, hits = hits + 1
+                    WHERE cache_key = ?
+                ''', (now, cache_key))
+                conn.commit()
+                self._record(hit=True)
+                return {'answer': row[0], 'model': row[1]}
+
+            if row:
+                cursor.execute('DELETE FROM ai_response_cache WHERE cache_key = ?', (cache_key,))
+                conn.commit()
+            self._record(hit=False)
+            return None
+        except sqlite3.Error as e:
+            # The cache is best-effort; never fail the request because of it
+            print(f'[AICache] lookup failed: {e}')
+            self._record(hit=False)
+            return None
+        finally:
+            conn.close()
+
+    def put(self, cache_key: str, model: str, answer: str) -> None:
+        now = time.time()
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT OR REPLACE INTO ai_response_cache (cache_key, model, answer, created_at, last_used_at, hits)
+                VALUES (?, ?, ?, ?, ?, 0)
+            ''', (cache_key, model, answer, now, now))
+
+            # Evict expired entries first, then the least recently used beyond the size bound
+            cursor.execute('DELETE FROM ai_response_cache WHERE created_at < ?', (now - self.ttl_seconds,))
+            cursor.execute('SELECT COUNT(*) FROM ai_response_cache')
+            overflow = cursor.fetchone()[0] - self.max_entries
+            if overflow > 0:
+                cursor.execute('''
+                    DELETE FROM ai_response_cache WHERE cache_key IN (
+                        SELECT cache_key FROM ai_response_cache ORDER BY last_used_at ASC LIMIT ?
+                    )
+                ''', (overflow,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f'[AICache] store failed: {e}')
+        finally:
+            conn.close()
+
+    def _record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate for this process plus persisted totals across restarts"""
+        with self._lock:
+            hits, misses = self._hits, self._misses
+        lookups = hits + misses
+
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM ai_response_cache')
+            entries, stored_hits = cursor.fetchone()
+        finally:
+            conn.close()
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl_seconds,
+            'lifetime_hits_on_current_entries': stored_hits
+        }
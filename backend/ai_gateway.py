@@ -0,0 +1,345 @@
+"""
+AI Gateway Service for Library App
+Single entry point for Gemini calls: one asyncio HTTP client shared by every route,
+per-model circuit breakers that skip a model after consecutive failures, hedged requests
+that start the next model when the first is slow, coalescing of identical in-flight
+requests, and per-model latency/error metrics.
+
+Upstream calls run as tasks on the AsyncHTTPClient event loop. The calling Flask thread
+still blocks until the answer (or stream) finishes, so a slow Gemini response does hold
+that request's worker thread; what the event loop saves is the extra thread per hedged
+duplicate, which is only a task and a socket.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import deque
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+from async_http import AsyncHTTPClient
+from gemini_stream import GEMINI_API_BASE, stream_url, iter_stream_text
+from ai_cache import normalize_text
+
+
+class AIGatewayError(Exception):
+    """Raised when no model could be tried (every circuit is open)"""
+
+
+class CircuitBreaker:
+    """Closed -> open after `failure_threshold` consecutive failures; after `reset_seconds`
+    a single trial call is let through (half-open) and its outcome closes or re-opens it."""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_seconds and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def release_trial(self) -> None:
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return 'half_open'
+            return 'open'
+
+
+class ModelMetrics:
+    """Call/error counters and a rolling window of latencies for one model"""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+        self._latencies = deque(maxlen=window)
+
+    def record(self, latency_seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self._latencies.append(latency_seconds)
+
+    def increment(self, field: str) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            calls, errors = self.calls, self.errors
+            hedges, hedge_wins, skipped = self.hedges, self.hedge_wins, self.skipped
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            'calls': calls,
+            'errors': errors,
+            'error_rate': round(errors / calls, 4) if calls else 0.0,
+            'avg_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'hedges_started': hedges,
+            'hedge_wins': hedge_wins,
+            'skipped_circuit_open': skipped
+        }
+
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key wait for
+    the leader and receive its result (or its exception)."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[Exception] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, 'SingleFlight._Call'] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'leaders': self.leaders, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
+
+
+class AIGateway:
+    def __init__(self, failure_threshold: int = 3, reset_seconds: float = 60,
+                 hedge_after_seconds: float = 4.0, http: Optional[AsyncHTTPClient] = None):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.hedge_after_seconds = hedge_after_seconds
+
+        # One event loop and keep-alive connection pool instead of a TLS handshake per request; hedges run as tasks on it
+        self.http = http or AsyncHTTPClient()
+        self._lock = threading.Lock()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._metrics: Dict[str, ModelMetrics] = {}
+        self._flights = SingleFlight()
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+            return self._breakers[model]
+
+    def _model_metrics(self, model: str) -> ModelMetrics:
+        with self._lock:
+            if model not in self._metrics:
+                self._metrics[model] = ModelMetrics()
+            return self._metrics[model]
+
+    def _acquire(self, model: str) -> bool:
+        """Check the model's circuit right before calling it (claims the half-open trial slot)"""
+        if self._breaker(model).allow():
+            return True
+        self._model_metrics(model).increment('skipped')
+        return False
+
+    async def _call(self, model: str, payload: Dict[str, Any], api_key: str, timeout: float) -> str:
+        url = f"{GEMINI_API_BASE}/models/{model}:generateContent?key={api_key}"
+        started = time.monotonic()
+        try:
+            result = await self.http.post_json(url, payload, timeout)
+            text = result['candidates'][0]['content']['parts'][0]['text']
+            if not text or not text.strip():
+                raise ValueError(f'Empty response from {model}')
+        except asyncio.CancelledError:
+            # Lost a hedge race; says nothing about the model's health
+            self._breaker(model).release_trial()
+            raise
+        except Exception:
+            self._model_metrics(model).record(time.monotonic() - started, ok=False)
+            self._breaker(model).record_failure()
+            raise
+        self._model_metrics(model).record(time.monotonic() - started, ok=True)
+        self._breaker(model).record_success()
+        return text
+
+    @staticmethod
+    def flight_key(models: List[str], payload: Dict[str, Any]) -> str:
+        """Requests with the same model chain, generation settings and (normalized) prompt
+        text are interchangeable, so they can share one upstream call"""
+        prompt = ' '.join(
+            normalize_text(part.get('text', ''))
+            for content in payload.get('contents', [])
+            for part in content.get('parts', [])
+        )
+        settings = json.dumps(payload.get('generationConfig') or {}, sort_keys=True)
+        raw = f"{','.join(models)}\n{settings}\n{prompt}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def generate(self, models: List[str], payload: Dict[str, Any], api_key: str,
+                 timeout: float = 30, hedge: bool = True) -> Tuple[str, str]:
+        """Return (text, model) from the first model that answers.
+
+        Identical requests already in flight are joined rather than sent again.
+        """
+        return self._flights.do(self.flight_key(models, payload),
+                                lambda: self._generate(models, payload, api_key, timeout, hedge))
+
+    def _generate(self, models: List[str], payload: Dict[str, Any], api_key: str,
+                  timeout: float, hedge: bool) -> Tuple[str, str]:
+        return self.http.run(self._generate_async(models, payload, api_key, timeout, hedge))
+
+    async def _generate_async(self, models: List[str], payload: Dict[str, Any], api_key: str,
+                              timeout: float, hedge: bool) -> Tuple[str, str]:
+        """Models are tried in order, skipping any with an open circuit. If the current
+        model has not answered within hedge_after_seconds the next one is started in
+        parallel and whichever succeeds first wins; the loser is cancelled. Raises the
+        last upstream error if every model fails, or AIGatewayError if none could be tried.
+        """
+        candidates = list(models)
+        pending = {}
+        last_error: Optional[Exception] = None
+        hedged = False
+
+        def launch(is_hedge: bool) -> bool:
+            """Start the next model whose circuit allows a call; False if none is left"""
+            while candidates:
+                model = candidates.pop(0)
+                if not self._acquire(model):
+                    continue
+                if is_hedge:
+                    self._model_metrics(model).increment('hedges')
+                task = asyncio.ensure_future(self._call(model, payload, api_key, timeout))
+                pending[task] = (model, is_hedge)
+                return True
+            return False
+
+        if not launch(False):
+            raise AIGatewayError('All AI models are temporarily unavailable (circuit open)')
+        try:
+            while pending:
+                can_hedge = hedge and not hedged and candidates and len(pending) == 1
+                done, _ = await asyncio.wait(list(pending), timeout=self.hedge_after_seconds if can_hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if launch(True):
+                        print("[AIGateway] Slow response, hedged with the next model")
+                    continue
+
+                for task in done:
+                    model, is_hedge = pending.pop(task)
+                    try:
+                        text = task.result()
+                    except Exception as e:
+                        print(f"[AIGateway] Model {model} failed: {str(e)}")
+                        last_error = e
+                        continue
+                    if is_hedge:
+                        self._model_metrics(model).increment('hedge_wins')
+                    return text, model
+
+                if not pending:
+                    hedged = False
+                    launch(False)
+        finally:
+            # Cancel whichever request lost the race so its connection goes back to the pool
+            for task in pending:
+                task.cancel()
+
+        if last_error is None:
+            raise AIGatewayError('All AI models are temporarily unavailable (circuit open)')
+        raise last_error
+
+    def stream(self, model: str, payload: Dict[str, Any], api_key: str, timeout: float = 30) -> Iterator[str]:
+        """Yield text fragments from streamGenerateContent through the shared HTTP client,
+        recording metrics and breaker outcomes. Raises AIGatewayError if the model's
+        circuit is open, so callers can move on to their next model."""
+        if not self._acquire(model):
+            raise AIGatewayError(f'{model} is temporarily unavailable (circuit open)')
+        started = time.monotonic()
+        try:
+            yield from iter_stream_text(self.http.stream_lines(stream_url(model, api_key), payload, timeout))
+        except GeneratorExit:
+            # Client went away mid-stream; not the model's fault, but free a half-open trial slot
+            self._breaker(model).release_trial()
+            raise
+        except Exception:
+            self._model_metrics(model).record(time.monotonic() - started, ok=False)
+            self._breaker(model).record_failure()
+            raise
+        self._model_metrics(model).record(time.monotonic() - started, ok=True)
+        self._breaker(model).record_success()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            models = list(self._metrics.keys() | self._breakers.keys())
+        return {
+            'hedge_after_seconds': self.hedge_after_seconds,
+            'failure_threshold': self.failure_threshold,
+            'reset_seconds': self.reset_seconds,
+            'single_flight': self._flights.stats(),
+            'models': {
+                model: dict(self._model_metrics(model).snapshot(), circuit=self._breaker(model).state())
+                for model in sorted(models)
+            }
+        }
@@ -0,0 +1,107 @@
+"""
+AI Request Limiter for Library App
+Caps how many AI requests a worker process runs at once, with a short bounded wait
+queue, plus a sliding-window rate limit per user, so slow upstream AI calls cannot
+occupy every worker thread and starve the catalog, circulation and notification routes.
+"""
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, Any, Optional, Tuple
+
+
+class AIRequestLimiter:
+    def __init__(self, max_concurrent: int = 4, max_queue: int = 4, queue_timeout: float = 2.0,
+                 user_limit: int = 10, user_window_seconds: float = 60, retry_after_seconds: int = 5):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_limit = user_limit
+        self.user_window_seconds = user_window_seconds
+        self.retry_after_seconds = retry_after_seconds
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._user_lock = threading.Lock()
+        self._user_requests: Dict[str, deque] = {}
+        self._last_sweep = time.monotonic()
+        self._counters = {'admitted': 0, 'queued': 0, 'rejected_saturated': 0, 'rejected_rate_limited': 0}
+
+    def acquire(self, user_key: str) -> Optional[Tuple[int, int]]:
+        """Admit the request or return (status_code, retry_after_seconds).
+
+        Returns None when a slot was taken; the caller must call release() exactly once.
+        """
+        retry_after, recorded_at = self._take_user_request(user_key)
+        if retry_after:
+            self._count('rejected_rate_limited')
+            return 429, retry_after
+
+        with self._cond:
+            if self._active >= self.max_concurrent:
+                if self._waiting >= self.max_queue:
+                    self._counters['rejected_saturated'] += 1
+                    rejected = True
+                else:
+                    self._waiting += 1
+                    self._counters['queued'] += 1
+                    try:
+                        rejected = not self._cond.wait_for(lambda: self._active < self.max_concurrent,
+                                                           self.queue_timeout)
+                    finally:
+                        self._waiting -= 1
+                    if rejected:
+                        self._counters['rejected_saturated'] += 1
+                if rejected:
+                    self._refund_user_request(user_key, recorded_at)
+                    return 503, self.retry_after_seconds
+            self._active += 1
+            self._counters['admitted'] += 1
+        return None
+
+    def release(self) -> None:
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def _take_user_request(self, user_key: str) -> Tuple[int, float]:
+        """Check the user's window and record the request in one step, so concurrent requests
+        from one user cannot all pass the check. Returns (seconds until allowed, 0 if recorded;
+        the recorded timestamp)."""
+        now = time.monotonic()
+        with self._user_lock:
+            if now - self._last_sweep >= self.user_window_seconds:
+                self._sweep(now)
+            window = self._user_requests.setdefault(user_key, deque())
+            while window and now - window[0] >= self.user_window_seconds:
+                window.popleft()
+            if len(window) >= self.user_limit:
+                return max(1, math.ceil(self.user_window_seconds - (now - window[0]))), now
+            window.append(now)
+            return 0, now
+
+    def _refund_user_request(self, user_key: str, recorded_at: float) -> None:
+        """Forget a recorded request that was turned away as saturated"""
+        with self._user_lock:
+            window = self._user_requests.get(user_key)
+            if window and recorded_at in window:
+                window.remove(recorded_at)
+
+    def _sweep(self, now: float) -> None:
+        """Drop users with no request inside the window. Caller holds _user_lock."""
+        self._user_requests = {key: window for key, window in self._user_requests.items()
+                               if window and now - window[-1] < self.user_window_seconds}
+        self._last_sweep = now
+
+    def _count(self, field: str) -> None:
+        with self._cond:
+            self._counters[field] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self._counters, active=self._active, waiting=self._waiting)
+        stats.update(max_concurrent=self.max_concurrent, max_queue=self.max_queue,
+                     user_limit=self.user_limit, user_window_seconds=self.user_window_seconds)
+        return stats
@@ -1,9 +1,12 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, redirect, send_file
 from flask_cors import CORS
 import sqlite3
 import os
 import sys
+import json
+import time
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 try:
     from zoneinfo import ZoneInfo
     TZ_JHB = ZoneInfo("Africa/Johannesburg")
@@ -34,6 +37,29 @@ except ImportError as e:
     MLRecommendationService = None
     RECOMMENDATION_SERVICES_AVAILABLE = False
 import requests
+from chat_events import ChatEventBroker
+from chat_archive import ChatArchiveService
+from ai_cache import AIResponseCache
+from gemini_stream import sse_event
+from ai_gateway import AIGateway
+from library_context import LibraryContextService
+from ai_limiter import AIRequestLimiter
+from ebook_index import EbookIndexService
+import ebook_delivery
+from ebook_delivery import EbookDeliveryService
+import cover_thumbnails
+from cover_thumbnails import CoverThumbnailService
+from catalog_facets import CatalogFacetsService
+from typeahead import TypeaheadIndex
+from prompt_builder import PromptBuilder, PromptStats
+from conversation_history import ConversationHistoryService
+import inventory
+import waitlist
+import circulation
+import catalog_import
+import report_export
+from deadline_scheduler import DeadlineScheduler
+from functools import wraps
 try:
     # prefer the HTTP v1 FCM helper if available
     import sys
@@ -106,6 +132,87 @@ if GENAI_API_KEY:
 
 # FCM server key for sending push notifications (optional)
 FCM_SERVER_KEY = os.environ.get('FCM_SERVER_KEY')
+FCM_API_BASE = os.environ.get('FCM_API_BASE', 'https://fcm.googleapis.com').rstrip('/')  # Point at fake_upstreams.py for offline load tests
+
+# Chat history settings
+CHAT_PAGE_MAX = 200  # Largest page returned by GET /api/chat/messages
+CHAT_FULL_ARCHIVE_MAX = 200  # Archived messages included when the full history is requested; older ones via before_id
+CHAT_PREVIEW_LENGTH = 120  # Characters kept in chat_conversations.last_message_preview
+CHAT_STREAM_MAX_SECONDS = 55  # SSE streams close after this long; clients reconnect with Last-Event-ID
+CHAT_STREAM_POLL_SECONDS = 2  # How often a stream re-checks the database for messages saved by other workers
+CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', '90'))  # Age at which messages move to compressed archives
+
+# Wakes SSE chat streams in this process when save_message commits
+chat_events = ChatEventBroker()
+chat_archive = ChatArchiveService(DATABASE)
+
+# AI answer cache settings
+AI_CACHE_TTL_SECONDS = int(os.environ.get('AI_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))  # Cached answers older than this are refetched
+AI_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', '5000'))  # Least recently used answers are evicted beyond this
+ai_cache = AIResponseCache(DATABASE, AI_CACHE_TTL_SECONDS, AI_CACHE_MAX_ENTRIES)
+
+# AI gateway settings
+AI_HEDGE_AFTER_SECONDS = float(os.environ.get('AI_HEDGE_AFTER_SECONDS', '4'))  # Start the next model if the current one is this slow
+AI_BREAKER_FAILURES = int(os.environ.get('AI_BREAKER_FAILURES', '3'))  # Consecutive failures before a model is skipped
+AI_BREAKER_RESET_SECONDS = float(os.environ.get('AI_BREAKER_RESET_SECONDS', '60'))  # How long a tripped model is skipped before a trial call
+ai_gateway = AIGateway(AI_BREAKER_FAILURES, AI_BREAKER_RESET_SECONDS, AI_HEDGE_AFTER_SECONDS)
+
+# AI admission control (per worker process) so AI calls cannot take every worker thread.
+# Running plus queued AI requests each hold a request thread, so together they must stay
+# below the worker's thread count (gunicorn --threads, see render.yaml), leaving
+# AI_RESERVED_THREADS for catalog, notification, login and chat stream requests.
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', '8'))  # Must match gunicorn --threads
+AI_RESERVED_THREADS = int(os.environ.get('AI_RESERVED_THREADS', '4'))  # Threads AI requests never occupy
+_ai_thread_budget = max(2, WORKER_THREADS - AI_RESERVED_THREADS)
+AI_MAX_CONCURRENT = int(os.environ.get('AI_MAX_CONCURRENT', str(_ai_thread_budget // 2)))  # AI requests running at once
+AI_MAX_QUEUE = int(os.environ.get('AI_MAX_QUEUE', str(_ai_thread_budget - _ai_thread_budget // 2)))  # Requests allowed to wait for a slot; beyond this -> 503
+if AI_MAX_CONCURRENT + AI_MAX_QUEUE >= WORKER_THREADS:
+    raise ValueError(f'AI_MAX_CONCURRENT + AI_MAX_QUEUE ({AI_MAX_CONCURRENT} + {AI_MAX_QUEUE}) must be below '
+                     f'WORKER_THREADS ({WORKER_THREADS}), or AI calls can take every request thread')
+AI_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('AI_QUEUE_TIMEOUT_SECONDS', '2'))  # Longest wait for a slot before 503
+AI_USER_RATE_LIMIT = int(os.environ.get('AI_USER_RATE_LIMIT', '10'))  # AI requests per user per window; beyond this -> 429
+AI_USER_RATE_WINDOW_SECONDS = 60
+ai_limiter = AIRequestLimiter(AI_MAX_CONCURRENT, AI_MAX_QUEUE, AI_QUEUE_TIMEOUT_SECONDS,
+                              AI_USER_RATE_LIMIT, AI_USER_RATE_WINDOW_SECONDS)
+# Each open chat stream holds a request thread for up to CHAT_STREAM_MAX_SECONDS, so streams may use
+# at most half of the reserved threads; beyond this -> 503 and the client polls instead
+CHAT_STREAM_MAX_OPEN = int(os.environ.get('CHAT_STREAM_MAX_OPEN', str(max(1, AI_RESERVED_THREADS // 2))))
+
+# E-book passage retrieval for the book assistant
+EBOOK_DIR = os.environ.get('EBOOK_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ebooks'))  # Local PDFs referenced by relative pdf_url
+EBOOK_INDEX_DIR = os.environ.get('EBOOK_INDEX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ebook_indexes'))
+EBOOK_CONTEXT_TOKEN_BUDGET = int(os.environ.get('EBOOK_CONTEXT_TOKEN_BUDGET', '1500'))  # Max prompt tokens spent on retrieved passages
+ebook_index = EbookIndexService(DATABASE, EBOOK_INDEX_DIR, EBOOK_DIR)
+ebook_files = EbookDeliveryService(EBOOK_DIR)
+
+# Cover thumbnails for book grids
+COVER_DIR = os.environ.get('COVER_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'covers'))  # Local originals referenced by relative cover_image
+COVER_CACHE_DIR = os.environ.get('COVER_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cover_cache'))
+COVER_CACHE_MAX_BYTES = int(os.environ.get('COVER_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))  # Least recently used thumbnails are deleted beyond this
+cover_thumbs = CoverThumbnailService(COVER_CACHE_DIR, COVER_DIR, COVER_CACHE_MAX_BYTES)
+
+# Browse facet counts
+FACETS_MAX_AGE_SECONDS = int(os.environ.get('FACETS_MAX_AGE_SECONDS', '30'))  # Longest a facet rollup is reused; availability changes with loans
+catalog_facets = CatalogFacetsService(DATABASE, FACETS_MAX_AGE_SECONDS)
+
+# Title/author autocomplete
+TYPEAHEAD_MAX_AGE_SECONDS = int(os.environ.get('TYPEAHEAD_MAX_AGE_SECONDS', '300'))  # Background rebuild interval; picks up other workers' writes
+typeahead = TypeaheadIndex(DATABASE, TYPEAHEAD_MAX_AGE_SECONDS)
+
+LIBRARY_CONTEXT_REFRESH_SECONDS = 300  # How often the library assistant's catalog statistics are rebuilt
+
+# Prompt assembly for the AI assistants
+AI_PROMPT_TOKEN_BUDGET = int(os.environ.get('AI_PROMPT_TOKEN_BUDGET', '4000'))  # Largest prompt sent; low-priority sections are trimmed first
+AI_HISTORY_WINDOW_MESSAGES = int(os.environ.get('AI_HISTORY_WINDOW_MESSAGES', '8'))  # Recent chat messages sent verbatim; older ones are summarized
+conversation_history = ConversationHistoryService(DATABASE, AI_HISTORY_WINDOW_MESSAGES, chat_archive)
+prompt_stats = PromptStats()
+
+# Bulk admin circulation endpoints
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '1000'))  # Largest list of IDs accepted by one bulk request
+push_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='push-batch')  # Sends bulk pushes off the request path
+
+# Checkouts expire at their exact deadline; the hourly sweep only catches what this misses
+checkout_deadlines = DeadlineScheduler('checkouts', lambda checkout_ids: process_expired_checkouts(checkout_ids))
 
 def init_db():
     conn = get_db_connection()
@@ -186,6 +293,7 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_issues_user_book ON book_issues(user_id, book_id, status)')
     
     # Add new columns if they don't exist
     try:
@@ -211,6 +319,7 @@ def init_db():
             FOREIGN KEY (paid_by) REFERENCES users (id)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_fine_payments_fine ON fine_payments(fine_id, payment_type)')
 
     # Device tokens table - stores push tokens for user's devices
     cursor.execute('''
@@ -256,6 +365,7 @@ def init_db():
             FOREIGN KEY (book_id) REFERENCES books (id)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purchases_user_book ON purchases(user_id, book_id)')
     
     # Book reservations table
     cursor.execute('''
@@ -302,6 +412,8 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+    # Outstanding deadlines for the expiry scheduler's startup load and the safety-net sweep
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_checkouts_deadline ON book_checkouts(status, checkout_deadline)')
     
     # Account requests table
     cursor.execute('''
@@ -363,7 +475,39 @@ def init_db():
             FOREIGN KEY (reply_to_id) REFERENCES chat_messages (id)
         )
     ''')
-    
+
+    # Keyset index for incremental chat sync (after_id / before_id paging)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_conversation_id ON chat_messages(conversation_id, id)')
+
+    # Denormalized conversation summary columns, maintained by save_message
+    try:
+        cursor.execute('ALTER TABLE chat_conversations ADD COLUMN message_count INTEGER DEFAULT 0')
+        cursor.execute('ALTER TABLE chat_conversations ADD COLUMN last_message_id INTEGER')
+        cursor.execute('ALTER TABLE chat_conversations ADD COLUMN last_message_preview TEXT')
+        # One-time backfill for conversations created before the columns existed
+        cursor.execute('''
+            UPDATE chat_conversations
+            SET message_count = (SELECT COUNT(*) FROM chat_messages m WHERE m.conversation_id = chat_conversations.id),
+                last_message_id = (SELECT MAX(m.id) FROM chat_messages m WHERE m.conversation_id = chat_conversations.id),
+                last_message_preview = (
+                    SELECT substr(m.message_text, 1, ?) FROM chat_messages m
+                    WHERE m.conversation_id = chat_conversations.id
+                    ORDER BY m.id DESC LIMIT 1
+                )
+        ''', (CHAT_PREVIEW_LENGTH,))
+    except sqlite3.OperationalError:
+        pass  # Columns already exist
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_conversations_user ON chat_conversations(user_id, last_message_at)')
+
+    # Compressed cold storage for old chat messages
+    chat_archive.ensure_schema(cursor)
+    ai_cache.ensure_schema(cursor)
+    ebook_index.ensure_schema(cursor)
+    conversation_history.ensure_schema(cursor)
+    waitlist.ensure_schema(cursor)
+    inventory.ensure_schema(cursor)
+
     # Insert admin user
     admin_password = hashlib.sha256('admin'.encode()).hexdigest()
     user_password = hashlib.sha256('user'.encode()).hexdigest()
@@ -417,7 +561,7 @@ def send_fcm(token: str, title: str, message: str, data: dict = None) -> bool:
             except Exception as e:
                 print(f'[Push] FCM v1 send failed, falling back to legacy: {e}')
 
-        resp = requests.post('https://fcm.googleapis.com/fcm/send', json=payload, headers=headers, timeout=5)
+        resp = requests.post(f'{FCM_API_BASE}/fcm/send', json=payload, headers=headers, timeout=5)
         if resp.status_code >= 200 and resp.status_code < 300:
             print(f'[Push] Sent FCM push to token (truncated): {token[:10]}...')
             return True
@@ -459,7 +603,55 @@ def send_push_to_user(user_id: int, title: str, message: str, data: dict = None)
         print(f'[Push] Error while sending push to user {user_id}: {e}')
         return False
 
+
+def notify_waitlist_promotions(promotions):
+    """Push and cache invalidation for waitlist.promote_next() results, once their transaction has committed"""
+    for promotion in promotions:
+        if not promotion:
+            continue
+        checkout_deadlines.schedule(promotion['checkout_id'], promotion['checkout_deadline'])
+        library_context.invalidate_user(promotion['user_id'])
+        push = waitlist.promotion_push(promotion)
+        send_push_to_user(push['user_id'], push['title'], push['message'], push['data'])
+
+
+def send_push_batch(pushes):
+    """Send many pushes with one device-token lookup (used by the bulk admin endpoints)"""
+    try:
+        user_ids = sorted({push['user_id'] for push in pushes})
+        tokens = {}
+        conn = sqlite3.connect(DATABASE)
+        cursor = conn.cursor()
+        for start in range(0, len(user_ids), circulation.MAX_IDS_PER_QUERY):
+            chunk = user_ids[start:start + circulation.MAX_IDS_PER_QUERY]
+            cursor.execute(f'SELECT user_id, token FROM device_tokens WHERE user_id IN ({",".join("?" * len(chunk))})', chunk)
+            for user_id, token in cursor.fetchall():
+                tokens.setdefault(user_id, []).append(token)
+        conn.close()
+
+        sent = 0
+        for push in pushes:
+            for token in tokens.get(push['user_id'], []):
+                if send_fcm(token, push['title'], push['message'], push['data'] or {}):
+                    sent += 1
+        print(f'[Push] Batch of {len(pushes)} notifications sent to {sent} devices')
+    except Exception as e:
+        print(f'[Push] Error while sending push batch: {e}')
+
+
+def enqueue_push_batch(pushes):
+    """Hand a batch of pushes to the background sender so the request does not wait on FCM"""
+    if pushes:
+        push_executor.submit(send_push_batch, pushes)
+
 # API Routes
+def bool_arg(name):
+    """True/False for a 'true'/'false' (or 1/0) query parameter, None if it is absent"""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    return value.lower() in ('true', '1', 'yes')
+
 @app.route('/api/books', methods=['GET'])
 def get_books():
     conn = sqlite3.connect(DATABASE)
@@ -467,6 +659,8 @@ def get_books():
     
     category = request.args.get('category')
     is_ebook = request.args.get('is_ebook')
+    is_free = bool_arg('is_free')
+    available = bool_arg('available')
     
     query = '''
         SELECT b.*, 
@@ -487,6 +681,13 @@ def get_books():
         query += ' AND b.is_ebook = ?'
         params.append(1 if is_ebook == 'true' else 0)
     
+    if is_free is not None:
+        query += ' AND b.is_free = ?'
+        params.append(1 if is_free else 0)
+    
+    if available is not None:
+        query += ' AND b.available_copies > 0' if available else ' AND COALESCE(b.available_copies, 0) <= 0'
+    
     query += ' GROUP BY b.id ORDER BY b.created_at DESC'
     
     cursor.execute(query, params)
@@ -511,12 +712,114 @@ def get_books():
             'reading_time_minutes': book[13],
             'publish_date': book[14],
             'avg_rating': round(float(book[16]), 1) if len(book) > 16 else 0,
-            'rating_count': book[17] if len(book) > 17 else 0
+            'rating_count': book[17] if len(book) > 17 else 0,
+            **cover_thumbs.thumb_urls(book[0], book[9])
         })
     
     conn.close()
     return jsonify(book_list)
 
+@app.route('/api/books/<int:book_id>/ebook', methods=['GET'])
+def read_ebook(book_id):
+    """Serve an e-book's PDF with Range support (206 partial content) and a strong ETag.
+    Paid e-books require ?user_id= of someone who bought or borrowed the book."""
+    user_id = request.args.get('user_id', type=int)
+
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT title, is_ebook, is_free, pdf_url FROM books WHERE id = ?', (book_id,))
+    book = cursor.fetchone()
+    if not book or not book[1] or not book[3]:
+        conn.close()
+        return jsonify({'error': 'E-book not found'}), 404
+    if not book[2]:
+        if not user_id:
+            conn.close()
+            return jsonify({'error': 'user_id is required'}), 400
+        if not ebook_delivery.has_access(cursor, book_id, user_id):
+            conn.close()
+            return jsonify({'error': 'Purchase or borrow this book to read it'}), 403
+    conn.close()
+
+    pdf_url = book[3]
+    if pdf_url.startswith(('http://', 'https://')):
+        return redirect(pdf_url)
+    path = ebook_files.resolve(pdf_url)
+    if not path:
+        return jsonify({'error': 'E-book file not found'}), 404
+
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = ebook_files.etag(path, stat)
+    headers = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, no-cache',  # Revalidate (cheap 304) so access checks still apply
+        'Content-Disposition': f'inline; filename="book-{book_id}.pdf"'
+    }
+    if request.if_none_match.contains_weak(etag.strip('"')):
+        return Response(status=304, headers=headers)
+
+    range_header = request.headers.get('Range')
+    if request.headers.get('If-Range') and request.if_range.etag != etag.strip('"'):
+        range_header = None  # File changed since the client's first range: send it whole
+    try:
+        byte_range = ebook_delivery.parse_range(range_header, size)
+    except ValueError:
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status=416, headers=headers)
+
+    if byte_range:
+        start, end = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    else:
+        start, end = 0, size - 1
+        status = 200
+    length = end - start + 1
+    headers['Content-Length'] = str(length)
+
+    if request.method == 'HEAD':
+        return Response(status=status, headers=headers, mimetype='application/pdf')
+    body = ebook_files.body(path, start, length, request.environ.get('wsgi.file_wrapper'))
+    return Response(body, status=status, headers=headers, mimetype='application/pdf', direct_passthrough=True)
+
+@app.route('/api/books/<int:book_id>/cover/<int:size>', methods=['GET'])
+def get_cover_thumbnail(book_id, size):
+    """WebP cover thumbnail (the cover_thumb_url fields of book responses). URLs carry a
+    version, so a thumbnail is cached for a year and a new cover gets a new URL."""
+    if size not in cover_thumbnails.THUMB_SIZES:
+        return jsonify({'error': f'size must be one of {list(cover_thumbnails.THUMB_SIZES)}'}), 404
+
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT cover_image FROM books WHERE id = ?', (book_id,))
+    book = cursor.fetchone()
+    conn.close()
+    if not book or not book[0]:
+        return jsonify({'error': 'Book has no cover'}), 404
+    cover_image = book[0]
+
+    path = cover_thumbs.get(cover_image, size)
+    if path:
+        response = send_file(path, mimetype='image/webp', conditional=True)
+        if request.args.get('v') == cover_thumbnails.cover_key(cover_image):
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = 'public, max-age=300'  # Unversioned or outdated URL
+        return response
+
+    # Thumbnail is being generated in the background: send the original this once, uncached
+    original = cover_thumbs.original_path(cover_image)
+    if original:
+        response = send_file(original, conditional=True)
+    elif cover_image.startswith(('http://', 'https://')):
+        response = redirect(cover_image)
+    else:
+        return jsonify({'error': 'Cover image not found'}), 404
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/api/books/<int:book_id>/rate', methods=['POST'])
 def rate_book():
     # Rating functionality disabled
@@ -545,6 +848,7 @@ def purchase_book():
     ''', (user_id, book_id, book[0]))
     
     conn.commit()
+    library_context.invalidate_user(user_id)
     conn.close()
     
     return jsonify({'message': 'Purchase successful'})
@@ -586,6 +890,7 @@ def pay_fine():
     ''', (fine_id,))
     
     conn.commit()
+    library_context.invalidate_issue(fine_id)
     conn.close()
     
     return jsonify({'message': 'Fine paid successfully'})
@@ -601,6 +906,31 @@ def get_categories():
     conn.close()
     return jsonify(categories)
 
+@app.route('/api/books/facets', methods=['GET'])
+def get_book_facets():
+    """Counts per category, format, price and availability for the browse filters
+    (?category=&is_ebook=&is_free=&available=), from a cached rollup of the catalog"""
+    filters = {
+        'category': request.args.get('category') or None,
+        'is_ebook': bool_arg('is_ebook'),
+        'is_free': bool_arg('is_free'),
+        'available': bool_arg('available')
+    }
+    try:
+        return jsonify(catalog_facets.facets(filters))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/books/suggest', methods=['GET'])
+def suggest_books():
+    """Search-as-you-type suggestions for ?q= from the in-memory title/author index"""
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 8, type=int), 20))
+    try:
+        return jsonify({'query': query, 'suggestions': typeahead.suggest(query, limit)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # Authentication routes
 @app.route('/api/auth/login', methods=['POST'])
 def login():
@@ -718,7 +1048,9 @@ def db_info():
         'database_path': path,
         'exists': exists,
         'size_bytes': size,
-        'tables': {}
+        'tables': {},
+        'checkout_deadlines': checkout_deadlines.stats(),
+        'cover_thumbnails': cover_thumbs.stats()
     }
     try:
         conn = sqlite3.connect(DATABASE)
@@ -734,7 +1066,82 @@ def db_info():
         info['error'] = str(e)
     return jsonify(info)
 
+def catalog_changed(book_ids=None):
+    """Refresh what is derived from the catalog after books are added, edited or removed.
+    Pass the changed book IDs for single-book writes; bulk imports call this once at the
+    end without IDs rather than once per book."""
+    library_context.invalidate_catalog()
+    catalog_facets.invalidate()
+    if book_ids is None:
+        typeahead.invalidate()
+    else:
+        typeahead.refresh_books(book_ids)
+
 # Admin routes
+@app.route('/api/admin/books/import', methods=['POST'])
+def import_books():
+    """Bulk-import books from a CSV or JSON Lines upload (multipart field "file", or the raw
+    request body). The body is streamed; the response reports counts, errors and rows/sec."""
+    upload = request.files.get('file')
+    if upload:
+        stream, filename, content_type = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename, content_type = request.stream, None, request.mimetype
+    fmt = request.args.get('format') or catalog_import.detect_format(filename, content_type)
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+
+    def on_complete(report):
+        catalog_import.optimize(DATABASE)
+        catalog_changed()
+
+    importer = catalog_import.CatalogImporter(
+        DATABASE,
+        chunk_rows=request.args.get('chunk_size', catalog_import.DEFAULT_CHUNK_ROWS, type=int),
+        default_branch=request.args.get('branch', inventory.DEFAULT_BRANCH),
+        on_complete=on_complete
+    )
+    try:
+        report = importer.run(catalog_import.iter_rows(stream, fmt))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        # Chunks committed before any failure may already have given copies to waiting members
+        notify_waitlist_promotions(importer.promotions)
+
+    print(f"[Import] {report['inserted']} books imported from {report['rows_read']} rows "
+          f"({report['rows_per_second']} rows/sec)")
+    aborted = report.get('aborted')
+    if aborted:
+        # Rows committed before the failure stay imported; the report says how far it got
+        print(f"[Import] Stopped after line {aborted['after_line']}: {aborted['error']}")
+        report['error'] = 'Upload must be UTF-8 text' if aborted['type'] == 'UnicodeDecodeError' else \
+            f"Import stopped after line {aborted['after_line']}: {aborted['error']}"
+        return jsonify(report), 400 if aborted['bad_input'] else 500
+    return jsonify(report)
+
+@app.route('/api/admin/export/<name>', methods=['GET'])
+def export_report(name):
+    """Download catalog, loans, fines or reservations as CSV or NDJSON (?format=, ?gzip=1).
+    Rows are streamed in batches, so memory use does not grow with the table."""
+    if name not in report_export.EXPORTS:
+        return jsonify({'error': f"Unknown export. Available: {', '.join(report_export.EXPORTS)}"}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+
+    filename = f"{name}-{datetime.now().strftime('%Y%m%d')}.{fmt}" + ('.gz' if compress else '')
+    body = report_export.stream_export(DATABASE, name, fmt, compress, request.args.to_dict())
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    if compress:
+        mimetype = 'application/gzip'
+    return Response(body, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/admin/books', methods=['POST'])
 def add_book():
     data = request.json
@@ -742,13 +1149,29 @@ def add_book():
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
     
-    # Auto-generate ISBN
-    import random
-    isbn = f"978-{random.randint(1000000000, 9999999999)}"
-    
+    try:
+        isbn = catalog_import.normalize_isbn(data.get('isbn'))
+    except catalog_import.ImportRowError as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    if isbn:
+        cursor.execute('SELECT id FROM books WHERE isbn = ?', (isbn,))
+        if cursor.fetchone():
+            conn.close()
+            return jsonify({'error': 'A book with this ISBN already exists'}), 409
+    else:
+        # Auto-generate an ISBN that is not taken yet
+        import random
+        while True:
+            isbn = f"978{random.randint(1000000000, 9999999999)}"
+            cursor.execute('SELECT 1 FROM books WHERE isbn = ?', (isbn,))
+            if not cursor.fetchone():
+                break
+    
+    # Counters start at zero; add_copies creates the copy rows and counts them
     cursor.execute('''
-        INSERT INTO books (title, author, isbn, category, description, price, is_free, is_ebook, reading_time_minutes, total_copies, available_copies, publish_date)
-        VALUES (?, ?, ?, ?, ?, 0, 1, 0, ?, ?, ?, ?)
+        INSERT INTO books (title, author, isbn, category, description, price, is_free, is_ebook, reading_time_minutes, total_copies, available_copies, publish_date, cover_image)
+        VALUES (?, ?, ?, ?, ?, 0, 1, 0, ?, 0, 0, ?, ?)
     ''', (
         data.get('title'),
         data.get('author'),
@@ -756,15 +1179,25 @@ def add_book():
         data.get('category'),
         data.get('description', ''),
         data.get('reading_time_minutes', 0),
-        data.get('total_copies', 1),
-        data.get('available_copies', 1),
-        data.get('publish_date')
+        data.get('publish_date'),
+        data.get('cover_image')
     ))
+    book_id = cursor.lastrowid
+    
+    try:
+        inventory.add_copies(cursor, book_id, int(data.get('total_copies', 1)),
+                             data.get('branch', inventory.DEFAULT_BRANCH), data.get('barcodes'))
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Barcode already in use'}), 409
     
     conn.commit()
     conn.close()
+    catalog_changed([book_id])
+    cover_thumbs.enqueue(data.get('cover_image'))
     
-    return jsonify({'message': 'Book added successfully'})
+    return jsonify({'message': 'Book added successfully', 'book_id': book_id})
 
 @app.route('/api/books/<int:book_id>/reserve', methods=['POST'])
 def reserve_book(book_id):
@@ -772,32 +1205,38 @@ def reserve_book(book_id):
         data = request.json
         user_id = data.get('user_id', 1)
 
-        conn = sqlite3.connect(DATABASE)
+        conn = inventory.connect(DATABASE)
         cursor = conn.cursor()
 
-        # Check if book exists and get availability
-        cursor.execute('SELECT title, available_copies, total_copies FROM books WHERE id = ?', (book_id,))
-        book = cursor.fetchone()
+        # Duplicate check, copy decrement and reservation rows commit as one write transaction
+        inventory.begin_immediate(conn)
+        try:
+            # Check if user already has pending request for this book
+            cursor.execute('SELECT id FROM book_reservations WHERE book_id = ? AND user_id = ? AND (status = "pending" OR status = "approved_checkout")', (book_id, user_id))
+            existing = cursor.fetchone()
+
+            if existing:
+                conn.rollback()
+                conn.close()
+                return jsonify({'error': 'You already have a pending request or approved checkout for this book'}), 400
 
-        if not book:
-            conn.close()
-            return jsonify({'error': 'Book not found'}), 404
+            # Automated approval logic: approved only if a copy could actually be taken
+            copy_id = inventory.take_copy(cursor, book_id, 'on_hold')
+            approved = copy_id is not None
+            position = None
 
-        book_title, available_copies, total_copies = book
+            cursor.execute('SELECT title FROM books WHERE id = ?', (book_id,))
+            book = cursor.fetchone()
 
-        # Check if user already has pending request for this book
-        cursor.execute('SELECT id FROM book_reservations WHERE book_id = ? AND user_id = ? AND (status = "pending" OR status = "approved_checkout")', (book_id, user_id))
-        existing = cursor.fetchone()
+            if not book:
+                conn.rollback()
+                conn.close()
+                return jsonify({'error': 'Book not found'}), 404
 
-        if existing:
-            conn.close()
-            return jsonify({'error': 'You already have a pending request or approved checkout for this book'}), 400
+            book_title = book[0]
 
-        # Automated approval logic
-        if available_copies > 0:
-            # Auto-approve: create reservation and checkout record
-            conn.execute('BEGIN')
-            try:
+            if approved:
+                # Auto-approve: create reservation and checkout record
                 cursor.execute('''
                     INSERT INTO book_reservations (book_id, user_id, status)
                     VALUES (?, ?, 'approved_checkout')
@@ -806,23 +1245,36 @@ def reserve_book(book_id):
                 reservation_id = cursor.lastrowid
 
                 # Calculate checkout deadline (2 days from now)
-                from datetime import datetime, timedelta
                 checkout_deadline = (datetime.now() + timedelta(days=2)).isoformat()
 
                 # Create checkout record
                 cursor.execute('''
-                    INSERT INTO book_checkouts (reservation_id, book_id, user_id, status, checkout_deadline, approved_at)
-                    VALUES (?, ?, ?, 'pending_checkout', ?, ?)
-                ''', (reservation_id, book_id, user_id, checkout_deadline, datetime.now().isoformat()))
+                    INSERT INTO book_checkouts (reservation_id, book_id, user_id, status, checkout_deadline, approved_at, copy_id)
+                    VALUES (?, ?, ?, 'pending_checkout', ?, ?, ?)
+                ''', (reservation_id, book_id, user_id, checkout_deadline, datetime.now().isoformat(), copy_id))
+                checkout_id = cursor.lastrowid
+                waitlist.resolve(cursor, book_id, user_id)
+            elif data.get('waitlist', True):
+                # No copy free: queue the user; return_book / expired checkouts promote from here
+                position = waitlist.join(cursor, book_id, user_id)
+            else:
+                # Auto-reject: book not available
+                cursor.execute('''
+                    INSERT INTO book_reservations (book_id, user_id, status, rejection_reason)
+                    VALUES (?, ?, 'rejected', 'Book currently unavailable')
+                ''', (book_id, user_id))
+
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            conn.close()
+            raise e
+        conn.close()
 
-                # Update book availability
-                cursor.execute('UPDATE books SET available_copies = available_copies - 1 WHERE id = ?', (book_id,))
+        if approved:
+            checkout_deadlines.schedule(checkout_id, checkout_deadline)
+            library_context.invalidate_user(user_id)
 
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                raise e
-            
             # Send notification to user
             send_push_to_user(user_id, 'Reservation Approved', f'Your reservation for "{book_title}" has been approved! Please collect it within 2 days.', {
                 'type': 'reservation_approved',
@@ -830,8 +1282,6 @@ def reserve_book(book_id):
                 'book_title': book_title,
                 'checkout_deadline': checkout_deadline
             })
-            
-            conn.close()
 
             return jsonify({
                 'status': 'approved_checkout',
@@ -839,13 +1289,15 @@ def reserve_book(book_id):
                 'checkout_deadline': checkout_deadline
             })
 
-        else:
-            # Auto-reject: book not available
-            cursor.execute('''
-                INSERT INTO book_reservations (book_id, user_id, status, rejection_reason)
-                VALUES (?, ?, 'rejected', 'Book currently unavailable')
-            ''', (book_id, user_id))
+        elif position:
+            return jsonify({
+                'status': 'waitlisted',
+                'position': position,
+                'message': f'"{book_title}" is currently unavailable. You are number {position} on the waitlist '
+                           f'and will be notified when a copy is reserved for you.'
+            })
 
+        else:
             # Send notification to user
             send_push_to_user(user_id, 'Reservation Rejected', f'Sorry, "{book_title}" is currently unavailable.', {
                 'type': 'reservation_rejected',
@@ -854,9 +1306,6 @@ def reserve_book(book_id):
                 'reason': 'Book currently unavailable'
             })
 
-            conn.commit()
-            conn.close()
-
             return jsonify({
                 'status': 'rejected',
                 'reason': 'Book currently unavailable',
@@ -901,6 +1350,7 @@ def approve_reservation(reservation_id):
         ''', (approved_by, reservation_id))
 
         conn.commit()
+        library_context.invalidate_user(user_id)
 
         # Send push notification to user
         notification_title = "📚 Reservation Approved!"
@@ -951,6 +1401,7 @@ def reject_reservation(reservation_id):
         ''', (approved_by, rejection_reason, reservation_id))
 
         conn.commit()
+        library_context.invalidate_user(user_id)
 
         # Send push notification to user
         notification_title = "❌ Reservation Rejected"
@@ -1040,19 +1491,20 @@ def get_checkouts():
 
 @app.route('/api/admin/checkouts/<int:checkout_id>/complete', methods=['POST'])
 def complete_checkout(checkout_id):
-    conn = sqlite3.connect(DATABASE)
+    conn = inventory.connect(DATABASE)
     cursor = conn.cursor()
     
     try:
+        inventory.begin_immediate(conn)
         # Get checkout details
-        cursor.execute('SELECT book_id, user_id FROM book_checkouts WHERE id = ?', (checkout_id,))
+        cursor.execute('SELECT book_id, user_id, copy_id FROM book_checkouts WHERE id = ?', (checkout_id,))
         checkout = cursor.fetchone()
         
         if not checkout:
             conn.close()
             return jsonify({'error': 'Checkout not found'}), 404
             
-        book_id, user_id = checkout
+        book_id, user_id, copy_id = checkout
         
         # Update checkout status
         cursor.execute('''
@@ -1069,15 +1521,17 @@ def complete_checkout(checkout_id):
         ''', (checkout_id,))
         
         # Note: available_copies was already decreased when reservation was approved
-        # Do not decrease again
+        # Do not decrease again; the held copy just goes out on loan
+        inventory.lend_held_copy(cursor, copy_id)
         
         # Create book issue record
         cursor.execute('''
-            INSERT INTO book_issues (book_id, user_id, issue_date, due_date, status)
-            VALUES (?, ?, datetime('now'), datetime('now', '+30 days'), 'issued')
-        ''', (book_id, user_id))
+            INSERT INTO book_issues (book_id, user_id, issue_date, due_date, status, copy_id)
+            VALUES (?, ?, datetime('now'), datetime('now', '+30 days'), 'issued', ?)
+        ''', (book_id, user_id, copy_id))
         
         conn.commit()
+        library_context.invalidate_user(user_id)
         conn.close()
         
         return jsonify({'message': 'Checkout completed successfully'})
@@ -1086,31 +1540,121 @@ def complete_checkout(checkout_id):
         conn.close()
         return jsonify({'error': str(e)}), 500
 
+def run_bulk_circulation(operation, *args):
+    """Validate the ids of a bulk request, apply `operation` in one write transaction and
+    queue its pushes. Returns a Flask response with per-item results."""
+    data = request.get_json(silent=True) or {}
+    try:
+        ids = circulation.unique_ids(data.get('ids') or [])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ids must be a list of integers'}), 400
+    if not ids:
+        return jsonify({'error': 'ids is required'}), 400
+    if len(ids) > BULK_MAX_ITEMS:
+        return jsonify({'error': f'At most {BULK_MAX_ITEMS} ids per request'}), 400
+
+    conn = inventory.connect(DATABASE)
+    cursor = conn.cursor()
+    try:
+        inventory.begin_immediate(conn)
+        results, pushes = operation(cursor, ids, *args)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+
+    # Every member whose loans changed, whether or not they get a push (completions send none)
+    changed_users = set()
+    for result in results:
+        if result['status'] in ('approved', 'completed', 'returned'):
+            changed_users.add(result['user_id'])
+        if result.get('waitlist_checkout'):
+            changed_users.add(result['waitlist_checkout']['user_id'])
+            checkout_deadlines.schedule(result['waitlist_checkout']['checkout_id'], result['waitlist_checkout']['checkout_deadline'])
+    for user_id in changed_users:
+        library_context.invalidate_user(user_id)
+    enqueue_push_batch(pushes)
+
+    succeeded = sum(1 for result in results if result['status'] in ('approved', 'completed', 'returned'))
+    return jsonify({
+        'results': results,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'notifications_queued': len(pushes)
+    })
+
+@app.route('/api/admin/checkouts/bulk-complete', methods=['POST'])
+def bulk_complete_checkouts():
+    """Complete many pending checkouts in one transaction: {"ids": [...]}"""
+    return run_bulk_circulation(circulation.complete_checkouts)
+
 @app.route('/api/admin/books/<int:book_id>', methods=['PUT'])
 def edit_book(book_id):
-    data = request.json
-    
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        UPDATE books SET title = ?, author = ?, category = ?, description = ?, 
-                        total_copies = ?, available_copies = ?, publish_date = ?
-        WHERE id = ?
-    ''', (
-        data.get('title'),
-        data.get('author'),
-        data.get('category'),
-        data.get('description'),
-        data.get('total_copies'),
-        data.get('available_copies'),
-        data.get('publish_date'),
-        book_id
-    ))
-    
-    conn.commit()
-    conn.close()
-    
+    data = request.get_json(silent=True) or {}
+
+    # Validate before taking the write lock
+    total_copies = None
+    if data.get('total_copies') is not None:
+        try:
+            total_copies = int(data['total_copies'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'total_copies must be a whole number'}), 400
+        if total_copies < 0:
+            return jsonify({'error': 'total_copies cannot be negative'}), 400
+
+    conn = inventory.connect(DATABASE)
+    try:
+        cursor = conn.cursor()
+        inventory.begin_immediate(conn)
+
+        # Copy counters are derived from book_copies and never written directly: a new
+        # total_copies adds copies or withdraws shelved ones; available_copies is ignored
+        promotions = []
+        if total_copies is not None:
+            cursor.execute('SELECT total_copies FROM books WHERE id = ?', (book_id,))
+            book = cursor.fetchone()
+            change = total_copies - (book[0] or 0) if book else 0
+            if change > 0:
+                inventory.add_copies(cursor, book_id, change, data.get('branch', inventory.DEFAULT_BRANCH))
+                promotions = waitlist.promote_for_copies(cursor, book_id, change)
+            elif change < 0:
+                cursor.execute('''
+                    SELECT id FROM book_copies WHERE book_id = ? AND state = 'available' ORDER BY id DESC LIMIT ?
+                ''', (book_id, -change))
+                shelved = [row[0] for row in cursor.fetchall()]
+                if len(shelved) < -change:
+                    conn.rollback()
+                    return jsonify({'error': f'Only {len(shelved)} copies are on the shelf; the rest are lent out'}), 400
+                for copy_id in shelved:
+                    inventory.set_state(cursor, copy_id, 'withdrawn', ('available',))
+
+        cursor.execute('''
+            UPDATE books SET title = ?, author = ?, category = ?, description = ?, publish_date = ?,
+                             cover_image = COALESCE(?, cover_image)
+            WHERE id = ?
+        ''', (
+            data.get('title'),
+            data.get('author'),
+            data.get('category'),
+            data.get('description'),
+            data.get('publish_date'),
+            data.get('cover_image'),
+            book_id
+        ))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    catalog_changed([book_id])
+    cover_thumbs.enqueue(data.get('cover_image'))
+    notify_waitlist_promotions(promotions)
+
     return jsonify({'message': 'Book updated successfully'})
 
 @app.route('/api/admin/books/<int:book_id>', methods=['DELETE'])
@@ -1118,13 +1662,102 @@ def delete_book(book_id):
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
     
+    cursor.execute('DELETE FROM book_copies WHERE book_id = ?', (book_id,))
     cursor.execute('DELETE FROM books WHERE id = ?', (book_id,))
     
     conn.commit()
     conn.close()
+    catalog_changed([book_id])
     
     return jsonify({'message': 'Book deleted successfully'})
 
+@app.route('/api/admin/books/<int:book_id>/copies', methods=['GET'])
+def get_book_copies(book_id):
+    """Every copy of a book with its barcode, branch and state, plus per-branch counts"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    copies = inventory.get_copies(cursor, book_id)
+    branches = inventory.branch_counts(cursor, book_id)
+    conn.close()
+    return jsonify({'book_id': book_id, 'copies': copies, 'branches': branches})
+
+@app.route('/api/admin/books/<int:book_id>/copies', methods=['POST'])
+def add_book_copies(book_id):
+    """Add copies: {"count": 2, "branch": "north"} or {"barcodes": ["..."], "branch": "north"}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        count = int(data.get('count', 1))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'count must be a whole number'}), 400
+    conn = inventory.connect(DATABASE)
+    cursor = conn.cursor()
+    inventory.begin_immediate(conn)
+    cursor.execute('SELECT id FROM books WHERE id = ?', (book_id,))
+    if not cursor.fetchone():
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Book not found'}), 404
+    try:
+        copy_ids = inventory.add_copies(cursor, book_id, count,
+                                        data.get('branch', inventory.DEFAULT_BRANCH), data.get('barcodes'))
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Barcode already in use'}), 409
+    # New copies go to members already on the waitlist before anyone else can reserve them
+    promotions = waitlist.promote_for_copies(cursor, book_id, len(copy_ids))
+    conn.commit()
+    copies = [copy for copy in inventory.get_copies(cursor, book_id) if copy['id'] in copy_ids]
+    conn.close()
+    notify_waitlist_promotions(promotions)
+    return jsonify({'copies': copies, 'waitlist_promoted': len(promotions)}), 201
+
+@app.route('/api/admin/copies/<int:copy_id>', methods=['PUT'])
+def update_book_copy(copy_id):
+    """Change a copy's state (damaged, lost, withdrawn, available) or branch. Lent copies
+    change state through checkout and return, not here."""
+    data = request.get_json(silent=True) or {}
+    state = data.get('state')
+    if state and state not in ('available', 'damaged', 'lost', 'withdrawn'):
+        return jsonify({'error': 'state must be one of available, damaged, lost, withdrawn'}), 400
+
+    conn = inventory.connect(DATABASE)
+    cursor = conn.cursor()
+    inventory.begin_immediate(conn)
+    cursor.execute('SELECT book_id FROM book_copies WHERE id = ?', (copy_id,))
+    copy = cursor.fetchone()
+    if not copy:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Copy not found'}), 404
+
+    promotion = None
+    if state:
+        if not inventory.set_state(cursor, copy_id, state, ('available', 'damaged', 'lost', 'withdrawn')):
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': 'Copy is lent out; return it first'}), 409
+        if state == 'available':
+            promotion = waitlist.promote_next(cursor, copy[0])
+    if data.get('branch'):
+        cursor.execute('UPDATE book_copies SET branch = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                       (data['branch'], copy_id))
+    conn.commit()
+    conn.close()
+    notify_waitlist_promotions([promotion])
+    return jsonify({'message': 'Copy updated successfully'})
+
+@app.route('/api/admin/copies/barcode/<path:barcode>', methods=['GET'])
+def lookup_barcode(barcode):
+    """Desk scan: the copy, its title and its current loan or hold"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    copy = inventory.find_by_barcode(cursor, barcode)
+    conn.close()
+    if not copy:
+        return jsonify({'error': 'Unknown barcode'}), 404
+    return jsonify(copy)
+
 @app.route('/api/users', methods=['GET'])
 def get_users():
     conn = sqlite3.connect(DATABASE)
@@ -1388,17 +2021,6 @@ def issue_book(book_id):
     custom_due_date = data.get('due_date')
     overdue_fee = data.get('overdue_fee', 5.00)
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # Check availability
-    cursor.execute('SELECT available_copies FROM books WHERE id = ?', (book_id,))
-    book = cursor.fetchone()
-    
-    if not book or book[0] <= 0:
-        conn.close()
-        return jsonify({'error': 'Book not available'}), 400
-    
     # Issue book
     issue_date = datetime.now().date()
     if custom_due_date:
@@ -1406,22 +2028,32 @@ def issue_book(book_id):
     else:
         due_date = issue_date + timedelta(days=14)
     
+    conn = inventory.connect(DATABASE)
+    cursor = conn.cursor()
+    
+    # Take a copy atomically (the scanned one if a barcode is given); fails when none is left
+    inventory.begin_immediate(conn)
+    copy_id = inventory.take_copy(cursor, book_id, barcode=data.get('barcode'), branch=data.get('branch'))
+    if not copy_id:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Book not available'}), 400
+    
     cursor.execute('''
-        INSERT INTO book_issues (book_id, user_id, issue_date, due_date, status, overdue_fee_per_day)
-        VALUES (?, ?, ?, ?, 'issued', ?)
-    ''', (book_id, user_id, issue_date, due_date, overdue_fee))
+        INSERT INTO book_issues (book_id, user_id, issue_date, due_date, status, overdue_fee_per_day, copy_id)
+        VALUES (?, ?, ?, ?, 'issued', ?, ?)
+    ''', (book_id, user_id, issue_date, due_date, overdue_fee, copy_id))
     
     # Get the inserted issue ID
     issue_id = cursor.lastrowid
-    
-    # Update available copies
-    cursor.execute('UPDATE books SET available_copies = available_copies - 1 WHERE id = ?', (book_id,))
+    waitlist.resolve(cursor, book_id, user_id)
     
     # Get book details
     cursor.execute('SELECT title, author FROM books WHERE id = ?', (book_id,))
     book = cursor.fetchone()
     
     conn.commit()
+    library_context.invalidate_user(user_id)
     
     # Send push notification to user about book issuance
     book_title = book[0] if book else "Book"
@@ -1498,16 +2130,19 @@ def get_issued_books_count():
 
 @app.route('/api/admin/issues/<int:issue_id>/return', methods=['POST'])
 def return_book(issue_id):
-    conn = sqlite3.connect(DATABASE)
+    conn = inventory.connect(DATABASE)
     cursor = conn.cursor()
     
-    cursor.execute('SELECT book_id, user_id FROM book_issues WHERE id = ?', (issue_id,))
+    # The returned copy goes straight to the head of the waitlist, in the same transaction
+    inventory.begin_immediate(conn)
+    cursor.execute('SELECT book_id, user_id, copy_id FROM book_issues WHERE id = ?', (issue_id,))
     book_result = cursor.fetchone()
     
     if book_result:
-        book_id, user_id = book_result
+        book_id, user_id, copy_id = book_result
         cursor.execute('UPDATE book_issues SET status = "returned", return_date = date("now") WHERE id = ?', (issue_id,))
-        cursor.execute('UPDATE books SET available_copies = available_copies + 1 WHERE id = ?', (book_id,))
+        inventory.release_copy(cursor, book_id, copy_id)
+        promotion = waitlist.promote_next(cursor, book_id)
         
         # Add to reading history when admin marks as returned
         cursor.execute('''
@@ -1517,6 +2152,8 @@ def return_book(issue_id):
         ''', (book_id, user_id))
         
         conn.commit()
+        library_context.invalidate_user(user_id)
+        notify_waitlist_promotions([promotion])
         
         # Send push notification to user about book return
         cursor.execute('SELECT title FROM books WHERE id = ?', (book_id,))
@@ -1534,6 +2171,11 @@ def return_book(issue_id):
     conn.close()
     return jsonify({'message': 'Book returned successfully'})
 
+@app.route('/api/admin/issues/bulk-return', methods=['POST'])
+def bulk_return_books():
+    """Return many issued books in one transaction: {"ids": [...]}. Freed copies go to waitlists."""
+    return run_bulk_circulation(circulation.return_issues, datetime.now().isoformat())
+
 @app.route('/api/admin/issues/<int:issue_id>/damage', methods=['POST'])
 def report_damage(issue_id):
     data = request.json
@@ -1550,6 +2192,7 @@ def report_damage(issue_id):
     ''', (damage_amount, damage_description, issue_id))
     
     conn.commit()
+    library_context.invalidate_issue(issue_id)
     conn.close()
     
     return jsonify({'message': 'Damage reported successfully'})
@@ -1621,7 +2264,7 @@ def get_all_fines():
         overdue_fine = 0
         if fine[9] == 'issued' and fine[8]:  # status is issued and has due_date
             from datetime import datetime
-            due_date = datetime.strptime(fine[8], '%Y-%m-%d').date()
+            due_date = datetime.strptime(fine[8][:10], '%Y-%m-%d').date()
             today = datetime.now().date()
             if today > due_date:
                 days_overdue = (today - due_date).days
@@ -1672,6 +2315,7 @@ def get_user_history(user_id):
         for row in cursor.fetchall():
             issue = dict(row)
             issue['is_overdue'] = False
+            issue.update(cover_thumbs.thumb_urls(issue['book_id'], issue['cover_image']))
             
             # Check if book is overdue
             if issue['status'] == 'issued' and issue['due_date']:
@@ -1741,7 +2385,7 @@ def get_user_fines(user_id):
         overdue_fine = 0
         if fine[9] == 'issued' and fine[8]:  # status is issued and has due_date
             from datetime import datetime
-            due_date = datetime.strptime(fine[8], '%Y-%m-%d').date()
+            due_date = datetime.strptime(fine[8][:10], '%Y-%m-%d').date()
             today = datetime.now().date()
             if today > due_date:
                 days_overdue = (today - due_date).days
@@ -1871,6 +2515,7 @@ def pay_damage_fine(fine_id):
         cursor.execute('UPDATE book_issues SET fine_amount = ? WHERE id = ?', (remaining, fine_id))
 
     conn.commit()
+    library_context.invalidate_user(row[1])
     conn.close()
 
     return jsonify({'message': 'Damage payment recorded', 'paid_amount': paid_amount, 'remaining': max(0.0, current_fine_amount - paid_amount)})
@@ -1895,7 +2540,7 @@ def pay_overdue_fine(fine_id):
     overdue_amount = 0
     if status == 'issued' and due_date:
         from datetime import datetime
-        due = datetime.strptime(due_date, '%Y-%m-%d').date()
+        due = datetime.strptime(due_date[:10], '%Y-%m-%d').date()
         today = datetime.now().date()
         if today > due and overdue_fee_per_day > 0:
             days_overdue = (today - due).days
@@ -1921,6 +2566,7 @@ def pay_overdue_fine(fine_id):
         cursor.execute('UPDATE book_issues SET overdue_fee_per_day = 0 WHERE id = ?', (fine_id,))
 
     conn.commit()
+    library_context.invalidate_issue(fine_id)
     conn.close()
 
     return jsonify({'message': 'Overdue payment recorded', 'paid_amount': paid_amount, 'remaining': max(0.0, overdue_amount - paid_amount)})
@@ -2094,24 +2740,27 @@ def approve_reservation_request(request_id):
     data = request.json
     admin_id = data.get('admin_id', 1)
     
-    conn = sqlite3.connect(DATABASE)
+    conn = inventory.connect(DATABASE)
     cursor = conn.cursor()
     
     try:
+        # Lock first so two admins cannot both approve the request or take the last copy
+        inventory.begin_immediate(conn)
+
         # Get reservation details
         cursor.execute('SELECT book_id, user_id FROM book_reservations WHERE id = ? AND status = "pending"', (request_id,))
         reservation = cursor.fetchone()
         
         if not reservation:
+            conn.rollback()
             return jsonify({'error': 'Reservation not found or already processed'}), 404
         
         book_id, user_id = reservation
         
-        # Check availability
-        cursor.execute('SELECT available_copies FROM books WHERE id = ?', (book_id,))
-        book = cursor.fetchone()
-        
-        if not book or book[0] <= 0:
+        # Take a copy (replaces the separate availability check)
+        copy_id = inventory.take_copy(cursor, book_id)
+        if not copy_id:
+            conn.rollback()
             return jsonify({'error': 'Book not available'}), 400
         
         # Issue the book
@@ -2119,12 +2768,10 @@ def approve_reservation_request(request_id):
         due_date = issue_date + timedelta(days=14)
         
         cursor.execute('''
-            INSERT INTO book_issues (book_id, user_id, issue_date, due_date, status, overdue_fee_per_day)
-            VALUES (?, ?, ?, ?, 'issued', 5.00)
-        ''', (book_id, user_id, issue_date, due_date))
-        
-        # Update available copies
-        cursor.execute('UPDATE books SET available_copies = available_copies - 1 WHERE id = ?', (book_id,))
+            INSERT INTO book_issues (book_id, user_id, issue_date, due_date, status, overdue_fee_per_day, copy_id)
+            VALUES (?, ?, ?, ?, 'issued', 5.00, ?)
+        ''', (book_id, user_id, issue_date, due_date, copy_id))
+        waitlist.resolve(cursor, book_id, user_id)
         
         # Update reservation status with local timestamp
         local_timestamp = (datetime.now(TZ_JHB).isoformat() if TZ_JHB else datetime.now().isoformat())
@@ -2157,13 +2804,17 @@ def approve_reservation_request(request_id):
                 f'{{"reservationId": {request_id}, "bookTitle": "{book_title}", "bookId": {book_id}, "timestamp": "{local_timestamp}"}}',
                 local_timestamp
             ))
-            # Best-effort: attempt to send a push to the user's devices
+        
+        conn.commit()
+        library_context.invalidate_user(user_id)
+
+        # Best-effort: attempt to send a push to the user's devices (after commit, so the
+        # write lock is not held during the network call)
+        if reservation_info:
             try:
                 send_push_to_user(user_id, 'Reservation Approved', f'Your reservation for "{book_title}" has been approved. Please collect it within 3 days.', {"reservationId": request_id, "bookTitle": book_title, "bookId": book_id, "timestamp": local_timestamp})
             except Exception as e:
                 print(f'[Push] reservation approved push error: {e}')
-        
-        conn.commit()
         return jsonify({'message': 'Reservation approved and book issued'})
     except Exception as e:
         conn.rollback()
@@ -2171,6 +2822,13 @@ def approve_reservation_request(request_id):
     finally:
         conn.close()
 
+@app.route('/api/admin/reservation-requests/bulk-approve', methods=['POST'])
+def bulk_approve_reservation_requests():
+    """Approve many pending reservation requests in one transaction: {"ids": [...], "admin_id": 1}"""
+    data = request.get_json(silent=True) or {}
+    local_timestamp = (datetime.now(TZ_JHB).isoformat() if TZ_JHB else datetime.now().isoformat())
+    return run_bulk_circulation(circulation.approve_reservations, data.get('admin_id', 1), local_timestamp)
+
 @app.route('/api/admin/reservation-requests/<int:request_id>/reject', methods=['POST'], endpoint='reject_reservation_request')
 def reject_reservation_request(request_id):
     data = request.json
@@ -2212,6 +2870,7 @@ def reject_reservation_request(request_id):
                 print(f'[Push] reservation rejected push error: {e}')
         
         conn.commit()
+        library_context.invalidate_user(reservation_info[0] if reservation_info else None)
         return jsonify({'message': 'Reservation rejected'})
     except Exception as e:
         conn.rollback()
@@ -2232,10 +2891,12 @@ def get_reservation_count():
 
 @app.route('/api/reservations/<int:reservation_id>/cancel', methods=['DELETE'])
 def cancel_reservation(reservation_id):
-    conn = sqlite3.connect(DATABASE)
+    conn = inventory.connect(DATABASE)
     cursor = conn.cursor()
+    promotion = None
     
     try:
+        inventory.begin_immediate(conn)
         # Get reservation details before deleting
         cursor.execute('SELECT user_id, status, book_id FROM book_reservations WHERE id = ?', (reservation_id,))
         result = cursor.fetchone()
@@ -2253,9 +2914,12 @@ def cancel_reservation(reservation_id):
         
         # If approved, also cancel the associated checkout
         if status in ['approved', 'approved_checkout']:
+            cursor.execute('SELECT copy_id FROM book_checkouts WHERE reservation_id = ?', (reservation_id,))
+            checkout = cursor.fetchone()
             cursor.execute('DELETE FROM book_checkouts WHERE reservation_id = ?', (reservation_id,))
-            # Return the book copy to available
-            cursor.execute('UPDATE books SET available_copies = available_copies + 1 WHERE id = ?', (book_id,))
+            # Return the book copy to available, or straight to the next user on the waitlist
+            inventory.release_copy(cursor, book_id, checkout[0] if checkout else None)
+            promotion = waitlist.promote_next(cursor, book_id)
         
         # Delete the reservation
         cursor.execute('DELETE FROM book_reservations WHERE id = ?', (reservation_id,))
@@ -2270,12 +2934,40 @@ def cancel_reservation(reservation_id):
         print(f'Cancelled {status} reservation {reservation_id} for user {user_id}')
         
         conn.commit()
+        library_context.invalidate_user(user_id)
         conn.close()
+        notify_waitlist_promotions([promotion])
         return jsonify({'message': 'Reservation cancelled successfully'})
     except Exception as e:
         conn.close()
         return jsonify({'error': str(e)}), 500
 
+# ============ WAITLIST API ============
+@app.route('/api/users/<int:user_id>/waitlist', methods=['GET'])
+def get_user_waitlist(user_id):
+    """Books the user is queued for, with their position in each queue"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    entries = waitlist.user_entries(cursor, user_id)
+    conn.close()
+    return jsonify(entries)
+
+@app.route('/api/books/<int:book_id>/waitlist', methods=['DELETE'])
+def leave_waitlist(book_id):
+    user_id = request.args.get('user_id', type=int)
+    if not user_id:
+        return jsonify({'error': 'user_id is required'}), 400
+
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    left = waitlist.resolve(cursor, book_id, user_id, status='cancelled')
+    conn.commit()
+    conn.close()
+
+    if not left:
+        return jsonify({'error': 'Not on the waitlist for this book'}), 404
+    return jsonify({'message': 'Removed from waitlist'})
+
 # ============ NOTIFICATIONS API ============
 @app.route('/api/users/<int:user_id>/notifications', methods=['GET'])
 def get_user_notifications(user_id):
@@ -2529,7 +3221,46 @@ def get_ml_recommendation_service():
         ml_recommendation_service = MLRecommendationService(DATABASE)
     return ml_recommendation_service
 
+# Prompt context for the library assistant; recommendations are computed off the request path
+library_context = LibraryContextService(
+    DATABASE,
+    lambda user_id, n: get_ml_recommendation_service().content_based_recommendations(user_id, n),
+    stats_refresh_seconds=LIBRARY_CONTEXT_REFRESH_SECONDS
+)
+
+def ai_rate_limited(view):
+    """Admit an AI route through ai_limiter: 429 when the user is over their rate limit,
+    503 when all AI slots and the wait queue are full. Streaming responses hold their
+    slot until the stream closes."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True)
+        user_id = data.get('user_id') if isinstance(data, dict) else None
+        user_key = f"user:{user_id}" if user_id else f"ip:{request.remote_addr}"
+
+        rejection = ai_limiter.acquire(user_key)
+        if rejection:
+            status, retry_after = rejection
+            message = 'Too many AI requests, please slow down' if status == 429 else 'AI assistant is busy, please retry shortly'
+            response = jsonify({'error': message, 'retry_after': retry_after})
+            response.status_code = status
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            ai_limiter.release()
+            raise
+        if response.is_streamed:
+            response.call_on_close(ai_limiter.release)
+        else:
+            ai_limiter.release()
+        return response
+    return wrapper
+
 @app.route('/api/ai/assistant', methods=['POST'])
+@ai_rate_limited
 def ai_book_assistant():
     if not GENAI_API_KEY:
         return jsonify({'error': 'AI features are not configured'}), 503
@@ -2538,11 +3269,6 @@ def ai_book_assistant():
     user_message = data.get('message', '')
     
     try:
-        import requests as req
-        
-        # Use REST API directly with gemini-1.5-flash (available model)
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GENAI_API_KEY}"
-        
         payload = {
             "contents": [{
                 "parts": [{
@@ -2551,11 +3277,7 @@ def ai_book_assistant():
             }]
         }
         
-        api_response = req.post(url, json=payload)
-        api_response.raise_for_status()
-        result = api_response.json()
-        
-        response_text = result['candidates'][0]['content']['parts'][0]['text']
+        response_text, _ = ai_gateway.generate(LIBRARY_ASSISTANT_MODELS, payload, GENAI_API_KEY, timeout=30)
         
         return jsonify({
             'response': response_text,
@@ -2688,21 +3410,156 @@ def get_similar_books(book_id):
             'details': str(e)
         }), 500
 
-@app.route('/api/ai/book-assistant', methods=['POST'])
-def ai_book_assistant_v2():
+# Try multiple models in order of preference (updated for available models)
+BOOK_ASSISTANT_MODELS = [
+    'gemini-2.5-flash',      # Latest stable model
+    'gemini-2.0-flash',      # Previous stable version
+    'gemini-pro-latest',     # Latest pro model
+    'gemini-flash-latest'    # Latest flash model
+]
+
+# Second model is the hedge/fallback target when gemini-1.5-flash is slow or failing
+LIBRARY_ASSISTANT_MODELS = ['gemini-1.5-flash', 'gemini-2.0-flash']
+LIBRARY_ASSISTANT_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "maxOutputTokens": 1000,
+    "topP": 0.8,
+    "topK": 40
+}
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+def get_book_passages(book, question):
+    """Passages from the e-book's own text relevant to the question, plus the index version.
+
+    Books are matched by id, or by title and author since the app only sends those.
+    E-books with a pdf_url that have not been indexed yet are queued for ingestion.
+    If retrieval fails the question is answered from the book's metadata alone.
+    """
     try:
-        print("AI Assistant endpoint called")
-        # Check for either GENAI_API_KEY or GEMINI_API_KEY
-        api_key = os.getenv('GENAI_API_KEY') or os.getenv('GEMINI_API_KEY')
-        print(f"API Key found: {'Yes' if api_key else 'No'}")
-        
-        if not api_key:
-            print("Error: No API key found in environment variables")
-            return jsonify({'error': 'AI not configured: Missing API key'}), 500
-            
+        conn = sqlite3.connect(DATABASE)
         try:
-            # Configure the Google Generative AI client
-            print("Configuring GenAI client...")
+            if book.get('id'):
+                row = conn.execute('SELECT id, is_ebook, pdf_url FROM books WHERE id = ?', (book['id'],)).fetchone()
+            else:
+                row = conn.execute('SELECT id, is_ebook, pdf_url FROM books WHERE title = ? AND author = ? LIMIT 1',
+                                   (book.get('title', ''), book.get('author', ''))).fetchone()
+        finally:
+            conn.close()
+        if not row or not row[1] or not row[2]:
+            return [], None
+
+        book_id = row[0]
+        version = ebook_index.index_version(book_id)
+        if version is None:
+            status = ebook_index.get_status(book_id)
+            if not status or status['status'] not in ('queued', 'indexing', 'failed') or ebook_index.is_stale(status):
+                ebook_index.enqueue(book_id)
+            return [], None
+
+        return ebook_index.retrieve(book_id, question, EBOOK_CONTEXT_TOKEN_BUDGET), version
+    except Exception as e:
+        print(f"Error retrieving e-book passages: {str(e)}")
+        return [], None
+
+def get_conversation_history(data, user_id, question):
+    """Prior turns for an assistant request that names its conversation_id, or None"""
+    try:
+        history = conversation_history.get_history(data.get('conversation_id'), user_id, question,
+                                                   data.get('reply_to_id'))
+    except Exception as e:
+        print(f"Error loading conversation history: {str(e)}")
+        return None
+    return history if history['turns'] else None
+
+def add_history_sections(builder, history, priority):
+    """Rolling summary and recent turns; the turns outrank the summary and keep the newest first"""
+    if not history:
+        return
+    if history['summary']:
+        builder.add('conversation_summary', f"Earlier in this conversation:\n{history['summary']}", priority + 1)
+    builder.add_items('recent_turns', ConversationHistoryService.format_turns(history['turns']), priority,
+                      header="Recent conversation (the question below continues it):\n", keep='last')
+
+def record_prompt(route, report):
+    prompt_stats.record(route, report)
+    dropped = [name for name, section in report['sections'].items() if section['dropped_items']]
+    print(f"[Prompt] {route}: ~{report['tokens']} tokens (budget {report['budget']})"
+          + (f", trimmed: {', '.join(dropped)}" if dropped else ''))
+
+def build_book_assistant_prompt(book, question, passages=None, history=None):
+    """Full prompt for the per-book study assistant, kept within AI_PROMPT_TOKEN_BUDGET"""
+    system_prompt = (
+        "You are a helpful study assistant for library books. "
+        "ONLY answer questions related to the provided book context. "
+        "If the user asks something off-topic, politely redirect them back to the book. "
+        "Provide clear, structured, study-friendly answers: summaries, themes, characters, plot, quotes, and exam-style insights."
+    )
+
+    book_context = (
+        f"Book Context:\n"
+        f"Title: {book.get('title','')}\n"
+        f"Author: {book.get('author','')}\n"
+        f"Category: {book.get('category','')}\n"
+        f"Description: {book.get('description','')}"
+    )
+
+    builder = PromptBuilder(AI_PROMPT_TOKEN_BUDGET)
+    builder.add('system', system_prompt, 0, required=True)
+    builder.add('book', book_context, 0, required=True)
+    # Retrieved in relevance order, so trimming drops the least relevant passages
+    builder.add_items('passages', [f"[p. {passage['page']}] {passage['text']}" for passage in passages or []], 1,
+                      header="Relevant passages from the book:\n", separator="\n\n")
+    add_history_sections(builder, history, 2)
+    builder.add('question', f"User Question (must be about this book): {question}", 0, required=True)
+
+    prompt, report = builder.build()
+    record_prompt('book_assistant', report)
+    return prompt
+
+def history_cache_scope(history):
+    """Answers to follow-up questions depend on the conversation, so they are cached per conversation state"""
+    if not history:
+        return ''
+    return f"|history:{history['last_message_id']}"
+
+def persist_ai_answer(conversation_id, user_id, answer, reply_to_id=None):
+    """Store a completed AI answer in chat_messages; returns the new message id or None"""
+    if not conversation_id or not user_id or not answer:
+        return None
+
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    try:
+        message_id = insert_chat_message(cursor, conversation_id, user_id, answer, False, reply_to_id)
+        conn.commit()
+        chat_events.publish(conversation_id, message_id)
+        return message_id
+    except Exception as e:
+        print(f"Error saving AI answer to conversation {conversation_id}: {str(e)}")
+        return None
+    finally:
+        conn.close()
+
+@app.route('/api/ai/book-assistant', methods=['POST'])
+@ai_rate_limited
+def ai_book_assistant_v2():
+    try:
+        print("AI Assistant endpoint called")
+        # Check for either GENAI_API_KEY or GEMINI_API_KEY
+        api_key = os.getenv('GENAI_API_KEY') or os.getenv('GEMINI_API_KEY')
+        print(f"API Key found: {'Yes' if api_key else 'No'}")
+        
+        if not api_key:
+            print("Error: No API key found in environment variables")
+            return jsonify({'error': 'AI not configured: Missing API key'}), 500
+            
+        try:
+            # Configure the Google Generative AI client
+            print("Configuring GenAI client...")
             genai.configure(api_key=api_key)
             print("GenAI client configured successfully")
         except Exception as config_error:
@@ -2714,76 +3571,42 @@ def ai_book_assistant_v2():
         
         book = data.get('book')  # expects {title, author, description, category, ...}
         question = data.get('question', '').strip()
+        user_id = data.get('user_id')
         
         if not book or not question:
             print(f"Error: Missing book or question. Book: {bool(book)}, Question: {bool(question)}")
             return jsonify({'error': 'book and question are required'}), 400
 
         try:
-            system_prompt = (
-                "You are a helpful study assistant for library books. "
-                "ONLY answer questions related to the provided book context. "
-                "If the user asks something off-topic, politely redirect them back to the book. "
-                "Provide clear, structured, study-friendly answers: summaries, themes, characters, plot, quotes, and exam-style insights."
-            )
-
-            book_context = (
-                f"Title: {book.get('title','')}\n"
-                f"Author: {book.get('author','')}\n"
-                f"Category: {book.get('category','')}\n"
-                f"Description: {book.get('description','')}\n"
-            )
-
-            user_prompt = (
-                f"Book Context:\n{book_context}\n\n"
-                f"User Question (must be about this book): {question}"
-            )
+            passages, index_version = get_book_passages(book, question)
+            history = get_conversation_history(data, user_id, question)
+            full_prompt = build_book_assistant_prompt(book, question, passages, history)
 
             print("Sending request to Gemini API...")
-            import requests as req
-
-            # Try multiple models in order of preference (updated for available models)
-            models_to_try = [
-                'gemini-2.5-flash',      # Latest stable model
-                'gemini-2.0-flash',      # Previous stable version
-                'gemini-pro-latest',     # Latest pro model
-                'gemini-flash-latest'    # Latest flash model
-            ]
-
-            last_error = None
-            for model in models_to_try:
-                try:
-                    print(f"Trying model: {model}")
-                    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
-
-                    full_prompt = f"{system_prompt}\n\n{user_prompt}"
-                    payload = {
-                        "contents": [{
-                            "parts": [{"text": full_prompt}]
-                        }]
-                    }
-
-                    api_response = req.post(url, json=payload, timeout=30)
-                    api_response.raise_for_status()
-                    result = api_response.json()
-
-                    text = result['candidates'][0]['content']['parts'][0]['text']
-                    print(f"Success with model: {model}")
-                    print(f"Response text length: {len(text) if text else 0} characters")
-
-                    if not text or len(text.strip()) == 0:
-                        print("Error: Empty response from Gemini API")
-                        continue  # Try next model
+            models_to_try = BOOK_ASSISTANT_MODELS
+
+            # Same book (and e-book index) + same (normalized) question + same model chain -> reuse the stored answer
+            cache_scope = ai_cache.book_key(book) + (f'|index:{index_version}' if index_version else '') + history_cache_scope(history)
+            cache_key = ai_cache.make_key(cache_scope, question, models_to_try[0])
+            cached = ai_cache.get(cache_key)
+            if cached:
+                print(f"Cache hit (answered by {cached['model']})")
+                return jsonify({ 'answer': cached['answer'], 'cached': True })
+
+            payload = {
+                "contents": [{
+                    "parts": [{"text": full_prompt}]
+                }]
+            }
 
-                    return jsonify({ 'answer': text })
+            # Skips models with an open circuit and hedges to the next model when one is slow;
+            # raises the last model error if all of them fail
+            text, model = ai_gateway.generate(models_to_try, payload, api_key, timeout=30)
+            print(f"Success with model: {model}")
+            print(f"Response text length: {len(text)} characters")
 
-                except Exception as model_error:
-                    print(f"Model {model} failed: {str(model_error)}")
-                    last_error = model_error
-                    continue  # Try next model
-
-            # If all models failed, raise the last error
-            raise last_error
+            ai_cache.put(cache_key, model, text)
+            return jsonify({ 'answer': text })
             
         except Exception as ai_error:
             print(f"Error in AI processing: {str(ai_error)}")
@@ -2826,6 +3649,86 @@ def ai_book_assistant_v2():
             'type': type(e).__name__
         }), 500
 
+@app.route('/api/ai/book-assistant/stream', methods=['POST'])
+@ai_rate_limited
+def ai_book_assistant_stream():
+    """Streaming variant of /api/ai/book-assistant.
+
+    Sends Server-Sent Events: `chunk` events with {"text"} as Gemini's
+    streamGenerateContent produces them, then one `done` event with the full
+    answer, or an `error` event. When conversation_id and user_id are supplied the
+    final answer is saved to chat_messages, so the client must not save it again.
+    """
+    api_key = os.getenv('GENAI_API_KEY') or os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        return jsonify({'error': 'AI not configured: Missing API key'}), 500
+
+    data = request.json or {}
+    book = data.get('book')
+    question = data.get('question', '').strip()
+    conversation_id = data.get('conversation_id')
+    user_id = data.get('user_id')
+    reply_to_id = data.get('reply_to_id')
+
+    if not book or not question:
+        return jsonify({'error': 'book and question are required'}), 400
+
+    try:
+        passages, index_version = get_book_passages(book, question)
+        history = get_conversation_history(data, user_id, question)
+        cache_scope = ai_cache.book_key(book) + (f'|index:{index_version}' if index_version else '') + history_cache_scope(history)
+        cache_key = ai_cache.make_key(cache_scope, question, BOOK_ASSISTANT_MODELS[0])
+        payload = {
+            "contents": [{
+                "parts": [{"text": build_book_assistant_prompt(book, question, passages, history)}]
+            }]
+        }
+    except Exception as e:
+        print(f"Unexpected error in AI assistant stream: {str(e)}")
+        error = {'error': 'AI request failed', 'details': str(e), 'type': type(e).__name__}
+        return Response(iter([sse_event('error', error)]), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+    def generate():
+        cached = ai_cache.get(cache_key)
+        if cached:
+            answer = cached['answer']
+            yield sse_event('chunk', {'text': answer})
+        else:
+            answer = None
+            last_error = None
+            for model in BOOK_ASSISTANT_MODELS:
+                parts = []
+                try:
+                    print(f"Streaming from model: {model}")
+                    for text in ai_gateway.stream(model, api_key=api_key, payload=payload, timeout=30):
+                        parts.append(text)
+                        yield sse_event('chunk', {'text': text})
+                except Exception as model_error:
+                    print(f"Model {model} failed: {str(model_error)}")
+                    last_error = model_error
+                    if parts:
+                        # The client already has partial text; falling through would garble it
+                        yield sse_event('error', {'error': 'AI response interrupted', 'details': str(model_error)})
+                        return
+                    continue  # Try next model
+
+                if ''.join(parts).strip():
+                    answer = ''.join(parts)
+                    ai_cache.put(cache_key, model, answer)
+                    break
+
+            if answer is None:
+                yield sse_event('error', {
+                    'error': 'AI service temporarily unavailable',
+                    'details': str(last_error) if last_error else 'Empty response from AI'
+                })
+                return
+
+        message_id = persist_ai_answer(conversation_id, user_id, answer, reply_to_id)
+        yield sse_event('done', {'answer': answer, 'cached': bool(cached), 'message_id': message_id})
+
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/api/admin/cleanup-old-notifications', methods=['POST'])
 def cleanup_old_notifications():
     """Delete approved/rejected notifications older than 12 hours to fix UTC duplicates"""
@@ -2907,7 +3810,7 @@ def get_conversations():
     try:
         cursor.execute('''
             SELECT c.*, b.title as book_title, b.author as book_author,
-                   (SELECT COUNT(*) FROM chat_messages WHERE conversation_id = c.id) as message_count
+                   COALESCE(c.message_count, 0) as message_count
             FROM chat_conversations c
             LEFT JOIN books b ON c.book_id = b.id
             WHERE c.user_id = ?
@@ -2973,31 +3876,226 @@ def create_conversation():
         conn.close()
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/chat/messages/<int:conversation_id>', methods=['GET'])
+CHAT_MESSAGES_QUERY = '''
+    SELECT m.*, u.username,
+           reply.message_text as reply_to_text
+    FROM chat_messages m
+    JOIN users u ON m.user_id = u.id
+    LEFT JOIN chat_messages reply ON m.reply_to_id = reply.id
+    WHERE m.conversation_id = ?
+'''
+
+def fill_archived_replies(cursor, conversation_id, messages):
+    """Set reply_to_text for replies whose target has been archived (the JOIN above cannot see it)"""
+    missing = [m['reply_to_id'] for m in messages if m.get('reply_to_id') and m.get('reply_to_text') is None]
+    if missing:
+        texts = chat_archive.get_archived_texts(cursor, conversation_id, missing)
+        for message in messages:
+            if message.get('reply_to_text') is None and message.get('reply_to_id') in texts:
+                message['reply_to_text'] = texts[message['reply_to_id']]
+    return messages
+
+def get_chat_sync_state(cursor, conversation_id):
+    """Return (etag, last_message_id) for a conversation, or (None, None) if it does not exist.
+    The ETag is keyed on last_message_at plus the newest message id so two
+    messages saved within the same second still change it.
+    """
+    cursor.execute('''
+        SELECT last_message_at, last_message_id
+        FROM chat_conversations
+        WHERE id = ?
+    ''', (conversation_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None, None
+    last_message_id = row[1] or 0
+    etag = hashlib.sha1(f'{conversation_id}:{row[0]}:{last_message_id}'.encode()).hexdigest()[:16]
+    return etag, last_message_id
+
+@app.route('/api/chat/messages/<int:conversation_id>', methods=['GET', 'HEAD'])
 def get_messages(conversation_id):
-    """Get all messages in a conversation"""
+    """Get messages in a conversation.
+
+    Optional query params (without them the full conversation is returned, but only the
+    newest CHAT_FULL_ARCHIVE_MAX archived messages; X-Has-More says whether to page back
+    with before_id):
+    - after_id: only messages newer than this id (incremental sync)
+    - before_id: the page of messages older than this id ("load older")
+    - limit: page size, capped at CHAT_PAGE_MAX
+
+    HEAD returns only the ETag / X-Last-Message-Id headers, and a matching
+    If-None-Match returns 304, so idle polls never touch chat_messages rows.
+    """
+    after_id = request.args.get('after_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, CHAT_PAGE_MAX))
+    if before_id is not None and not limit:
+        limit = 50
+
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
-    
+
     try:
-        cursor.execute('''
-            SELECT m.*, u.username,
-                   reply.message_text as reply_to_text
-            FROM chat_messages m
-            JOIN users u ON m.user_id = u.id
-            LEFT JOIN chat_messages reply ON m.reply_to_id = reply.id
-            WHERE m.conversation_id = ?
-            ORDER BY m.created_at ASC
-        ''', (conversation_id,))
-        
+        state_etag, last_message_id = get_chat_sync_state(cursor, conversation_id)
+        if state_etag is None:
+            conn.close()
+            return jsonify({'error': 'Conversation not found'}), 404
+
+        # Older pages never change, so the ETag only applies to the full-history,
+        # latest-page and after_id modes. The same state gives a different body in
+        # each mode, so the mode and its parameters are part of the tag.
+        etag = hashlib.sha1(f'{state_etag}:after={after_id}:limit={limit}'.encode()).hexdigest()[:16]
+        not_modified = request.if_none_match.contains_weak(etag)
+        if before_id is None and (request.method == 'HEAD' or not_modified):
+            conn.close()
+            response = app.response_class(status=304 if not_modified else 200)
+            response.set_etag(etag, weak=True)
+            response.headers['X-Last-Message-Id'] = str(last_message_id)
+            return response
+
+        query = CHAT_MESSAGES_QUERY
+        params = [conversation_id]
+        newest_first = False
+
+        if before_id is not None:
+            query += ' AND m.id < ? ORDER BY m.id DESC LIMIT ?'
+            params.extend([before_id, limit])
+            newest_first = True
+        elif after_id is not None:
+            query += ' AND m.id > ? ORDER BY m.id ASC'
+            params.append(after_id)
+            if limit:
+                query += ' LIMIT ?'
+                params.append(limit)
+        elif limit:
+            # Latest page only, e.g. the initial load of a long conversation
+            query += ' ORDER BY m.id DESC LIMIT ?'
+            params.append(limit)
+            newest_first = True
+        else:
+            query += ' ORDER BY m.id ASC'
+
+        cursor.execute(query, params)
         messages = [dict(row) for row in cursor.fetchall()]
+        archive_truncated = False
+        if newest_first:
+            messages.reverse()
+            # Older history may live in compressed archives; fill the page from there
+            if len(messages) < limit:
+                oldest_id = messages[0]['id'] if messages else before_id
+                messages = chat_archive.get_archived_messages(cursor, conversation_id, oldest_id, limit - len(messages)) + messages
+        elif after_id is None:
+            oldest_id = messages[0]['id'] if messages else None
+            archived = chat_archive.get_archived_messages(cursor, conversation_id, oldest_id, CHAT_FULL_ARCHIVE_MAX + 1)
+            archive_truncated = len(archived) > CHAT_FULL_ARCHIVE_MAX
+            messages = archived[-CHAT_FULL_ARCHIVE_MAX:] + messages
+        fill_archived_replies(cursor, conversation_id, messages)
         conn.close()
-        return jsonify(messages)
+
+        has_more = len(messages) == limit if limit else archive_truncated
+        response = jsonify(messages)
+        response.headers['X-Last-Message-Id'] = str(last_message_id)
+        if limit or after_id is None:
+            response.headers['X-Has-More'] = 'true' if has_more else 'false'
+        # A truncated after_id page is not the latest state, so it gets no ETag
+        if before_id is None and not (after_id is not None and has_more):
+            response.set_etag(etag, weak=True)
+        return response
     except Exception as e:
         conn.close()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/chat/stream/<int:conversation_id>', methods=['GET'])
+def stream_messages(conversation_id):
+    """Server-Sent Events stream of new messages in a conversation.
+
+    Resumes after ?last_id= (or the Last-Event-ID header on reconnect). Messages
+    saved in this process are pushed as soon as save_message commits; messages
+    saved by other workers are picked up within CHAT_STREAM_POLL_SECONDS. The
+    stream closes after CHAT_STREAM_MAX_SECONDS so workers are not held forever,
+    and clients fall back to polling GET /api/chat/messages?after_id= on error,
+    including the 503 returned when CHAT_STREAM_MAX_OPEN streams are already open.
+    """
+    last_id = request.args.get('last_id', type=int)
+    if last_id is None:
+        last_id = request.headers.get('Last-Event-ID', default=0, type=int)
+
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    etag, _ = get_chat_sync_state(cursor, conversation_id)
+    conn.close()
+    if etag is None:
+        return jsonify({'error': 'Conversation not found'}), 404
+
+    if not chat_events.subscribe(conversation_id, CHAT_STREAM_MAX_OPEN):
+        response = jsonify({'error': 'Too many open chat streams', 'details': 'Poll for new messages instead'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(CHAT_STREAM_MAX_SECONDS)
+        return response
+
+    def generate():
+        sent_id = last_id
+        deadline = time.monotonic() + CHAT_STREAM_MAX_SECONDS
+        stream_conn = sqlite3.connect(DATABASE)
+        stream_conn.row_factory = sqlite3.Row
+        stream_cursor = stream_conn.cursor()
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                # Cheap single-row probe before touching chat_messages
+                _, latest_id = get_chat_sync_state(stream_cursor, conversation_id)
+                if latest_id is None:
+                    yield 'event: deleted\ndata: {}\n\n'
+                    return
+                if latest_id > sent_id:
+                    stream_cursor.execute(CHAT_MESSAGES_QUERY + ' AND m.id > ? ORDER BY m.id ASC LIMIT ?',
+                                          (conversation_id, sent_id, CHAT_PAGE_MAX))
+                    rows = [dict(row) for row in stream_cursor.fetchall()]
+                    for message in fill_archived_replies(stream_cursor, conversation_id, rows):
+                        sent_id = message['id']
+                        yield f"id: {sent_id}\nevent: message\ndata: {json.dumps(message)}\n\n"
+                    if not rows:
+                        # The newest ids were archived (old history, paged with before_id); not new messages
+                        sent_id = latest_id
+                if time.monotonic() >= deadline:
+                    return
+                if not chat_events.wait(conversation_id, sent_id, CHAT_STREAM_POLL_SECONDS):
+                    yield ': keepalive\n\n'
+        finally:
+            stream_conn.close()
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Runs even if the client goes away before the generator starts
+    response.call_on_close(lambda: chat_events.unsubscribe(conversation_id))
+    return response
+
+def insert_chat_message(cursor, conversation_id, user_id, message_text, is_user_message, reply_to_id=None):
+    """Insert a message and update the conversation summary; the caller commits and publishes"""
+    cursor.execute('''
+        INSERT INTO chat_messages (conversation_id, user_id, message_text, is_user_message, reply_to_id)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (conversation_id, user_id, message_text, is_user_message, reply_to_id))
+
+    message_id = cursor.lastrowid
+
+    # Update conversation summary in the same transaction as the insert
+    cursor.execute('''
+        UPDATE chat_conversations
+        SET last_message_at = CURRENT_TIMESTAMP,
+            message_count = COALESCE(message_count, 0) + 1,
+            last_message_id = ?,
+            last_message_preview = ?
+        WHERE id = ?
+    ''', (message_id, message_text[:CHAT_PREVIEW_LENGTH], conversation_id))
+
+    return message_id
+
 @app.route('/api/chat/messages', methods=['POST'])
 def save_message():
     """Save a chat message"""
@@ -3016,22 +4114,9 @@ def save_message():
     cursor = conn.cursor()
     
     try:
-        # Insert message
-        cursor.execute('''
-            INSERT INTO chat_messages (conversation_id, user_id, message_text, is_user_message, reply_to_id)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (conversation_id, user_id, message_text, is_user_message, reply_to_id))
-        
-        message_id = cursor.lastrowid
-        
-        # Update conversation last_message_at
-        cursor.execute('''
-            UPDATE chat_conversations 
-            SET last_message_at = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (conversation_id,))
-        
+        message_id = insert_chat_message(cursor, conversation_id, user_id, message_text, is_user_message, reply_to_id)
         conn.commit()
+        chat_events.publish(conversation_id, message_id)
         
         # Get the saved message
         cursor.execute('''
@@ -3056,6 +4141,9 @@ def delete_conversation(conversation_id):
         return jsonify({'error': 'user_id is required'}), 400
     
     conn = sqlite3.connect(DATABASE)
+    # Foreign keys are off by default in SQLite; enable them so the cascade
+    # to chat_messages and chat_message_archives actually fires
+    conn.execute('PRAGMA foreign_keys = ON')
     cursor = conn.cursor()
     
     try:
@@ -3081,7 +4169,345 @@ def delete_conversation(conversation_id):
         conn.close()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/chat/archive', methods=['POST'])
+def archive_chat_messages():
+    """Archive old chat messages into compressed blobs and remove orphaned messages"""
+    data = request.json or {}
+    older_than_days = int(data.get('older_than_days', CHAT_ARCHIVE_AFTER_DAYS))
+
+    try:
+        archived = chat_archive.archive_old_messages(older_than_days)
+        orphans = chat_archive.cleanup_orphans()
+        return jsonify({
+            'success': True,
+            'older_than_days': older_than_days,
+            'archived': archived,
+            'orphans': orphans
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/admin/ebooks/<int:book_id>/index', methods=['POST'])
+def index_ebook(book_id):
+    """Queue an e-book's PDF for passage indexing, optionally setting its pdf_url first"""
+    data = request.get_json(silent=True) or {}
+
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    if data.get('pdf_url'):
+        cursor.execute('UPDATE books SET pdf_url = ?, is_ebook = 1 WHERE id = ?', (data['pdf_url'], book_id))
+        conn.commit()
+    cursor.execute('SELECT pdf_url FROM books WHERE id = ?', (book_id,))
+    book = cursor.fetchone()
+    conn.close()
+
+    if not book:
+        return jsonify({'error': 'Book not found'}), 404
+    if not book[0]:
+        return jsonify({'error': 'Book has no pdf_url'}), 400
+
+    ebook_index.enqueue(book_id)
+    return jsonify({'message': 'Indexing queued', 'status': ebook_index.get_status(book_id)}), 202
+
+@app.route('/api/admin/ebooks/<int:book_id>/index', methods=['GET'])
+def get_ebook_index_status(book_id):
+    """Ingestion status of an e-book's passage index"""
+    status = ebook_index.get_status(book_id)
+    if not status:
+        return jsonify({'error': 'Book has not been indexed'}), 404
+    return jsonify(status)
+
+@app.route('/api/admin/ai-gateway/metrics', methods=['GET'])
+def get_ai_gateway_metrics():
+    """Per-model latency, error rate, hedging and circuit state, plus admission counters and prompt sizes"""
+    metrics = ai_gateway.metrics()
+    metrics['limiter'] = ai_limiter.stats()
+    metrics['prompts'] = prompt_stats.snapshot()
+    return jsonify(metrics)
+
+@app.route('/api/admin/ai-cache/stats', methods=['GET'])
+def get_ai_cache_stats():
+    """Hit rate and size of the AI answer cache"""
+    try:
+        return jsonify(ai_cache.stats())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def build_library_assistant_context(user_id, question, history=None):
+    """Gather reading history, account, catalog, search and conversation context for the library assistant.
+
+    Returns the prompt (kept within AI_PROMPT_TOKEN_BUDGET) plus the structured results
+    that are appended to the answer.
+    """
+    # Account summary, reading history and recommendations come from in-memory snapshots
+    user_context = ""
+    user_account_info = ""
+    ml_recommendations = []
+
+    if user_id:
+        try:
+            summary = library_context.get_user_summary(user_id)
+            user_context = summary['history']
+            user_account_info = summary['account']
+            if summary['has_history']:
+                ml_recommendations = library_context.get_recommendations(user_id, 3)
+        except Exception as e:
+            print(f"Error getting user context: {str(e)}")
+            # Continue without user context
+
+    library_stats = library_context.get_library_stats()
+    book_search_results = []
+
+    try:
+        conn = sqlite3.connect(DATABASE)
+        cursor = conn.cursor()
+
+        # Check if the question is about book search
+        question_lower = question.lower()
+        if any(keyword in question_lower for keyword in ['find', 'search', 'looking for', 'have', 'available', 'books about', 'books by']):
+            # Extract potential search terms
+            search_terms = []
+            
+            # Look for book titles in quotes
+            import re
+            title_matches = re.findall(r'"([^"]*)"', question)
+            if title_matches:
+                search_terms.extend(title_matches)
+            
+            # Look for author names (common patterns)
+            author_patterns = [
+                r'by\s+([A-Z][a-z]+\s+[A-Z][a-z]+)',  # "by First Last"
+                r'([A-Z][a-z]+\s+[A-Z][a-z]+)',       # Any "First Last" pattern
+            ]
+            
+            for pattern in author_patterns:
+                matches = re.findall(pattern, question)
+                search_terms.extend(matches)
+            
+            # If no specific terms found, use the whole question for fuzzy search
+            if not search_terms:
+                search_terms = [question.replace('find', '').replace('search', '').replace('looking for', '').strip()]
+            
+            # Perform book search
+            for term in search_terms[:3]:  # Limit to 3 search terms
+                term = term.strip()
+                if len(term) < 3:  # Skip very short terms
+                    continue
+                    
+                cursor.execute("""
+                    SELECT id, title, author, category, description, available_copies, total_copies
+                    FROM books 
+                    WHERE (title LIKE ? OR author LIKE ? OR category LIKE ? OR description LIKE ?)
+                    AND available_copies > 0
+                    ORDER BY 
+                        CASE 
+                            WHEN title LIKE ? THEN 1
+                            WHEN author LIKE ? THEN 2
+                            ELSE 3
+                        END,
+                        title
+                    LIMIT 5
+                """, (f'%{term}%', f'%{term}%', f'%{term}%', f'%{term}%', f'%{term}%', f'%{term}%'))
+                
+                results = cursor.fetchall()
+                for result in results:
+                    book_search_results.append({
+                        'id': result[0],
+                        'title': result[1],
+                        'author': result[2],
+                        'category': result[3],
+                        'description': result[4] or 'No description available',
+                        'available_copies': result[5],
+                        'total_copies': result[6]
+                    })
+                
+                # If we found results, break
+                if book_search_results:
+                    break
+            
+            # Remove duplicates
+            seen = set()
+            unique_results = []
+            for book in book_search_results:
+                book_key = (book['title'], book['author'])
+                if book_key not in seen:
+                    seen.add(book_key)
+                    unique_results.append(book)
+            
+            book_search_results = unique_results[:5]  # Limit to 5 results
+
+        # Check if user is asking to compare books
+        comparison_results = []
+        question_lower = question.lower()
+        if any(keyword in question_lower for keyword in ['compare', 'vs', 'versus', 'difference between', 'similar to', 'like']):
+            # Extract book titles to compare
+            compare_titles = []
+            
+            # Look for quoted titles
+            import re
+            title_matches = re.findall(r'"([^"]*)"', question)
+            compare_titles.extend(title_matches)
+            
+            # Look for common comparison patterns
+            if ' vs ' in question_lower:
+                parts = question_lower.split(' vs ')
+                compare_titles.extend([part.strip() for part in parts])
+            elif ' versus ' in question_lower:
+                parts = question_lower.split(' versus ')
+                compare_titles.extend([part.strip() for part in parts])
+            elif ' compared to ' in question_lower:
+                parts = question_lower.split(' compared to ')
+                compare_titles.extend([part.strip() for part in parts])
+            
+            # Find books in database for comparison
+            if len(compare_titles) >= 2:
+                try:
+                    for title in compare_titles[:3]:  # Compare up to 3 books
+                        title = title.strip()
+                        if len(title) < 3:
+                            continue
+                            
+                        cursor.execute("""
+                            SELECT id, title, author, category, description, publish_date,
+                                   available_copies, total_copies
+                            FROM books 
+                            WHERE title LIKE ? OR author LIKE ?
+                            LIMIT 1
+                        """, (f'%{title}%', f'%{title}%'))
+                        
+                        book_result = cursor.fetchone()
+                        if book_result:
+                            comparison_results.append({
+                                'id': book_result[0],
+                                'title': book_result[1],
+                                'author': book_result[2],
+                                'category': book_result[3],
+                                'description': book_result[4] or 'No description available',
+                                'publish_date': book_result[5],
+                                'available_copies': book_result[6],
+                                'total_copies': book_result[7]
+                            })
+                    
+                except Exception as e:
+                    print(f"Error getting comparison books: {str(e)}")
+
+        conn.close()
+
+    except Exception as e:
+        print(f"Error getting library stats or search results: {str(e)}")
+
+    # Create comprehensive system prompt
+    system_prompt = """You are an intelligent Library Assistant AI with access to real library data and machine learning recommendations.
+
+Your capabilities include:
+1. **Book Search & Discovery**: Help users find books by title, author, genre, or keywords
+2. **Personalized Recommendations**: Suggest books based on reading history and preferences
+3. **Library Services**: Explain policies, hours, fines, reservations, and procedures
+4. **Reading Guidance**: Provide insights, summaries, and discussion points
+5. **Account Assistance**: Help with borrowing history, due dates, and account management
+
+Always provide helpful, accurate information. If you don't have specific data, acknowledge limitations but still assist where possible.
+Be conversational and engaging while being informative.
+For recommendations, consider the user's reading history when available."""
+
+    # Sections appear in this order; when over budget the highest priority numbers go first
+    builder = PromptBuilder(AI_PROMPT_TOKEN_BUDGET)
+    builder.add('system', system_prompt, 0, required=True)
+    builder.add('library_stats', library_stats.strip(), 3)
+    builder.add('reading_history', user_context.strip(), 4)
+    builder.add('account', user_account_info.strip(), 1)
+    builder.add_items('recommendations', [
+        f"- {rec['title']} by {rec['author']} ({rec['category']})" for rec in ml_recommendations[:3]
+    ], 5, header="Personalized Recommendations Available:\n")
+    add_history_sections(builder, history, 2)
+    builder.add('question', f"User Question: {question}", 0, required=True)
+
+    prompt, report = builder.build()
+    record_prompt('library_assistant', report)
+
+    return {
+        'prompt': prompt,
+        'ml_recommendations': ml_recommendations,
+        'search_results': book_search_results,
+        'comparison_results': comparison_results
+    }
+
+def decorate_library_answer(ai_response, question, context):
+    """Append catalog search and comparison results to the assistant's answer"""
+    enhanced_response = ai_response
+    book_search_results = context['search_results']
+    comparison_results = context['comparison_results']
+
+    # Add book search results if available
+    if book_search_results:
+        enhanced_response += f"\n\n📚 I found these books that match your search:\n"
+        for i, book in enumerate(book_search_results[:3], 1):
+            enhanced_response += f"\n{i}. **{book['title']}** by {book['author']}\n"
+            enhanced_response += f"   Category: {book['category']}\n"
+            enhanced_response += f"   Available: {book['available_copies']} of {book['total_copies']} copies\n"
+        
+        if len(book_search_results) > 3:
+            enhanced_response += f"\n   ... and {len(book_search_results) - 3} more results"
+        
+        enhanced_response += "\n\n💡 You can ask me to reserve any of these books!"
+
+    # Add book comparison results if available
+    if comparison_results and len(comparison_results) >= 2:
+        enhanced_response += f"\n\n⚖️ Book Comparison ({len(comparison_results)} books):\n"
+        for i, book in enumerate(comparison_results, 1):
+            enhanced_response += f"\n{i}. **{book['title']}** by {book['author']}\n"
+            enhanced_response += f"   Category: {book['category']}\n"
+            enhanced_response += f"   Published: {book['publish_date'] or 'Unknown'}\n"
+            enhanced_response += f"   Available: {book['available_copies']} of {book['total_copies']} copies\n"
+        
+        enhanced_response += "\n💡 I can help you compare these books in terms of themes, writing style, or popularity!"
+
+    # Add book search suggestions if relevant
+    elif any(keyword in question.lower() for keyword in ['find', 'search', 'looking for', 'recommend']):
+        enhanced_response += "\n\n💡 Tip: You can also use the Book Search feature in the app to browse available books!"
+
+    return enhanced_response
+
+def library_answer_payload(answer, context):
+    """Response body shared by the blocking and streaming library assistant routes"""
+    ml_recommendations = context['ml_recommendations']
+    book_search_results = context['search_results']
+    comparison_results = context['comparison_results']
+    return {
+        'answer': answer,
+        'has_recommendations': len(ml_recommendations) > 0,
+        'recommendations': ml_recommendations[:3] if ml_recommendations else [],
+        'search_results': book_search_results[:5] if book_search_results else [],
+        'comparison_results': comparison_results[:3] if comparison_results else []
+    }
+
+def library_assistant_fallback(question):
+    """Canned answer used when the AI service is unreachable"""
+    question_lower = question.lower()
+
+    if 'recommend' in question_lower or 'suggest' in question_lower:
+        return {
+            'answer': "I'd love to recommend some great books! While I'm currently experiencing technical difficulties, here are some popular choices:\n\n📚 **Fiction**: 'The Seven Husbands of Evelyn Hugo' by Taylor Jenkins Reid\n📖 **Mystery**: 'The Thursday Murder Club' by Richard Osman\n🚀 **Sci-Fi**: 'Project Hail Mary' by Andy Weir\n\nPlease try again in a moment for personalized recommendations based on your reading history!",
+            'has_recommendations': False,
+            'recommendations': []
+        }
+
+    elif 'hour' in question_lower or 'open' in question_lower:
+        return {
+            'answer': "📅 **Library Hours**:\n\n• Monday - Friday: 8:00 AM - 8:00 PM\n• Saturday: 9:00 AM - 6:00 PM\n• Sunday: 12:00 PM - 5:00 PM\n\nWe're closed on public holidays. Please try your question again for more detailed information!",
+            'has_recommendations': False,
+            'recommendations': []
+        }
+
+    else:
+        return {
+            'answer': "I'm sorry, but I'm currently experiencing connectivity issues. Please try your question again in a moment. I'm here to help with book recommendations, library information, and reading guidance!",
+            'has_recommendations': False,
+            'recommendations': []
+        }
+
 @app.route('/api/ai/library-assistant', methods=['POST'])
+@ai_rate_limited
 def ai_library_assistant():
     """
     AI-powered library assistant that can answer questions about:
@@ -3114,443 +4540,132 @@ def ai_library_assistant():
         if not question:
             return jsonify({'error': 'question is required'}), 400
 
-        # Get user context if available
-        user_context = ""
-        ml_recommendations = []
-
-        if user_id:
-            try:
-                # Get user borrowing history for personalized recommendations
-                ml_service = MLRecommendationService('library.db')
-                user_history = ml_service.get_user_history(user_id)
-
-                if user_history:
-                    # Get user's borrowed books for context
-                    conn = sqlite3.connect('library.db')
-                    cursor = conn.cursor()
-
-                    placeholders = ','.join('?' * len(user_history))
-                    cursor.execute(f"""
-                        SELECT title, author, category
-                        FROM books
-                        WHERE id IN ({placeholders})
-                        ORDER BY title
-                    """, user_history)
-
-                    borrowed_books = cursor.fetchall()
-                    conn.close()
-
-                    if borrowed_books:
-                        user_context = "\n\nUser's Reading History:\n" + "\n".join([
-                            f"- {title} by {author} ({category})"
-                            for title, author, category in borrowed_books[:10]  # Limit to 10 most recent
-                        ])
-
-                        # Get personalized recommendations
-                        recommendations = ml_service.content_based_recommendations(user_id, 5)
-                        if recommendations:
-                            ml_recommendations = recommendations
-
-            except Exception as e:
-                print(f"Error getting user context: {str(e)}")
-                # Continue without user context
-
-        # Get user account information if user_id is provided
-        user_account_info = ""
-        if user_id:
-            try:
-                conn = sqlite3.connect('library.db')
-                cursor = conn.cursor()
-
-                # Get user's current borrowed books
-                cursor.execute("""
-                    SELECT b.title, b.author, bi.due_date, bi.issue_date,
-                           CASE WHEN bi.due_date < date('now') THEN 1 ELSE 0 END as is_overdue
-                    FROM book_issues bi
-                    JOIN books b ON bi.book_id = b.id
-                    WHERE bi.user_id = ? AND bi.return_date IS NULL
-                    ORDER BY bi.due_date
-                """, (user_id,))
-
-                borrowed_books = cursor.fetchall()
-
-                if borrowed_books:
-                    user_account_info += f"\n\nYour Current Loans ({len(borrowed_books)} books):\n"
-                    overdue_count = 0
-                    for title, author, due_date, issue_date, is_overdue in borrowed_books:
-                        status = "⚠️ OVERDUE" if is_overdue else "✅ On time"
-                        if is_overdue:
-                            overdue_count += 1
-                        user_account_info += f"• {title} by {author} (Due: {due_date}) - {status}\n"
-
-                    if overdue_count > 0:
-                        user_account_info += f"\n⚠️ You have {overdue_count} overdue book(s). Please return them to avoid fines."
-
-                # Get user's fines
-                cursor.execute("""
-                    SELECT SUM(amount) as total_fines, COUNT(*) as fine_count
-                    FROM fines
-                    WHERE user_id = ? AND paid = 0
-                """, (user_id,))
-
-                fine_info = cursor.fetchone()
-                if fine_info and fine_info[0]:
-                    user_account_info += f"\n\n💰 Outstanding Fines: R{fine_info[0]:.2f} ({fine_info[1]} items)"
-                    user_account_info += "\n   Fines accrue at R5 per day for overdue books."
-
-                # Get user's reservation count
-                cursor.execute("""
-                    SELECT COUNT(*) as reservation_count
-                    FROM reservations
-                    WHERE user_id = ? AND status = 'pending'
-                """, (user_id,))
-
-                reservation_info = cursor.fetchone()
-                if reservation_info and reservation_info[0] > 0:
-                    user_account_info += f"\n\n📋 Active Reservations: {reservation_info[0]}"
-                    user_account_info += "\n   You can have up to 5 active reservations."
-
-                # Get user's total borrowing history
-                cursor.execute("""
-                    SELECT COUNT(*) as total_borrowed
-                    FROM book_issues
-                    WHERE user_id = ?
-                """, (user_id,))
-
-                history_info = cursor.fetchone()
-                if history_info and history_info[0] > 0:
-                    user_account_info += f"\n\n📚 Total Books Borrowed: {history_info[0]}"
-
-                conn.close()
-
-            except Exception as e:
-                print(f"Error getting user account info: {str(e)}")
-
-        # Get current library stats for context
-        library_stats = ""
-        book_search_results = []
-        
-        try:
-            conn = sqlite3.connect('library.db')
-            cursor = conn.cursor()
-
-            # Get total books, available books, etc.
-            cursor.execute("""
-                SELECT
-                    COUNT(*) as total_books,
-                    SUM(available_copies) as available_copies,
-                    COUNT(CASE WHEN available_copies > 0 THEN 1 END) as available_titles
-                FROM books
-            """)
-            stats = cursor.fetchone()
-
-            if stats:
-                library_stats = f"""
-Library Statistics:
-- Total book titles: {stats[2] or 0}
-- Total book copies: {stats[0] or 0}
-- Currently available copies: {stats[1] or 0}
-"""
-
-            # Get popular categories
-            cursor.execute("""
-                SELECT category, COUNT(*) as count
-                FROM books
-                GROUP BY category
-                ORDER BY count DESC
-                LIMIT 5
-            """)
-            categories = cursor.fetchall()
-
-            if categories:
-                library_stats += "\nPopular Categories:\n" + "\n".join([
-                    f"- {cat}: {count} books" for cat, count in categories
-                ])
-
-            # Check if the question is about book search
-            question_lower = question.lower()
-            if any(keyword in question_lower for keyword in ['find', 'search', 'looking for', 'have', 'available', 'books about', 'books by']):
-                # Extract potential search terms
-                search_terms = []
-                
-                # Look for book titles in quotes
-                import re
-                title_matches = re.findall(r'"([^"]*)"', question)
-                if title_matches:
-                    search_terms.extend(title_matches)
-                
-                # Look for author names (common patterns)
-                author_patterns = [
-                    r'by\s+([A-Z][a-z]+\s+[A-Z][a-z]+)',  # "by First Last"
-                    r'([A-Z][a-z]+\s+[A-Z][a-z]+)',       # Any "First Last" pattern
-                ]
-                
-                for pattern in author_patterns:
-                    matches = re.findall(pattern, question)
-                    search_terms.extend(matches)
-                
-                # If no specific terms found, use the whole question for fuzzy search
-                if not search_terms:
-                    search_terms = [question.replace('find', '').replace('search', '').replace('looking for', '').strip()]
-                
-                # Perform book search
-                for term in search_terms[:3]:  # Limit to 3 search terms
-                    term = term.strip()
-                    if len(term) < 3:  # Skip very short terms
-                        continue
-                        
-                    cursor.execute("""
-                        SELECT id, title, author, category, description, available_copies, total_copies
-                        FROM books 
-                        WHERE (title LIKE ? OR author LIKE ? OR category LIKE ? OR description LIKE ?)
-                        AND available_copies > 0
-                        ORDER BY 
-                            CASE 
-                                WHEN title LIKE ? THEN 1
-                                WHEN author LIKE ? THEN 2
-                                ELSE 3
-                            END,
-                            title
-                        LIMIT 5
-                    """, (f'%{term}%', f'%{term}%', f'%{term}%', f'%{term}%', f'%{term}%', f'%{term}%'))
-                    
-                    results = cursor.fetchall()
-                    for result in results:
-                        book_search_results.append({
-                            'id': result[0],
-                            'title': result[1],
-                            'author': result[2],
-                            'category': result[3],
-                            'description': result[4] or 'No description available',
-                            'available_copies': result[5],
-                            'total_copies': result[6]
-                        })
-                    
-                    # If we found results, break
-                    if book_search_results:
-                        break
-                
-                # Remove duplicates
-                seen = set()
-                unique_results = []
-                for book in book_search_results:
-                    book_key = (book['title'], book['author'])
-                    if book_key not in seen:
-                        seen.add(book_key)
-                        unique_results.append(book)
-                
-                book_search_results = unique_results[:5]  # Limit to 5 results
-
-            # Check if user is asking to compare books
-            comparison_results = []
-            question_lower = question.lower()
-            if any(keyword in question_lower for keyword in ['compare', 'vs', 'versus', 'difference between', 'similar to', 'like']):
-                # Extract book titles to compare
-                compare_titles = []
-                
-                # Look for quoted titles
-                import re
-                title_matches = re.findall(r'"([^"]*)"', question)
-                compare_titles.extend(title_matches)
-                
-                # Look for common comparison patterns
-                if ' vs ' in question_lower:
-                    parts = question_lower.split(' vs ')
-                    compare_titles.extend([part.strip() for part in parts])
-                elif ' versus ' in question_lower:
-                    parts = question_lower.split(' versus ')
-                    compare_titles.extend([part.strip() for part in parts])
-                elif ' compared to ' in question_lower:
-                    parts = question_lower.split(' compared to ')
-                    compare_titles.extend([part.strip() for part in parts])
-                
-                # Find books in database for comparison
-                if len(compare_titles) >= 2:
-                    try:
-                        conn = sqlite3.connect('library.db')
-                        cursor = conn.cursor()
-                        
-                        for title in compare_titles[:3]:  # Compare up to 3 books
-                            title = title.strip()
-                            if len(title) < 3:
-                                continue
-                                
-                            cursor.execute("""
-                                SELECT id, title, author, category, description, publish_date,
-                                       available_copies, total_copies
-                                FROM books 
-                                WHERE title LIKE ? OR author LIKE ?
-                                LIMIT 1
-                            """, (f'%{title}%', f'%{title}%'))
-                            
-                            book_result = cursor.fetchone()
-                            if book_result:
-                                comparison_results.append({
-                                    'id': book_result[0],
-                                    'title': book_result[1],
-                                    'author': book_result[2],
-                                    'category': book_result[3],
-                                    'description': book_result[4] or 'No description available',
-                                    'publish_date': book_result[5],
-                                    'available_copies': book_result[6],
-                                    'total_copies': book_result[7]
-                                })
-                        
-                        conn.close()
-                        
-                    except Exception as e:
-                        print(f"Error getting comparison books: {str(e)}")
-
-            conn.close()
-
-        except Exception as e:
-            print(f"Error getting library stats or search results: {str(e)}")
-
-        # Create comprehensive system prompt
-        system_prompt = f"""You are an intelligent Library Assistant AI with access to real library data and machine learning recommendations.
-
-Your capabilities include:
-1. **Book Search & Discovery**: Help users find books by title, author, genre, or keywords
-2. **Personalized Recommendations**: Suggest books based on reading history and preferences
-3. **Library Services**: Explain policies, hours, fines, reservations, and procedures
-4. **Reading Guidance**: Provide insights, summaries, and discussion points
-5. **Account Assistance**: Help with borrowing history, due dates, and account management
-
-{library_stats}
-
-Always provide helpful, accurate information. If you don't have specific data, acknowledge limitations but still assist where possible.
-Be conversational and engaging while being informative.
-For recommendations, consider the user's reading history when available.
-"""
-
-        # Add user context and ML recommendations to the prompt
-        enhanced_context = f"{system_prompt}{user_context}{user_account_info}"
-
-        if ml_recommendations:
-            enhanced_context += f"\n\nPersonalized Recommendations Available:\n"
-            for rec in ml_recommendations[:3]:
-                enhanced_context += f"- {rec['title']} by {rec['author']} ({rec['category']})\n"
-
-        # Create the user prompt
-        user_prompt = f"User Question: {question}"
+        history = get_conversation_history(data, user_id, question)
+        context = build_library_assistant_context(user_id, question, history)
 
         print("Sending request to Gemini API for library assistant...")
 
-        # Use Gemini API
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={api_key}"
-
-        full_prompt = f"{enhanced_context}\n\n{user_prompt}"
+        full_prompt = context['prompt']
 
         payload = {
             "contents": [{
                 "parts": [{"text": full_prompt}]
             }],
-            "generationConfig": {
-                "temperature": 0.7,
-                "maxOutputTokens": 1000,
-                "topP": 0.8,
-                "topK": 40
-            }
+            "generationConfig": LIBRARY_ASSISTANT_GENERATION_CONFIG
         }
 
-        response = requests.post(url, json=payload, timeout=15)
-        response.raise_for_status()
-
-        result = response.json()
-        if 'candidates' in result and result['candidates']:
-            ai_response = result['candidates'][0]['content']['parts'][0]['text'].strip()
-
-            # Post-process response to add interactive elements
-            enhanced_response = ai_response
-
-            # Add book search results if available
-            if book_search_results:
-                enhanced_response += f"\n\n📚 I found these books that match your search:\n"
-                for i, book in enumerate(book_search_results[:3], 1):
-                    enhanced_response += f"\n{i}. **{book['title']}** by {book['author']}\n"
-                    enhanced_response += f"   Category: {book['category']}\n"
-                    enhanced_response += f"   Available: {book['available_copies']} of {book['total_copies']} copies\n"
-                
-                if len(book_search_results) > 3:
-                    enhanced_response += f"\n   ... and {len(book_search_results) - 3} more results"
-                
-                enhanced_response += "\n\n💡 You can ask me to reserve any of these books!"
-
-            # Add book comparison results if available
-            if comparison_results and len(comparison_results) >= 2:
-                enhanced_response += f"\n\n⚖️ Book Comparison ({len(comparison_results)} books):\n"
-                for i, book in enumerate(comparison_results, 1):
-                    enhanced_response += f"\n{i}. **{book['title']}** by {book['author']}\n"
-                    enhanced_response += f"   Category: {book['category']}\n"
-                    enhanced_response += f"   Published: {book['publish_date'] or 'Unknown'}\n"
-                    enhanced_response += f"   Available: {book['available_copies']} of {book['total_copies']} copies\n"
-                
-                enhanced_response += "\n💡 I can help you compare these books in terms of themes, writing style, or popularity!"
-
-            # Add book search suggestions if relevant
-            elif any(keyword in question.lower() for keyword in ['find', 'search', 'looking for', 'recommend']):
-                enhanced_response += "\n\n💡 Tip: You can also use the Book Search feature in the app to browse available books!"
+        text, _ = ai_gateway.generate(LIBRARY_ASSISTANT_MODELS, payload, api_key, timeout=15)
+        ai_response = text.strip()
 
-            return jsonify({
-                'answer': enhanced_response,
-                'has_recommendations': len(ml_recommendations) > 0,
-                'recommendations': ml_recommendations[:3] if ml_recommendations else [],
-                'search_results': book_search_results[:5] if book_search_results else [],
-                'comparison_results': comparison_results[:3] if comparison_results else []
-            })
+        enhanced_response = decorate_library_answer(ai_response, question, context)
 
-        else:
-            return jsonify({'error': 'No response generated from AI'}), 500
+        return jsonify(library_answer_payload(enhanced_response, context))
 
     except Exception as e:
         print(f"Error in library assistant AI: {str(e)}")
         import traceback
         traceback.print_exc()
 
-        # Provide helpful fallback responses
-        question_lower = question.lower()
+        return jsonify(library_assistant_fallback(question))
 
-        if 'recommend' in question_lower or 'suggest' in question_lower:
-            return jsonify({
-                'answer': "I'd love to recommend some great books! While I'm currently experiencing technical difficulties, here are some popular choices:\n\n📚 **Fiction**: 'The Seven Husbands of Evelyn Hugo' by Taylor Jenkins Reid\n📖 **Mystery**: 'The Thursday Murder Club' by Richard Osman\n🚀 **Sci-Fi**: 'Project Hail Mary' by Andy Weir\n\nPlease try again in a moment for personalized recommendations based on your reading history!",
-                'has_recommendations': False,
-                'recommendations': []
-            })
+@app.route('/api/ai/library-assistant/stream', methods=['POST'])
+@ai_rate_limited
+def ai_library_assistant_stream():
+    """Streaming variant of /api/ai/library-assistant.
 
-        elif 'hour' in question_lower or 'open' in question_lower:
-            return jsonify({
-                'answer': "📅 **Library Hours**:\n\n• Monday - Friday: 8:00 AM - 8:00 PM\n• Saturday: 9:00 AM - 6:00 PM\n• Sunday: 12:00 PM - 5:00 PM\n\nWe're closed on public holidays. Please try your question again for more detailed information!",
-                'has_recommendations': False,
-                'recommendations': []
-            })
+    Emits `chunk` events while Gemini streams, followed by the catalog search and
+    comparison text, then a `done` event carrying the same body as the blocking
+    route (plus message_id). If Gemini fails before producing any text the
+    canned fallback answer is streamed instead, matching the blocking route.
+    """
+    api_key = os.getenv('GENAI_API_KEY') or os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        return jsonify({'error': 'AI not configured: Missing API key'}), 500
 
+    data = request.json or {}
+    user_id = data.get('user_id')
+    question = data.get('question', '').strip()
+    conversation_id = data.get('conversation_id')
+    reply_to_id = data.get('reply_to_id')
+
+    if not question:
+        return jsonify({'error': 'question is required'}), 400
+
+    def generate():
+        # Send something immediately so the client sees the stream open while context loads
+        yield ': context\n\n'
+        history = get_conversation_history(data, user_id, question)
+        context = build_library_assistant_context(user_id, question, history)
+        payload = {
+            "contents": [{
+                "parts": [{"text": context['prompt']}]
+            }],
+            "generationConfig": LIBRARY_ASSISTANT_GENERATION_CONFIG
+        }
+
+        parts = []
+        for model in LIBRARY_ASSISTANT_MODELS:
+            try:
+                for text in ai_gateway.stream(model, api_key=api_key, payload=payload, timeout=15):
+                    parts.append(text)
+                    yield sse_event('chunk', {'text': text})
+                break
+            except Exception as e:
+                print(f"Error in library assistant stream ({model}): {str(e)}")
+                if parts:
+                    yield sse_event('error', {'error': 'AI response interrupted', 'details': str(e)})
+                    return
+
+        ai_response = ''.join(parts).strip()
+        if ai_response:
+            answer = decorate_library_answer(ai_response, question, context)
+            extra = answer[len(ai_response):]
+            if extra:
+                yield sse_event('chunk', {'text': extra})
+            body = library_answer_payload(answer, context)
         else:
-            return jsonify({
-                'answer': "I'm sorry, but I'm currently experiencing connectivity issues. Please try your question again in a moment. I'm here to help with book recommendations, library information, and reading guidance!",
-                'has_recommendations': False,
-                'recommendations': []
-            })
+            body = library_assistant_fallback(question)
+            yield sse_event('chunk', {'text': body['answer']})
+
+        body['message_id'] = persist_ai_answer(conversation_id, user_id, body['answer'], reply_to_id)
+        yield sse_event('done', body)
+
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
 
-def process_expired_checkouts():
-    """Process checkouts that have expired (2 days old) and return books to available"""
+def process_expired_checkouts(checkout_ids=None):
+    """Process checkouts that have expired (2 days old) and return books to available
+    (or hand them to the next user on the book's waitlist).
+
+    Called by the deadline scheduler with the checkouts that just reached their deadline,
+    and hourly without ids as a safety net for anything it missed. Checkouts that were
+    collected, cancelled or already expired in the meantime are left alone."""
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = inventory.connect(DATABASE)
         cursor = conn.cursor()
+        promotions = []
+
+        # Expiry, copy release and waitlist promotion commit together
+        inventory.begin_immediate(conn)
 
         # Find expired checkouts
         current_time = datetime.now().isoformat()
-        cursor.execute('''
-            SELECT bc.id, bc.reservation_id, bc.book_id, bc.user_id, b.title
+        query = '''
+            SELECT bc.id, bc.reservation_id, bc.book_id, bc.user_id, b.title, bc.copy_id
             FROM book_checkouts bc
             JOIN books b ON bc.book_id = b.id
             WHERE bc.status = 'pending_checkout'
-            AND bc.checkout_deadline < ?
-        ''', (current_time,))
+            AND bc.checkout_deadline <= ?
+        '''
+        params = [current_time]
+        if checkout_ids:
+            query += f' AND bc.id IN ({",".join("?" * len(checkout_ids))})'
+            params.extend(checkout_ids)
+        cursor.execute(query, params)
 
         expired_checkouts = cursor.fetchall()
 
         for checkout in expired_checkouts:
-            checkout_id, reservation_id, book_id, user_id, book_title = checkout
+            checkout_id, reservation_id, book_id, user_id, book_title, copy_id = checkout
 
             # Update checkout status to expired
             cursor.execute('''
@@ -3566,6 +4681,9 @@ def process_expired_checkouts():
                 WHERE id = ?
             ''', (reservation_id,))
 
+            inventory.release_copy(cursor, book_id, copy_id)
+            promotions.append(waitlist.promote_next(cursor, book_id))
+
             # Create notification for user
             local_timestamp = (datetime.now(TZ_JHB).isoformat() if TZ_JHB else datetime.now().isoformat())
             cursor.execute('''
@@ -3585,34 +4703,91 @@ def process_expired_checkouts():
 
         conn.commit()
         conn.close()
+        notify_waitlist_promotions(promotions)
+        for checkout in expired_checkouts:
+            library_context.invalidate_user(checkout[3])
 
     except Exception as e:
         print(f'Error processing expired checkouts: {e}')
 
+def archive_chat_history():
+    """Move old chat messages to compressed archives and drop messages of deleted conversations"""
+    try:
+        archived = chat_archive.archive_old_messages(CHAT_ARCHIVE_AFTER_DAYS)
+        orphans = chat_archive.cleanup_orphans()
+        if archived['messages'] or orphans['orphan_messages']:
+            print(f"Archived {archived['messages']} chat messages "
+                  f"({archived['bytes_before']} -> {archived['bytes_after']} bytes), "
+                  f"removed {orphans['orphan_messages']} orphaned messages")
+    except Exception as e:
+        print(f'Error archiving chat history: {e}')
+
+def refresh_library_context():
+    """Rebuild the library assistant's catalog statistics snapshot"""
+    try:
+        library_context.refresh_library_stats()
+    except Exception as e:
+        print(f'Error refreshing library context: {e}')
+
 # Initialize background scheduler for automated tasks (if available)
 if APSCHEDULER_AVAILABLE:
     scheduler = BackgroundScheduler()
     scheduler.start()
 
-    # Schedule expired checkout processing every hour
+    # Safety-net sweep for expired checkouts (checkout_deadlines normally expires them on time)
     scheduler.add_job(
         func=process_expired_checkouts,
         trigger=IntervalTrigger(hours=1),
         id='process_expired_checkouts',
-        name='Process expired checkouts every hour',
+        name='Sweep expired checkouts every hour',
+        replace_existing=True
+    )
+
+    # Archive old chat history once a day
+    scheduler.add_job(
+        func=archive_chat_history,
+        trigger=IntervalTrigger(days=1),
+        id='archive_chat_history',
+        name='Archive old chat messages daily',
         replace_existing=True
     )
 
-    print("[Startup] Background scheduler initialized with expired checkout processing")
+    # Keep the library assistant's catalog statistics fresh off the request path
+    scheduler.add_job(
+        func=refresh_library_context,
+        trigger=IntervalTrigger(seconds=LIBRARY_CONTEXT_REFRESH_SECONDS),
+        id='refresh_library_context',
+        name='Refresh library assistant statistics',
+        replace_existing=True
+    )
+
+    print("[Startup] Background scheduler initialized with expired checkout processing, chat archival and library context refresh")
 else:
     scheduler = None
     print("[Startup] Background scheduler not available - manual processing only")
 
+def load_checkout_deadlines():
+    """Register every outstanding checkout deadline (the schedule is rebuilt from the table on each start)"""
+    try:
+        conn = sqlite3.connect(DATABASE)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, checkout_deadline FROM book_checkouts WHERE status = 'pending_checkout'")
+        count = checkout_deadlines.load(cursor.fetchall())
+        conn.close()
+        print(f"[Startup] Scheduled {count} checkout deadlines")
+    except Exception as e:
+        print(f'[Startup] Could not load checkout deadlines: {e}')
+
+load_checkout_deadlines()
+checkout_deadlines.start()
+typeahead.warm()
+
 import atexit
 
 # Ensure scheduler shuts down properly on app exit (if available)
 if APSCHEDULER_AVAILABLE and scheduler:
     atexit.register(lambda: scheduler.shutdown())
+atexit.register(checkout_deadlines.stop)
 
 if __name__ == '__main__':
     # Bind to Render's provided PORT when deployed; fall back to local dev defaults
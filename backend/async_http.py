@@ -0,0 +1,133 @@
+"""
+Async HTTP Client for Library App
+A single asyncio event loop running in a background thread that performs outbound
+HTTP calls for the AI routes over one keep-alive connection pool. Flask handlers keep
+their synchronous structure and block on a concurrent.futures.Future for the whole
+upstream call, so every AI request still holds its own worker thread (AIRequestLimiter
+bounds how many). What runs on the loop without a thread of its own is the extra
+work inside a request: hedged duplicates and the race between them.
+
+Uses aiohttp when installed; otherwise requests calls run in the loop's default
+executor so behaviour is unchanged, except that hedges then take executor threads.
+"""
+import asyncio
+import queue
+import threading
+from typing import Dict, Any, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Optional async transport
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    aiohttp = None
+    AIOHTTP_AVAILABLE = False
+    print("[Startup] aiohttp not available - AI calls will use threaded requests")
+
+_END = object()
+
+
+class AsyncHTTPError(Exception):
+    """Non-2xx upstream response (message mirrors requests.HTTPError's)"""
+
+    def __init__(self, status: int, reason: str, url: str):
+        kind = 'Client' if status < 500 else 'Server'
+        # Drop the query string so API keys never end up in logs or error bodies
+        super().__init__(f"{status} {kind} Error: {reason} for url: {url.split('?')[0]}")
+        self.status = status
+
+
+class AsyncHTTPClient:
+    def __init__(self, max_connections: int = 100):
+        self.max_connections = max_connections
+        self._loop = asyncio.new_event_loop()
+        self._session = None
+        self._ready = threading.Event()
+
+        # Fallback transport, also used for streaming when aiohttp is missing
+        self.requests_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.requests_session.mount('https://', adapter)
+        self.requests_session.mount('http://', adapter)
+
+        self._thread = threading.Thread(target=self._run, name='async-http', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        if AIOHTTP_AVAILABLE:
+            # The session must be created on the loop that will use it
+            self._session = self._loop.run_until_complete(self._create_session())
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+        return aiohttp.ClientSession(connector=connector)
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Run a coroutine on the background loop and block the calling thread for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    async def post_json(self, url: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        """POST JSON and return the decoded JSON body; raises on HTTP errors and timeouts"""
+        if self._session is None:
+            return await self._loop.run_in_executor(None, self._post_json_blocking, url, payload, timeout)
+
+        async with self._session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status >= 400:
+                raise AsyncHTTPError(response.status, response.reason or '', url)
+            return await response.json(content_type=None)
+
+    def _post_json_blocking(self, url: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        response = self.requests_session.post(url, json=payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def stream_lines(self, url: str, payload: Dict[str, Any], timeout: float) -> Iterator[str]:
+        """POST JSON and yield the response body line by line as it arrives.
+
+        `timeout` bounds the connection and each gap between lines. Closing the
+        generator early cancels the upstream request.
+        """
+        if self._session is None:
+            with self.requests_session.post(url, json=payload, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                yield from response.iter_lines(decode_unicode=True)
+            return
+
+        lines: queue.Queue = queue.Queue()
+
+        async def pump():
+            try:
+                client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+                async with self._session.post(url, json=payload, timeout=client_timeout) as response:
+                    if response.status >= 400:
+                        raise AsyncHTTPError(response.status, response.reason or '', url)
+                    async for raw in response.content:
+                        lines.put(raw.decode('utf-8').rstrip('\r\n'))
+                lines.put(_END)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                lines.put(e)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        try:
+            while True:
+                item = lines.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
@@ -0,0 +1,101 @@
+"""
+Catalog Facets Service for Library App
+Counts for the browse screen's filters (category, e-book/physical, free/paid, available)
+without downloading the catalog. One grouped query builds a rollup with one row per
+combination of facet values (a few rows per category), and the counts for any filter
+set are summed from that rollup in memory.
+
+Each facet is counted with every filter applied except its own, so the screen can show
+how many books selecting a different value would give; `total` has all filters applied.
+The rollup is dropped on catalog writes (invalidate) and also expires after max_age
+seconds, which bounds staleness for availability (changed by loans) and for writes
+made by other worker processes.
+"""
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+FACETS = ('category', 'is_ebook', 'is_free', 'available')
+
+
+class CatalogFacetsService:
+    def __init__(self, db_path: str, max_age_seconds: int = 30):
+        self.db_path = db_path
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._rollup: Optional[List[Tuple[str, bool, bool, bool, int]]] = None
+        self._built_at = 0.0
+        self._version = 0  # Bumped by invalidate() so a rebuild that raced a write is not kept
+
+    def get_db_connection(self):
+        """Get SQLite database connection"""
+        return sqlite3.connect(self.db_path)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._rollup = None
+            self._version += 1
+
+    def _build(self) -> List[Tuple[str, bool, bool, bool, int]]:
+        conn = self.get_db_connection()
+        try:
+            rows = conn.execute('''
+                SELECT category,
+                       COALESCE(is_ebook, 0) != 0,
+                       COALESCE(is_free, 0) != 0,
+                       COALESCE(available_copies, 0) > 0,
+                       COUNT(*)
+                FROM books
+                GROUP BY 1, 2, 3, 4
+            ''').fetchall()
+        finally:
+            conn.close()
+        return [(category, bool(ebook), bool(free), bool(available), count)
+                for category, ebook, free, available, count in rows]
+
+    def rollup(self) -> Tuple[List[Tuple[str, bool, bool, bool, int]], float]:
+        """(rows, built_at), rebuilding if invalidated or older than max_age"""
+        with self._lock:
+            if self._rollup is not None and time.time() - self._built_at < self.max_age_seconds:
+                return self._rollup, self._built_at
+            version = self._version
+        rows = self._build()
+        built_at = time.time()
+        with self._lock:
+            if version == self._version:
+                self._rollup, self._built_at = rows, built_at
+        return rows, built_at
+
+    def facets(self, filters: Dict[str, Any]) -> Dict[str, Any]:
+        """Facet counts for filters {category: str, is_ebook/is_free/available: bool}; None = unset"""
+        rows, built_at = self.rollup()
+        active = {name: value for name, value in filters.items() if name in FACETS and value is not None}
+
+        def matches(row, skip=None):
+            return all(row[FACETS.index(name)] == value for name, value in active.items() if name != skip)
+
+        counts = {name: {} for name in FACETS}
+        total = 0
+        for row in rows:
+            count = row[4]
+            if matches(row):
+                total += count
+            for position, name in enumerate(FACETS):
+                if matches(row, skip=name):
+                    counts[name][row[position]] = counts[name].get(row[position], 0) + count
+
+        categories = sorted(counts['category'].items(), key=lambda item: (-item[1], item[0] or ''))
+        return {
+            'total': total,
+            'filters': active,
+            'facets': {
+                'category': [{'value': value, 'count': count} for value, count in categories],
+                'format': {'ebook': counts['is_ebook'].get(True, 0), 'physical': counts['is_ebook'].get(False, 0)},
+                'price': {'free': counts['is_free'].get(True, 0), 'paid': counts['is_free'].get(False, 0)},
+                'availability': {'available': counts['available'].get(True, 0),
+                                 'unavailable': counts['available'].get(False, 0)}
+            },
+            'generated_at': datetime.fromtimestamp(built_at).isoformat()
+        }
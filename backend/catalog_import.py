@@ -0,0 +1,338 @@
+"""
+Catalog Import Service for Library App
+Bulk-loads books from CSV or JSON Lines. Input is read as a stream (rows are parsed
+and validated one at a time and only the current chunk is held in memory), ISBNs are
+normalized and deduplicated against both the file and the catalog, and each chunk is
+inserted with executemany on its own BEGIN IMMEDIATE transaction, so a large import
+never holds the write lock for long. Copies are created through inventory so the
+copy counters stay consistent. Caches derived from the catalog are refreshed once, by
+the caller's on_complete hook, rather than once per book. If reading or inserting
+fails partway, the chunks already committed stay, the report's `aborted` entry says
+where it stopped, and on_complete still runs.
+
+Usable from the admin upload endpoint or from the command line:
+    python catalog_import.py books.csv [--db library.db] [--format csv|jsonl]
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from typing import Iterable, Iterator, Dict, Any, List, Optional, Tuple, Callable, IO
+
+import inventory
+import waitlist
+
+DEFAULT_CHUNK_ROWS = 1000  # Rows per transaction
+MAX_REPORTED_ERRORS = 100  # Validation errors listed in the report (all are counted)
+
+REQUIRED_FIELDS = ('title', 'author', 'category')
+BOOK_COLUMNS = ('title', 'author', 'isbn', 'category', 'description', 'price', 'is_free', 'is_ebook',
+                'cover_image', 'pdf_url', 'reading_time_minutes', 'publish_date')
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', 'f', ''}
+
+
+class ImportRowError(ValueError):
+    pass
+
+
+def normalize_isbn(value: Any) -> Optional[str]:
+    """ISBN as stored in books.isbn (digits, plus a trailing X for ISBN-10), or None if empty.
+    Raises ImportRowError if it is not 10 or 13 characters once hyphens and spaces are removed."""
+    if value is None:
+        return None
+    isbn = re.sub(r'[\s-]', '', str(value)).upper()
+    if not isbn:
+        return None
+    if not (re.fullmatch(r'\d{13}', isbn) or re.fullmatch(r'\d{9}[\dX]', isbn)):
+        raise ImportRowError(f'invalid ISBN {value!r}')
+    return isbn
+
+
+def _text(row: Dict[str, Any], field: str) -> Optional[str]:
+    value = row.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _bool(row: Dict[str, Any], field: str, default: bool) -> bool:
+    value = row.get(field)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False if text else default
+    raise ImportRowError(f'{field} must be true or false')
+
+
+def _number(row: Dict[str, Any], field: str, default, cast):
+    value = row.get(field)
+    if value is None or str(value).strip() == '':
+        return default
+    try:
+        number = cast(value)
+    except (TypeError, ValueError):
+        raise ImportRowError(f'{field} must be a number')
+    if number < 0:
+        raise ImportRowError(f'{field} must not be negative')
+    return number
+
+
+def validate_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Clean one input row into a book record. Raises ImportRowError."""
+    if not isinstance(row, dict):
+        raise ImportRowError('row is not an object')
+    row = {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+
+    book = {field: _text(row, field) for field in ('title', 'author', 'category', 'description',
+                                                    'cover_image', 'pdf_url', 'branch')}
+    missing = [field for field in REQUIRED_FIELDS if not book[field]]
+    if missing:
+        raise ImportRowError(f"missing {', '.join(missing)}")
+
+    book['isbn'] = normalize_isbn(row.get('isbn'))
+    book['price'] = _number(row, 'price', 0.0, float)
+    book['is_free'] = _bool(row, 'is_free', book['price'] == 0)
+    book['is_ebook'] = _bool(row, 'is_ebook', bool(book['pdf_url']))
+    book['reading_time_minutes'] = _number(row, 'reading_time_minutes', 0, int)
+    book['copies'] = _number(row, 'total_copies', 0 if book['is_ebook'] else 1, int)
+
+    publish_date = _text(row, 'publish_date')
+    if publish_date:
+        try:
+            publish_date = datetime.strptime(publish_date[:10], '%Y-%m-%d').date().isoformat()
+        except ValueError:
+            raise ImportRowError('publish_date must be YYYY-MM-DD')
+    book['publish_date'] = publish_date
+    return book
+
+
+def detect_format(filename: Optional[str] = None, content_type: Optional[str] = None) -> str:
+    """'csv' or 'jsonl' from a file name or content type (CSV if it cannot tell)"""
+    name = (filename or '').lower()
+    mime = (content_type or '').lower()
+    if name.endswith(('.jsonl', '.ndjson', '.json')) or 'ndjson' in mime or 'jsonl' in mime or 'json' in mime:
+        return 'jsonl'
+    return 'csv'
+
+
+def iter_rows(stream: IO, fmt: str) -> Iterator[Tuple[int, Any]]:
+    """Yield (line_number, raw_row) from a binary or text stream without reading it whole"""
+    if isinstance(stream, io.TextIOBase):
+        text = stream
+    else:
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, ImportRowError(f'invalid JSON: {e.msg}')
+    else:
+        reader = csv.DictReader(text)
+        for row in reader:
+            # line_num is the reader's position after the row; header is line 1
+            yield reader.line_num, row
+
+
+class CatalogImporter:
+    def __init__(self, db_path: str, chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                 default_branch: str = inventory.DEFAULT_BRANCH,
+                 on_complete: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.db_path = db_path
+        self.chunk_rows = chunk_rows
+        self.default_branch = default_branch
+        self.on_complete = on_complete
+        self.promotions: List[Dict[str, Any]] = []  # Waitlist promotions made by the last run, to notify after it
+
+    def run(self, rows: Iterable[Tuple[int, Any]]) -> Dict[str, Any]:
+        """Validate, dedupe and insert rows; returns the import report"""
+        started = time.time()
+        report = {
+            'rows_read': 0,
+            'inserted': 0,
+            'copies_created': 0,
+            'duplicates_in_file': 0,
+            'duplicates_existing': 0,
+            'invalid': 0,
+            'chunks': 0,
+            'waitlist_promoted': 0,
+            'errors': []
+        }
+        self.promotions = []
+        seen_isbns = set()
+        chunk: List[Dict[str, Any]] = []
+        line_number = 0
+        committed_through_line = 0
+
+        conn = inventory.connect(self.db_path)
+        try:
+            for line_number, raw in rows:
+                report['rows_read'] += 1
+                try:
+                    if isinstance(raw, Exception):
+                        raise raw
+                    book = validate_row(raw)
+                except ImportRowError as e:
+                    report['invalid'] += 1
+                    if len(report['errors']) < MAX_REPORTED_ERRORS:
+                        report['errors'].append({'line': line_number, 'error': str(e)})
+                    continue
+
+                if book['isbn']:
+                    if book['isbn'] in seen_isbns:
+                        report['duplicates_in_file'] += 1
+                        continue
+                    seen_isbns.add(book['isbn'])
+
+                chunk.append(book)
+                if len(chunk) >= self.chunk_rows:
+                    self._insert_chunk(conn, chunk, report)
+                    committed_through_line = line_number
+                    chunk = []
+
+            if chunk:
+                self._insert_chunk(conn, chunk, report)
+                committed_through_line = line_number
+                chunk = []
+        except Exception as e:
+            # Earlier chunks are committed and stay; report where the import stopped so it can be resumed
+            report['aborted'] = {
+                'after_line': line_number,
+                'error': str(e) or type(e).__name__,
+                'type': type(e).__name__,
+                'bad_input': isinstance(e, (UnicodeError, csv.Error)),  # As opposed to a database failure
+                'committed_through_line': committed_through_line,
+                'rows_not_committed': len(chunk)
+            }
+        finally:
+            conn.close()
+
+        elapsed = time.time() - started
+        report['seconds'] = round(elapsed, 3)
+        report['rows_per_second'] = round(report['rows_read'] / elapsed, 1) if elapsed > 0 else None
+
+        if report['inserted'] and self.on_complete:
+            self.on_complete(report)
+        return report
+
+    def _insert_chunk(self, conn, chunk: List[Dict[str, Any]], report: Dict[str, Any]) -> None:
+        cursor = conn.cursor()
+        inventory.begin_immediate(conn)
+        try:
+            isbns = [book['isbn'] for book in chunk if book['isbn']]
+            existing = set()
+            for start in range(0, len(isbns), 500):
+                part = isbns[start:start + 500]
+                cursor.execute(f"SELECT isbn FROM books WHERE isbn IN ({','.join('?' * len(part))})", part)
+                existing.update(row[0] for row in cursor.fetchall())
+            books = [book for book in chunk if not book['isbn'] or book['isbn'] not in existing]
+            report['duplicates_existing'] += len(chunk) - len(books)
+
+            if books:
+                # Ids are assigned in insertion order and nobody else can insert while we hold the lock
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM books')
+                last_id = cursor.fetchone()[0]
+                cursor.executemany(f'''
+                    INSERT INTO books ({', '.join(BOOK_COLUMNS)}, total_copies, available_copies)
+                    VALUES ({', '.join('?' * len(BOOK_COLUMNS))}, 0, 0)
+                ''', [tuple(book[column] for column in BOOK_COLUMNS) for book in books])
+                cursor.execute('SELECT id FROM books WHERE id > ? ORDER BY id', (last_id,))
+                book_ids = [row[0] for row in cursor.fetchall()]
+
+                report['copies_created'] += inventory.add_copies_bulk(cursor, [
+                    (book_id, book['copies'], book['branch'] or self.default_branch)
+                    for book_id, book in zip(book_ids, books)
+                ])
+                report['inserted'] += len(books)
+
+                # Shelved copies go to anyone already waiting for these books, in queue order
+                cursor.execute('''
+                    SELECT DISTINCT book_id FROM book_waitlist
+                    WHERE status = 'waiting' AND book_id BETWEEN ? AND ?
+                ''', (book_ids[0], book_ids[-1]))
+                waiting = {row[0] for row in cursor.fetchall()}
+                for book_id, book in zip(book_ids, books):
+                    if book_id in waiting:
+                        promotions = waitlist.promote_for_copies(cursor, book_id, book['copies'])
+                        self.promotions.extend(promotions)
+                        report['waitlist_promoted'] += len(promotions)
+
+            conn.commit()
+            report['chunks'] += 1
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def optimize(db_path: str) -> None:
+    """Refresh the query planner's statistics after a large import"""
+    conn = inventory.connect(db_path)
+    try:
+        conn.execute('ANALYZE books')
+        conn.execute('ANALYZE book_copies')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk-import books from CSV or JSON Lines')
+    parser.add_argument('path', help='CSV or .jsonl file (- for stdin)')
+    parser.add_argument('--db', default=os.environ.get('DATABASE_PATH', 'library.db'))
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='Default: from the file extension')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument('--branch', default=inventory.DEFAULT_BRANCH, help='Branch for rows without one')
+    args = parser.parse_args()
+
+    # Make sure book_copies and book_waitlist exist when the app has never run against this database
+    conn = inventory.connect(args.db)
+    inventory.ensure_schema(conn.cursor())
+    waitlist.ensure_schema(conn.cursor())
+    conn.commit()
+    conn.close()
+
+    fmt = args.format or detect_format(args.path)
+    importer = CatalogImporter(args.db, args.chunk_size, args.branch,
+                               on_complete=lambda report: optimize(args.db))
+    if args.path == '-':
+        report = importer.run(iter_rows(sys.stdin.buffer, fmt))
+    else:
+        with open(args.path, 'rb') as stream:
+            report = importer.run(iter_rows(stream, fmt))
+
+    print(f"Read {report['rows_read']} rows in {report['seconds']}s ({report['rows_per_second']} rows/sec): "
+          f"{report['inserted']} inserted with {report['copies_created']} copies, "
+          f"{report['duplicates_in_file'] + report['duplicates_existing']} duplicate ISBNs skipped, "
+          f"{report['invalid']} invalid")
+    for error in report['errors']:
+        print(f"  line {error['line']}: {error['error']}")
+    if report['invalid'] > len(report['errors']):
+        print(f"  ... and {report['invalid'] - len(report['errors'])} more")
+    aborted = report.get('aborted')
+    if aborted:
+        print(f"Import stopped after line {aborted['after_line']}: {aborted['type']}: {aborted['error']} "
+              f"(rows through line {aborted['committed_through_line']} are committed)")
+    if report['waitlist_promoted']:
+        print(f"{report['waitlist_promoted']} waitlisted members were given copies (in-app notifications only; "
+              f"the app schedules their collection deadlines on its next start)")
+    if report.get('aborted'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
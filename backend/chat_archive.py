@@ -0,0 +1,183 @@
+"""
+Chat Archive Service for Library App
+Moves old chat messages (all but each conversation's newest) out of the hot
+chat_messages table into zlib-compressed per-conversation blobs, rehydrates them for
+"load older" paging, conversation summaries and reply quotes, and removes messages
+orphaned by deleted conversations.
+"""
+import json
+import sqlite3
+import zlib
+from typing import List, Dict, Any, Optional
+
+ARCHIVE_BLOB_MESSAGES = 200  # Messages packed into a single compressed blob
+
+
+class ChatArchiveService:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    def get_db_connection(self):
+        """Get SQLite database connection"""
+        return sqlite3.connect(self.db_path)
+
+    def ensure_schema(self, cursor) -> None:
+        """Create the archive table (called from init_db)"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_message_archives (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id INTEGER NOT NULL,
+                first_message_id INTEGER NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (conversation_id) REFERENCES chat_conversations (id) ON DELETE CASCADE
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_message_archives_conversation
+            ON chat_message_archives(conversation_id, last_message_id)
+        ''')
+
+    def archive_old_messages(self, older_than_days: int) -> Dict[str, int]:
+        """Compress messages older than the threshold into archive blobs and delete them from chat_messages"""
+        conn = self.get_db_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cutoff = f'-{int(older_than_days)} days'
+        stats = {'conversations': 0, 'messages': 0, 'blobs': 0, 'bytes_before': 0, 'bytes_after': 0}
+
+        try:
+            # A conversation's newest message is never archived: chat_conversations.last_message_id
+            # points at it, and the sync/stream endpoints expect to find it in chat_messages
+            cursor.execute('''
+                SELECT DISTINCT conversation_id FROM chat_messages m
+                WHERE created_at < datetime('now', ?)
+                  AND id < (SELECT MAX(id) FROM chat_messages WHERE conversation_id = m.conversation_id)
+            ''', (cutoff,))
+            conversation_ids = [row[0] for row in cursor.fetchall()]
+
+            for conversation_id in conversation_ids:
+                # reply_to_text and username are captured now because the rows they
+                # come from may themselves be archived later
+                cursor.execute('''
+                    SELECT m.id, m.conversation_id, m.user_id, m.message_text, m.is_user_message,
+                           m.reply_to_id, m.created_at, u.username,
+                           reply.message_text as reply_to_text
+                    FROM chat_messages m
+                    LEFT JOIN users u ON m.user_id = u.id
+                    LEFT JOIN chat_messages reply ON m.reply_to_id = reply.id
+                    WHERE m.conversation_id = ? AND m.created_at < datetime('now', ?)
+                      AND m.id < (SELECT MAX(id) FROM chat_messages WHERE conversation_id = m.conversation_id)
+                    ORDER BY m.id ASC
+                ''', (conversation_id, cutoff))
+                rows = [dict(row) for row in cursor.fetchall()]
+                if not rows:
+                    continue
+
+                for start in range(0, len(rows), ARCHIVE_BLOB_MESSAGES):
+                    chunk = rows[start:start + ARCHIVE_BLOB_MESSAGES]
+                    raw = json.dumps(chunk, separators=(',', ':')).encode('utf-8')
+                    payload = zlib.compress(raw, 9)
+                    cursor.execute('''
+                        INSERT INTO chat_message_archives
+                            (conversation_id, first_message_id, last_message_id, message_count, payload)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (conversation_id, chunk[0]['id'], chunk[-1]['id'], len(chunk), payload))
+                    cursor.executemany('DELETE FROM chat_messages WHERE id = ?', [(m['id'],) for m in chunk])
+                    stats['blobs'] += 1
+                    stats['bytes_before'] += len(raw)
+                    stats['bytes_after'] += len(payload)
+
+                # Commit per conversation so a failure never loses archived rows
+                conn.commit()
+                stats['conversations'] += 1
+                stats['messages'] += len(rows)
+
+            return stats
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def get_archived_messages(self, cursor, conversation_id: int, before_id: Optional[int] = None,
+                              limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Return up to `limit` archived messages older than before_id (all of them if limit is None),
+        in chronological order"""
+        if before_id is None:
+            cursor.execute('''
+                SELECT payload FROM chat_message_archives
+                WHERE conversation_id = ?
+                ORDER BY last_message_id DESC
+            ''', (conversation_id,))
+        else:
+            cursor.execute('''
+                SELECT payload FROM chat_message_archives
+                WHERE conversation_id = ? AND first_message_id < ?
+                ORDER BY last_message_id DESC
+            ''', (conversation_id, before_id))
+
+        collected: List[Dict[str, Any]] = []
+        for row in cursor:
+            messages = json.loads(zlib.decompress(row[0]))
+            if before_id is not None:
+                messages = [m for m in messages if m['id'] < before_id]
+            collected = messages + collected
+            if limit is not None and len(collected) >= limit:
+                return collected[-limit:]
+        return collected
+
+    def get_archived_range(self, cursor, conversation_id: int, after_id: int,
+                           before_id: int) -> List[Dict[str, Any]]:
+        """Archived messages with after_id < id < before_id, in chronological order"""
+        cursor.execute('''
+            SELECT payload FROM chat_message_archives
+            WHERE conversation_id = ? AND last_message_id > ? AND first_message_id < ?
+            ORDER BY first_message_id
+        ''', (conversation_id, after_id, before_id))
+        collected: List[Dict[str, Any]] = []
+        for row in cursor.fetchall():
+            collected.extend(m for m in json.loads(zlib.decompress(row[0])) if after_id < m['id'] < before_id)
+        return collected
+
+    def get_archived_texts(self, cursor, conversation_id: int, message_ids: List[int]) -> Dict[int, str]:
+        """message_text of the given archived messages, by id; only the blobs holding them are read"""
+        wanted = set(message_ids)
+        texts: Dict[int, str] = {}
+        for message_id in sorted(wanted):
+            if message_id in texts:
+                continue  # Found in a blob already read for an earlier id
+            cursor.execute('''
+                SELECT payload FROM chat_message_archives
+                WHERE conversation_id = ? AND first_message_id <= ? AND last_message_id >= ?
+            ''', (conversation_id, message_id, message_id))
+            row = cursor.fetchone()
+            if not row:
+                wanted.discard(message_id)
+                continue
+            for message in json.loads(zlib.decompress(row[0])):
+                if message['id'] in wanted:
+                    texts[message['id']] = message['message_text']
+        return texts
+
+    def cleanup_orphans(self) -> Dict[str, int]:
+        """Delete messages and archive blobs whose conversation no longer exists"""
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                DELETE FROM chat_messages
+                WHERE conversation_id NOT IN (SELECT id FROM chat_conversations)
+            ''')
+            orphan_messages = cursor.rowcount
+            cursor.execute('''
+                DELETE FROM chat_message_archives
+                WHERE conversation_id NOT IN (SELECT id FROM chat_conversations)
+            ''')
+            orphan_blobs = cursor.rowcount
+            conn.commit()
+            return {'orphan_messages': orphan_messages, 'orphan_blobs': orphan_blobs}
+        finally:
+            conn.close()
@@ -0,0 +1,62 @@
+"""
+Chat Event Broker for Library App
+In-process publish/subscribe of new chat message ids per conversation, used by the
+SSE stream endpoint to push messages to other devices as soon as they are saved.
+"""
+import threading
+from typing import Dict, Optional
+
+
+class ChatEventBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conditions: Dict[int, threading.Condition] = {}
+        self._subscribers: Dict[int, int] = {}
+        self._latest: Dict[int, int] = {}
+
+    def subscribe(self, conversation_id: int, max_total: Optional[int] = None) -> bool:
+        """Register interest in a conversation (call unsubscribe when the stream ends).
+        Returns False, without subscribing, if max_total subscriptions are already open."""
+        with self._lock:
+            if max_total is not None and sum(self._subscribers.values()) >= max_total:
+                return False
+            if conversation_id not in self._conditions:
+                # Every condition shares self._lock, so _latest is only ever touched under that one lock
+                self._conditions[conversation_id] = threading.Condition(self._lock)
+                self._latest[conversation_id] = 0
+            self._subscribers[conversation_id] = self._subscribers.get(conversation_id, 0) + 1
+            return True
+
+    def unsubscribe(self, conversation_id: int) -> None:
+        with self._lock:
+            remaining = self._subscribers.get(conversation_id, 0) - 1
+            if remaining > 0:
+                self._subscribers[conversation_id] = remaining
+                return
+            self._subscribers.pop(conversation_id, None)
+            self._conditions.pop(conversation_id, None)
+            self._latest.pop(conversation_id, None)
+
+    def publish(self, conversation_id: int, message_id: int) -> None:
+        """Wake every subscriber of the conversation. Must be called after the commit."""
+        with self._lock:
+            condition = self._conditions.get(conversation_id)
+            if condition is None:
+                return  # Nobody is listening in this process
+            if message_id > self._latest.get(conversation_id, 0):
+                self._latest[conversation_id] = message_id
+            condition.notify_all()
+
+    def wait(self, conversation_id: int, after_id: int, timeout: float) -> bool:
+        """Block until a message newer than after_id is published or the timeout passes.
+        Returns True if a newer message was published in this process.
+        """
+        with self._lock:
+            condition = self._conditions.get(conversation_id)
+            if condition is None:
+                return False
+            return condition.wait_for(lambda: self._latest.get(conversation_id, 0) > after_id, timeout)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(self._subscribers.values())
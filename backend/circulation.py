@@ -0,0 +1,203 @@
+"""
+Circulation Service for Library App
+Bulk versions of the admin circulation actions (approve reservation requests, complete
+checkouts, return issued books). Every row the batch needs is read with a few IN (...)
+queries, each item is validated in Python, and the writes go out as executemany calls
+on the caller's BEGIN IMMEDIATE transaction (copy state changes go through inventory,
+one guarded update per copy). A batch of hundreds of returns therefore costs one lock
+acquisition and one commit instead of one per book.
+
+Functions return (results, pushes): per-item results in request order (each found item
+carries its user_id, so callers can refresh per-user caches even when no push is sent),
+and the push notifications to send once the transaction has committed.
+"""
+import json
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Tuple, Iterable
+
+import inventory
+import waitlist
+
+MAX_IDS_PER_QUERY = 500  # Stays under SQLite's bound-parameter limit
+ISSUE_DAYS = 14  # Loan period for an approved reservation request (same as the single endpoint)
+
+
+def unique_ids(ids: Iterable[Any]) -> List[int]:
+    """Request IDs as ints, in order, without duplicates. Raises ValueError for non-integers."""
+    seen = set()
+    result = []
+    for value in ids:
+        item_id = int(value)
+        if item_id not in seen:
+            seen.add(item_id)
+            result.append(item_id)
+    return result
+
+
+def _fetch_by_ids(cursor, query: str, ids: List[int]) -> Dict[int, tuple]:
+    """Run `query` (with a single {ids} placeholder, first column the id) over ids in chunks"""
+    rows = {}
+    for start in range(0, len(ids), MAX_IDS_PER_QUERY):
+        chunk = ids[start:start + MAX_IDS_PER_QUERY]
+        cursor.execute(query.format(ids=','.join('?' * len(chunk))), chunk)
+        for row in cursor.fetchall():
+            rows[row[0]] = row
+    return rows
+
+
+def approve_reservations(cursor, request_ids: List[int], admin_id: int, timestamp: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Approve pending reservation requests and issue the books, first come first served per title"""
+    reservations = _fetch_by_ids(cursor, '''
+        SELECT br.id, br.book_id, br.user_id, br.status, b.title
+        FROM book_reservations br
+        LEFT JOIN books b ON br.book_id = b.id
+        WHERE br.id IN ({ids})
+    ''', request_ids)
+
+    # Copies are handed out in request order, so earlier requests win the last copies
+    results, approved = [], []
+    for request_id in request_ids:
+        row = reservations.get(request_id)
+        if not row:
+            results.append({'id': request_id, 'status': 'not_found'})
+            continue
+        if row[3] != 'pending':
+            results.append({'id': request_id, 'status': 'already_processed', 'current_status': row[3], 'user_id': row[2]})
+            continue
+        copy_id = inventory.take_copy(cursor, row[1])
+        if not copy_id:
+            results.append({'id': request_id, 'status': 'unavailable', 'user_id': row[2]})
+        else:
+            approved.append(row + (copy_id,))
+            results.append({'id': request_id, 'status': 'approved', 'copy_id': copy_id, 'user_id': row[2]})
+
+    if not approved:
+        return results, []
+
+    issue_date = datetime.now().date()
+    due_date = issue_date + timedelta(days=ISSUE_DAYS)
+    cursor.executemany('''
+        INSERT INTO book_issues (book_id, user_id, issue_date, due_date, status, overdue_fee_per_day, copy_id)
+        VALUES (?, ?, ?, ?, 'issued', 5.00, ?)
+    ''', [(row[1], row[2], issue_date, due_date, row[5]) for row in approved])
+    cursor.executemany('''
+        UPDATE book_reservations
+        SET status = 'approved', approved_at = ?, approved_by = ?, viewed = 0
+        WHERE id = ?
+    ''', [(timestamp, admin_id, row[0]) for row in approved])
+    waitlist.resolve_many(cursor, [(row[1], row[2]) for row in approved])
+
+    pushes = []
+    notifications = []
+    for request_id, book_id, user_id, _, book_title, _ in approved:
+        message = f'Your reservation for "{book_title}" has been approved. Please collect it within 3 days.'
+        data = {'reservationId': request_id, 'bookTitle': book_title, 'bookId': book_id, 'timestamp': timestamp}
+        notifications.append((user_id, 'reservation_approved', 'Reservation Approved', message, json.dumps(data), timestamp))
+        pushes.append({'user_id': user_id, 'title': 'Reservation Approved', 'message': message, 'data': data})
+    cursor.executemany('''
+        INSERT INTO notifications (user_id, type, title, message, data, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', notifications)
+
+    return results, pushes
+
+
+def complete_checkouts(cursor, checkout_ids: List[int]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Mark pending checkouts as collected and create their issue records (copies were taken at approval)"""
+    checkouts = _fetch_by_ids(cursor, '''
+        SELECT id, book_id, user_id, status, reservation_id, copy_id
+        FROM book_checkouts
+        WHERE id IN ({ids})
+    ''', checkout_ids)
+
+    results, completed = [], []
+    for checkout_id in checkout_ids:
+        row = checkouts.get(checkout_id)
+        if not row:
+            results.append({'id': checkout_id, 'status': 'not_found'})
+        elif row[3] != 'pending_checkout':
+            results.append({'id': checkout_id, 'status': 'already_processed', 'current_status': row[3], 'user_id': row[2]})
+        else:
+            completed.append(row)
+            results.append({'id': checkout_id, 'status': 'completed', 'user_id': row[2]})
+
+    if not completed:
+        return results, []
+
+    cursor.executemany('''
+        UPDATE book_checkouts
+        SET status = 'completed', completed_at = datetime('now')
+        WHERE id = ?
+    ''', [(row[0],) for row in completed])
+    cursor.executemany('''
+        UPDATE book_reservations
+        SET status = 'checked_out'
+        WHERE id = ?
+    ''', [(row[4],) for row in completed])
+    cursor.executemany('''
+        INSERT INTO book_issues (book_id, user_id, issue_date, due_date, status, copy_id)
+        VALUES (?, ?, datetime('now'), datetime('now', '+30 days'), 'issued', ?)
+    ''', [(row[1], row[2], row[5]) for row in completed])
+    for row in completed:
+        inventory.lend_held_copy(cursor, row[5])
+
+    return results, []
+
+
+def return_issues(cursor, issue_ids: List[int], timestamp: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Mark issued books as returned, put the copies back and promote waitlisted users"""
+    issues = _fetch_by_ids(cursor, '''
+        SELECT bi.id, bi.book_id, bi.user_id, bi.status, b.title, bi.copy_id
+        FROM book_issues bi
+        LEFT JOIN books b ON bi.book_id = b.id
+        WHERE bi.id IN ({ids})
+    ''', issue_ids)
+
+    results, returned = [], []
+    for issue_id in issue_ids:
+        row = issues.get(issue_id)
+        if not row:
+            results.append({'id': issue_id, 'status': 'not_found'})
+        elif row[3] == 'returned':
+            results.append({'id': issue_id, 'status': 'already_returned', 'user_id': row[2]})
+        else:
+            returned.append(row)
+            results.append({'id': issue_id, 'status': 'returned', 'user_id': row[2]})
+
+    if not returned:
+        return results, []
+
+    cursor.executemany('UPDATE book_issues SET status = "returned", return_date = date("now") WHERE id = ?',
+                       [(row[0],) for row in returned])
+    for row in returned:
+        inventory.release_copy(cursor, row[1], row[5])
+    cursor.executemany('''
+        INSERT OR REPLACE INTO reading_progress
+        (book_id, user_id, progress_percentage, is_completed, completed_at)
+        VALUES (?, ?, 100, 1, CURRENT_TIMESTAMP)
+    ''', [(row[1], row[2]) for row in returned])
+
+    pushes = []
+    for issue_id, book_id, user_id, _, book_title, _ in returned:
+        book_title = book_title or 'Book'
+        pushes.append({
+            'user_id': user_id,
+            'title': '📖 Book Returned Successfully!',
+            'message': f"'{book_title}' has been marked as returned. Thank you for using our library!",
+            'data': {'type': 'book_returned', 'book_id': book_id, 'issue_id': issue_id}
+        })
+
+    # Each returned copy goes to the head of its waitlist, still inside the transaction
+    results_by_id = {result['id']: result for result in results}
+    for issue_id, book_id, _, _, _, _ in returned:
+        promotion = waitlist.promote_next(cursor, book_id, timestamp)
+        if promotion:
+            pushes.append(waitlist.promotion_push(promotion))
+            results_by_id[issue_id]['waitlist_checkout'] = {
+                'checkout_id': promotion['checkout_id'],
+                'user_id': promotion['user_id'],
+                'checkout_deadline': promotion['checkout_deadline']
+            }
+
+    return results, pushes
+
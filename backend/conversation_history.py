@@ -0,0 +1,166 @@
+"""
+Conversation History Service for Library App
+Supplies the AI assistants with prior turns from chat_messages: a sliding window of
+the most recent messages verbatim, plus a rolling summary of everything older.
+
+The summary is extractive (the opening of each earlier question and answer) so it
+costs no extra AI call. It is stored per conversation with the id of the last message
+it covers and only extended with the messages that have left the window since, so
+long conversations are never re-read in full. Messages already moved to compressed
+archives (ChatArchiveService) are read from there for both the window and the summary.
+"""
+import re
+import sqlite3
+from typing import List, Dict, Any, Optional
+
+SUMMARY_SNIPPET_CHARS = 160  # Characters kept from each summarized message
+SUMMARY_MAX_LINES = 24  # Older lines beyond this are counted rather than kept
+MESSAGE_MAX_CHARS = 1500  # Longer messages in the window are clipped
+
+
+def _snippet(text: str, limit: int) -> str:
+    text = ' '.join(text.split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + '…'
+
+
+def _first_sentence(text: str, limit: int) -> str:
+    text = ' '.join(text.split())
+    match = re.match(r'(.+?[.!?])(\s|$)', text)
+    return _snippet(match.group(1) if match else text, limit)
+
+
+class ConversationHistoryService:
+    def __init__(self, db_path: str, window_messages: int = 8, archive=None):
+        self.db_path = db_path
+        self.window_messages = window_messages
+        self.archive = archive  # ChatArchiveService, or None if messages are never archived
+
+    def get_db_connection(self):
+        """Get SQLite database connection"""
+        return sqlite3.connect(self.db_path)
+
+    def ensure_schema(self, cursor) -> None:
+        """Create the rolling summary table (called from init_db)"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_conversation_summaries (
+                conversation_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                omitted_lines INTEGER NOT NULL DEFAULT 0,
+                through_message_id INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (conversation_id) REFERENCES chat_conversations (id) ON DELETE CASCADE
+            )
+        ''')
+
+    def get_history(self, conversation_id, user_id, question: str = '',
+                    before_id: Optional[int] = None) -> Dict[str, Any]:
+        """Return {'turns': [{'role', 'text'}], 'summary': str, 'last_message_id'} for the
+        conversation, oldest turn first.
+
+        The question being answered is normally already saved as the newest message, so
+        messages from `before_id` on are ignored, and without `before_id` a trailing user
+        message identical to the question is dropped. Conversations that do not belong to
+        `user_id` yield no history.
+        """
+        empty = {'turns': [], 'summary': '', 'last_message_id': None}
+        if not conversation_id or not user_id:
+            return empty
+
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT user_id FROM chat_conversations WHERE id = ?', (conversation_id,))
+            owner = cursor.fetchone()
+            if not owner or int(owner[0]) != int(user_id):
+                return empty
+
+            cursor.execute('''
+                SELECT id, message_text, is_user_message FROM chat_messages
+                WHERE conversation_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (conversation_id, before_id or 2 ** 62, self.window_messages + 1))
+            rows = cursor.fetchall()[::-1]
+            if len(rows) <= self.window_messages and self.archive:
+                # The rest of the window may already be archived
+                archived = self.archive.get_archived_messages(cursor, conversation_id, rows[0][0] if rows else before_id,
+                                                              self.window_messages + 1 - len(rows))
+                rows = [(m['id'], m['message_text'], m['is_user_message']) for m in archived] + rows
+
+            if before_id is None and rows and rows[-1][2] and \
+                    ' '.join(rows[-1][1].split()) == ' '.join(question.split()):
+                rows = rows[:-1]
+            rows = rows[-self.window_messages:]
+            if not rows:
+                return empty
+
+            summary = self._rolling_summary(cursor, conversation_id, rows[0][0])
+            conn.commit()
+        finally:
+            conn.close()
+
+        return {
+            'turns': [
+                {'role': 'user' if is_user else 'assistant', 'text': _snippet(text, MESSAGE_MAX_CHARS)}
+                for _, text, is_user in rows
+            ],
+            'summary': summary,
+            'last_message_id': rows[-1][0]
+        }
+
+    def _rolling_summary(self, cursor, conversation_id: int, window_start_id: int) -> str:
+        """Summary of the messages before window_start_id, extended incrementally"""
+        cursor.execute('''
+            SELECT summary, omitted_lines, through_message_id FROM chat_conversation_summaries
+            WHERE conversation_id = ?
+        ''', (conversation_id,))
+        row = cursor.fetchone()
+        summary, omitted, through_id = row if row else ('', 0, 0)
+
+        if through_id >= window_start_id:
+            # Answering an older message: the stored summary overlaps the window
+            return ''
+
+        cursor.execute('''
+            SELECT id, message_text, is_user_message FROM chat_messages
+            WHERE conversation_id = ? AND id > ? AND id < ?
+            ORDER BY id
+        ''', (conversation_id, through_id, window_start_id))
+        new_rows = cursor.fetchall()
+        if self.archive:
+            archived = self.archive.get_archived_range(cursor, conversation_id, through_id, window_start_id)
+            new_rows = sorted(new_rows + [(m['id'], m['message_text'], m['is_user_message']) for m in archived])
+        if new_rows:
+            lines = summary.split('\n') if summary else []
+            for _, text, is_user in new_rows:
+                if is_user:
+                    lines.append(f"- User asked: {_snippet(text, SUMMARY_SNIPPET_CHARS)}")
+                else:
+                    lines.append(f"- Assistant answered: {_first_sentence(text, SUMMARY_SNIPPET_CHARS)}")
+            if len(lines) > SUMMARY_MAX_LINES:
+                omitted += len(lines) - SUMMARY_MAX_LINES
+                lines = lines[-SUMMARY_MAX_LINES:]
+            summary = '\n'.join(lines)
+            cursor.execute('''
+                INSERT INTO chat_conversation_summaries (conversation_id, summary, omitted_lines, through_message_id, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(conversation_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    omitted_lines = excluded.omitted_lines,
+                    through_message_id = excluded.through_message_id,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE excluded.through_message_id > chat_conversation_summaries.through_message_id
+            ''', (conversation_id, summary, omitted, window_start_id - 1))
+
+        if not summary:
+            return ''
+        if omitted:
+            return f"({omitted} earlier messages not shown)\n{summary}"
+        return summary
+
+    @staticmethod
+    def format_turns(turns: List[Dict[str, str]]) -> List[str]:
+        """One prompt line per turn, for PromptBuilder.add_items(keep='last')"""
+        return [f"{'User' if turn['role'] == 'user' else 'Assistant'}: {turn['text']}" for turn in turns]
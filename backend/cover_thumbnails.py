@@ -0,0 +1,279 @@
+"""
+Cover Thumbnail Service for Library App
+Generates fixed-width WebP thumbnails of book covers so grid screens download a few KB
+per card instead of the full-size original on every refresh.
+
+Each original is fetched once (a local file under the cover directory, or an http(s)
+URL) and every thumbnail size is produced from that one decode on a background worker.
+Thumbnails live in an on-disk cache bounded by total bytes and evicted least recently
+used first. The cache key is a hash of the cover_image value, and it is also put in the
+thumbnail URL, so a changed cover gets a new URL and responses can be cached for a year.
+
+Each worker process keeps its own LRU index (rebuilt from file mtimes at startup, and
+hits bump the mtime) and adopts thumbnails another process wrote when it finds them on
+disk, so with several processes the cache can briefly exceed its bound until the next
+eviction pass. Covers that fail to generate are not retried for FAILURE_RETRY_SECONDS.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+
+import requests
+
+# Optional image processing
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    Image = ImageOps = None
+    PIL_AVAILABLE = False
+    print("[Startup] Pillow not available - cover thumbnails disabled")
+
+THUMB_SIZES = (120, 360)  # Thumbnail widths in px: grid cards, detail screens
+WEBP_QUALITY = 80
+MAX_COVER_BYTES = 20 * 1024 * 1024  # Largest original accepted
+TOUCH_INTERVAL_SECONDS = 300  # How often a cache hit refreshes the file's mtime (the LRU order on disk)
+FAILURE_RETRY_SECONDS = 600  # A cover that failed to generate is not retried (re-fetched) before this
+
+
+def cover_key(cover_image: str) -> str:
+    """Cache key / URL version for a cover_image value"""
+    return hashlib.sha1(cover_image.encode('utf-8')).hexdigest()[:16]
+
+
+class CoverThumbnailService:
+    def __init__(self, cache_dir: str, cover_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.cover_dir = os.path.realpath(cover_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index: 'OrderedDict[str, list]' = OrderedDict()  # file name -> [bytes, last touch], oldest first
+        self._total_bytes = 0
+        self._queued: set = set()
+        self._failed_at: Dict[str, float] = {}  # key -> time of the last failed generation
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cover-thumbs')
+        self._generated = 0
+        self._failed = 0
+        self._evicted = 0
+        self._hits = 0
+        self._misses = 0
+        self._load_index()
+
+    def _load_index(self) -> None:
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.webp'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+        with self._lock:
+            for mtime, name, size in sorted(entries):
+                self._index[name] = [size, mtime]
+                self._total_bytes += size
+
+    @staticmethod
+    def _file_name(key: str, size: int) -> str:
+        return f'{key}-{size}.webp'
+
+    def thumb_urls(self, book_id: int, cover_image: Optional[str]) -> Dict[str, Optional[str]]:
+        """cover_thumb_url (grid) and cover_thumb_large_url (detail) fields for a book response"""
+        if not cover_image:
+            return {'cover_thumb_url': None, 'cover_thumb_large_url': None}
+        key = cover_key(cover_image)
+        small, large = THUMB_SIZES
+        return {
+            'cover_thumb_url': f'/api/books/{book_id}/cover/{small}?v={key}',
+            'cover_thumb_large_url': f'/api/books/{book_id}/cover/{large}?v={key}'
+        }
+
+    # ---- Lookup ----
+
+    def get(self, cover_image: str, size: int) -> Optional[str]:
+        """Path of the cached thumbnail, or None (and the cover is queued for generation)"""
+        name = self._file_name(cover_key(cover_image), size)
+        path = os.path.join(self.cache_dir, name)
+        now = time.time()
+        with self._lock:
+            entry = self._index.get(name)
+            if entry:
+                self._index.move_to_end(name)
+                touch = now - entry[1] > TOUCH_INTERVAL_SECONDS
+                if touch:
+                    entry[1] = now
+        if entry and os.path.isfile(path):
+            if touch:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            self._hits += 1
+            return path
+        if entry:
+            self._forget(name)  # Evicted by another process
+        elif self._adopt(name, path):
+            self._hits += 1
+            return path  # Written by another process
+        self._misses += 1
+        self.enqueue(cover_image)
+        return None
+
+    def _adopt(self, name: str, path: str) -> bool:
+        """Add a thumbnail found on disk but not in this process's index"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        with self._lock:
+            if name not in self._index:
+                self._index[name] = [size, time.time()]
+                self._total_bytes += size
+        self._evict()
+        return True
+
+    def original_path(self, cover_image: str) -> Optional[str]:
+        """Local original for a cover_image, or None if it is remote or missing"""
+        if cover_image.startswith(('http://', 'https://')):
+            return None
+        path = os.path.realpath(os.path.join(self.cover_dir, cover_image.lstrip('/')))
+        if not path.startswith(self.cover_dir + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    # ---- Generation ----
+
+    def enqueue(self, cover_image: Optional[str]) -> bool:
+        """Queue thumbnail generation for a cover; False if already queued or unavailable"""
+        if not cover_image or not PIL_AVAILABLE:
+            return False
+        key = cover_key(cover_image)
+        with self._lock:
+            if key in self._queued or time.time() - self._failed_at.get(key, 0) < FAILURE_RETRY_SECONDS:
+                return False
+            self._queued.add(key)
+        self._executor.submit(self._run_job, cover_image, key)
+        return True
+
+    def _run_job(self, cover_image: str, key: str) -> None:
+        try:
+            written = self.generate(cover_image)
+            self._generated += 1
+            with self._lock:
+                self._failed_at.pop(key, None)
+            print(f"[Covers] Generated {len(written)} thumbnails for {cover_image}")
+        except Exception as e:
+            self._failed += 1
+            now = time.time()
+            with self._lock:
+                # Drop expired entries so covers that never come back do not accumulate
+                self._failed_at = {k: at for k, at in self._failed_at.items() if now - at < FAILURE_RETRY_SECONDS}
+                self._failed_at[key] = now
+            print(f"[Covers] Thumbnail for {cover_image} failed: {e}")
+        finally:
+            with self._lock:
+                self._queued.discard(key)
+
+    def _read_original(self, cover_image: str) -> bytes:
+        if cover_image.startswith(('http://', 'https://')):
+            with requests.get(cover_image, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                data = bytearray()
+                for block in response.iter_content(64 * 1024):
+                    data.extend(block)
+                    if len(data) > MAX_COVER_BYTES:
+                        raise ValueError('Cover image is larger than the limit')
+                return bytes(data)
+        path = self.original_path(cover_image)
+        if not path:
+            raise FileNotFoundError(f'Cover not found: {cover_image}')
+        if os.path.getsize(path) > MAX_COVER_BYTES:
+            raise ValueError('Cover image is larger than the limit')
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def generate(self, cover_image: str) -> Dict[int, str]:
+        """Fetch the original once and write every thumbnail size. Returns {size: path}."""
+        if not PIL_AVAILABLE:
+            raise RuntimeError('Pillow is not installed')
+        key = cover_key(cover_image)
+        with Image.open(io.BytesIO(self._read_original(cover_image))) as original:
+            original = ImageOps.exif_transpose(original)
+            if original.mode not in ('RGB', 'RGBA'):
+                original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            written = {}
+            # Largest first, each size from the previous one, so the full-size image is resized once
+            image = original
+            for size in sorted(THUMB_SIZES, reverse=True):
+                if image.width > size:
+                    image = image.resize((size, max(1, round(image.height * size / image.width))),
+                                         Image.LANCZOS)
+                written[size] = self._store(self._file_name(key, size), image)
+        self._evict()
+        return written
+
+    def _store(self, name: str, image) -> str:
+        """Write atomically so readers never see a partial file"""
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, 'WEBP', quality=WEBP_QUALITY, method=4)
+            path = os.path.join(self.cache_dir, name)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        size = os.path.getsize(path)
+        with self._lock:
+            previous = self._index.pop(name, None)
+            if previous:
+                self._total_bytes -= previous[0]
+            self._index[name] = [size, time.time()]
+            self._total_bytes += size
+        return path
+
+    def _forget(self, name: str) -> None:
+        with self._lock:
+            entry = self._index.pop(name, None)
+            if entry:
+                self._total_bytes -= entry[0]
+
+    def _evict(self) -> None:
+        """Delete least recently used thumbnails until the cache is within max_bytes"""
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or not self._index:
+                    return
+                name, entry = self._index.popitem(last=False)
+                self._total_bytes -= entry[0]
+                self._evicted += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'enabled': PIL_AVAILABLE,
+                'files': len(self._index),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'queued': len(self._queued),
+                'hits': self._hits,
+                'misses': self._misses,
+                'generated': self._generated,
+                'failed': self._failed,
+                'failed_recently': len(self._failed_at),
+                'evicted': self._evicted
+            }
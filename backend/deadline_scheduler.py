@@ -0,0 +1,135 @@
+"""
+Deadline Scheduler for Library App
+In-process timer queue that fires a callback at (or just after) each registered
+deadline, instead of discovering deadlines by periodically scanning a table. Keys are
+kept in a min-heap ordered by deadline, and one thread sleeps until the earliest is due.
+Registering an earlier deadline wakes the thread so the new wait is recalculated.
+
+Jobs themselves are not stored here: the deadline lives on the row it belongs to
+(e.g. book_checkouts.checkout_deadline), and load() re-registers every outstanding
+row at startup, so the schedule survives restarts. Callbacks must therefore be
+idempotent: several workers may hold the same job, and a row may have been resolved
+(collected, cancelled, swept) before its deadline fires.
+"""
+import heapq
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Iterable, Tuple, Any, Union
+
+MAX_BATCH = 100  # Due keys handed to one callback invocation
+
+
+def to_timestamp(deadline: Union[str, datetime, float]) -> float:
+    """Epoch seconds for an ISO string (as stored in the database), datetime or number"""
+    if isinstance(deadline, str):
+        deadline = datetime.fromisoformat(deadline)
+    if isinstance(deadline, datetime):
+        return deadline.timestamp()
+    return float(deadline)
+
+
+class DeadlineScheduler:
+    def __init__(self, name: str, callback: Callable[[List[Any]], None]):
+        self.name = name
+        self._callback = callback
+        self._heap: List[Tuple[float, Any]] = []
+        self._deadlines: Dict[Any, float] = {}  # Current deadline per key; heap entries that disagree are stale
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._fired = 0
+        self._errors = 0
+
+    def schedule(self, key: Any, deadline: Union[str, datetime, float]) -> None:
+        """Register (or move) the deadline for `key`"""
+        when = to_timestamp(deadline)
+        with self._condition:
+            self._deadlines[key] = when
+            heapq.heappush(self._heap, (when, key))
+            if self._heap[0][1] == key:
+                self._condition.notify()
+
+    def cancel(self, key: Any) -> None:
+        """Forget `key`; its heap entry is dropped lazily when it reaches the top"""
+        with self._condition:
+            self._deadlines.pop(key, None)
+
+    def load(self, entries: Iterable[Tuple[Any, Union[str, datetime, float]]]) -> int:
+        """Register many (key, deadline) pairs, e.g. every outstanding row at startup"""
+        count = 0
+        with self._condition:
+            for key, deadline in entries:
+                try:
+                    when = to_timestamp(deadline)
+                except (TypeError, ValueError):
+                    continue
+                self._deadlines[key] = when
+                self._heap.append((when, key))
+                count += 1
+            heapq.heapify(self._heap)
+            self._condition.notify()
+        return count
+
+    def start(self) -> None:
+        with self._condition:
+            if self._thread:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name=f'deadline-{self.name}', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _pop_due(self) -> List[Any]:
+        """Wait until at least one key is due (or stop) and return the due keys. Caller holds the lock."""
+        while not self._stopped:
+            while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)  # Cancelled or rescheduled
+            if not self._heap:
+                self._condition.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._condition.wait(delay)
+                continue
+
+            due = []
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now and len(due) < MAX_BATCH:
+                when, key = heapq.heappop(self._heap)
+                if self._deadlines.get(key) == when:
+                    del self._deadlines[key]
+                    due.append(key)
+            if due:
+                return due
+        return []
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                due = self._pop_due()
+            if not due:
+                return
+            try:
+                self._callback(due)
+                self._fired += len(due)
+            except Exception as e:
+                self._errors += 1
+                print(f'[Deadlines] {self.name} callback error: {e}')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            next_deadline = min(self._deadlines.values()) if self._deadlines else None
+            return {
+                'pending': len(self._deadlines),
+                'next_deadline': datetime.fromtimestamp(next_deadline).isoformat() if next_deadline else None,
+                'fired': self._fired,
+                'errors': self._errors
+            }
@@ -0,0 +1,326 @@
+"""
+E-book Retrieval Index Service for Library App
+Background ingestion of e-book PDFs into a local TF-IDF/LSA passage index per book,
+and retrieval of the passages most relevant to a question so the book assistant can
+quote the actual text instead of answering from title and description alone.
+
+Index files are plain .npy arrays opened with mmap_mode='r', so every worker process
+shares the same pages through the OS cache and nothing is sent over the network at
+query time.
+"""
+import calendar
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+import requests
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from prompt_builder import estimate_tokens
+
+# Optional PDF text extraction
+try:
+    from pypdf import PdfReader
+    PYPDF_AVAILABLE = True
+except ImportError:
+    PdfReader = None
+    PYPDF_AVAILABLE = False
+    print("[Startup] pypdf not available - e-book passage retrieval disabled")
+
+CHUNK_WORDS = 200  # Words per passage
+CHUNK_OVERLAP_WORDS = 40  # Words shared with the previous passage so sentences are not cut in half
+LSA_DIMENSIONS = 128
+MAX_PDF_BYTES = 100 * 1024 * 1024
+LOADED_INDEX_LIMIT = 32  # Indexes kept open per process
+STALE_JOB_SECONDS = 30 * 60  # A job still queued/indexing after this long died with its process; retry it
+
+
+class EbookIndexService:
+    def __init__(self, db_path: str, index_dir: str, ebook_dir: str):
+        self.db_path = db_path
+        self.index_dir = index_dir
+        self.ebook_dir = ebook_dir
+        self._lock = threading.Lock()
+        self._loaded: 'OrderedDict[int, Dict[str, Any]]' = OrderedDict()
+        self._queued: set = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ebook-index')
+
+    def get_db_connection(self):
+        """Get SQLite database connection"""
+        return sqlite3.connect(self.db_path)
+
+    def ensure_schema(self, cursor) -> None:
+        """Create the ingestion status table (called from init_db)"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ebook_index_jobs (
+                book_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL CHECK(status IN ('queued', 'indexing', 'ready', 'failed')),
+                chunk_count INTEGER DEFAULT 0,
+                built_at REAL,
+                error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (book_id) REFERENCES books (id) ON DELETE CASCADE
+            )
+        ''')
+
+    # ---- Ingestion ----
+
+    def enqueue(self, book_id: int) -> bool:
+        """Queue a book for background ingestion; False if it is already queued in this process"""
+        with self._lock:
+            if book_id in self._queued:
+                return False
+            self._queued.add(book_id)
+        self._set_status(book_id, 'queued')
+        self._executor.submit(self._run_job, book_id)
+        return True
+
+    def _run_job(self, book_id: int) -> None:
+        try:
+            self._set_status(book_id, 'indexing')
+            chunk_count, built_at = self.ingest(book_id)
+            self._set_status(book_id, 'ready', chunk_count=chunk_count, built_at=built_at)
+            print(f"[EbookIndex] Indexed book {book_id}: {chunk_count} passages")
+        except Exception as e:
+            print(f"[EbookIndex] Indexing book {book_id} failed: {e}")
+            self._set_status(book_id, 'failed', error=str(e))
+        finally:
+            with self._lock:
+                self._queued.discard(book_id)
+
+    def ingest(self, book_id: int):
+        """Extract, chunk and index one book's PDF. Returns (chunk_count, built_at)."""
+        if not PYPDF_AVAILABLE:
+            raise RuntimeError('pypdf is not installed')
+
+        conn = self.get_db_connection()
+        try:
+            row = conn.execute('SELECT pdf_url FROM books WHERE id = ?', (book_id,)).fetchone()
+        finally:
+            conn.close()
+        if not row or not row[0]:
+            raise ValueError('Book has no pdf_url')
+
+        pdf_path, is_temp = self._fetch_pdf(row[0])
+        try:
+            pages = [(number, page.extract_text() or '') for number, page in enumerate(PdfReader(pdf_path).pages, 1)]
+        finally:
+            if is_temp:
+                os.remove(pdf_path)
+
+        chunks = self._chunk_pages(pages)
+        if not chunks:
+            raise ValueError('No extractable text in PDF (scanned images are not supported)')
+
+        vectorizer = TfidfVectorizer(stop_words='english', sublinear_tf=True, max_df=0.95)
+        tfidf = vectorizer.fit_transform([chunk['text'] for chunk in chunks])
+
+        dimensions = min(LSA_DIMENSIONS, tfidf.shape[0] - 1, tfidf.shape[1] - 1)
+        if dimensions >= 2:
+            svd = TruncatedSVD(n_components=dimensions, random_state=42)
+            vectors = svd.fit_transform(tfidf)
+            components = svd.components_.astype(np.float32)
+        else:
+            # Too little text for LSA; plain TF-IDF vectors work fine
+            vectors = tfidf.toarray()
+            components = None
+        vectors = self._normalize(vectors.astype(np.float32))
+
+        built_at = time.time()
+        staging = tempfile.mkdtemp(prefix=f'book_{book_id}_', dir=self._ensure_index_dir())
+        np.save(os.path.join(staging, 'vectors.npy'), vectors)
+        if components is not None:
+            np.save(os.path.join(staging, 'components.npy'), components)
+        with open(os.path.join(staging, 'vectorizer.pkl'), 'wb') as f:
+            pickle.dump(vectorizer, f)
+        with open(os.path.join(staging, 'chunks.json'), 'w', encoding='utf-8') as f:
+            json.dump(chunks, f)
+        with open(os.path.join(staging, 'meta.json'), 'w') as f:
+            json.dump({'built_at': built_at, 'chunks': len(chunks), 'lsa': components is not None}, f)
+
+        # Move the old index aside before swapping the new one in, so readers always find one
+        target = self._book_dir(book_id)
+        retired = None
+        if os.path.isdir(target):
+            retired = tempfile.mkdtemp(prefix=f'old_book_{book_id}_', dir=self.index_dir)
+            os.replace(target, os.path.join(retired, 'index'))
+        os.replace(staging, target)
+        if retired:
+            shutil.rmtree(retired, ignore_errors=True)
+        with self._lock:
+            self._loaded.pop(book_id, None)
+        return len(chunks), built_at
+
+    def _fetch_pdf(self, pdf_url: str):
+        """Return (local_path, is_temp) for a pdf_url that is either http(s) or a path under ebook_dir"""
+        if pdf_url.startswith(('http://', 'https://')):
+            with requests.get(pdf_url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                fd, path = tempfile.mkstemp(suffix='.pdf')
+                size = 0
+                with os.fdopen(fd, 'wb') as f:
+                    for block in response.iter_content(64 * 1024):
+                        size += len(block)
+                        if size > MAX_PDF_BYTES:
+                            f.close()
+                            os.remove(path)
+                            raise ValueError('PDF is larger than the ingestion limit')
+                        f.write(block)
+            return path, True
+
+        path = os.path.realpath(os.path.join(self.ebook_dir, pdf_url.lstrip('/')))
+        if not path.startswith(os.path.realpath(self.ebook_dir) + os.sep):
+            raise ValueError('pdf_url points outside the e-book directory')
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f'PDF not found: {pdf_url}')
+        return path, False
+
+    @staticmethod
+    def _chunk_pages(pages) -> List[Dict[str, Any]]:
+        """Overlapping word windows, each tagged with the page it starts on"""
+        words, word_pages = [], []
+        for number, text in pages:
+            page_words = text.split()
+            words.extend(page_words)
+            word_pages.extend([number] * len(page_words))
+
+        chunks = []
+        step = CHUNK_WORDS - CHUNK_OVERLAP_WORDS
+        for start in range(0, len(words), step):
+            window = words[start:start + CHUNK_WORDS]
+            if len(window) < 20 and chunks:
+                break  # Tail already covered by the previous window's overlap
+            chunks.append({'page': word_pages[start], 'text': ' '.join(window)})
+        return chunks
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _set_status(self, book_id: int, status: str, chunk_count: int = 0,
+                    built_at: Optional[float] = None, error: Optional[str] = None) -> None:
+        conn = self.get_db_connection()
+        try:
+            conn.execute('''
+                INSERT INTO ebook_index_jobs (book_id, status, chunk_count, built_at, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(book_id) DO UPDATE SET
+                    status = excluded.status,
+                    chunk_count = CASE WHEN excluded.status = 'ready' THEN excluded.chunk_count ELSE chunk_count END,
+                    built_at = CASE WHEN excluded.status = 'ready' THEN excluded.built_at ELSE built_at END,
+                    error = excluded.error,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (book_id, status, chunk_count, built_at, error))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_status(self, book_id: int) -> Optional[Dict[str, Any]]:
+        conn = self.get_db_connection()
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute('SELECT * FROM ebook_index_jobs WHERE book_id = ?', (book_id,)).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def is_stale(status: Dict[str, Any]) -> bool:
+        """True for a job left queued or indexing (e.g. by a worker that crashed) past STALE_JOB_SECONDS"""
+        if status['status'] not in ('queued', 'indexing') or not status.get('updated_at'):
+            return False
+        try:
+            updated_at = calendar.timegm(time.strptime(status['updated_at'], '%Y-%m-%d %H:%M:%S'))
+        except ValueError:
+            return False
+        return time.time() - updated_at > STALE_JOB_SECONDS
+
+    # ---- Retrieval ----
+
+    def _ensure_index_dir(self) -> str:
+        os.makedirs(self.index_dir, exist_ok=True)
+        return self.index_dir
+
+    def _book_dir(self, book_id: int) -> str:
+        return os.path.join(self.index_dir, f'book_{book_id}')
+
+    def _load(self, book_id: int) -> Optional[Dict[str, Any]]:
+        meta_path = os.path.join(self._book_dir(book_id), 'meta.json')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        with self._lock:
+            index = self._loaded.get(book_id)
+            if index and index['built_at'] == meta['built_at']:
+                self._loaded.move_to_end(book_id)
+                return index
+
+        book_dir = self._book_dir(book_id)
+        with open(os.path.join(book_dir, 'vectorizer.pkl'), 'rb') as f:
+            vectorizer = pickle.load(f)
+        with open(os.path.join(book_dir, 'chunks.json'), encoding='utf-8') as f:
+            chunks = json.load(f)
+        components_path = os.path.join(book_dir, 'components.npy')
+        index = {
+            'built_at': meta['built_at'],
+            'vectorizer': vectorizer,
+            'chunks': chunks,
+            'vectors': np.load(os.path.join(book_dir, 'vectors.npy'), mmap_mode='r'),
+            'components': np.load(components_path, mmap_mode='r') if meta.get('lsa') else None
+        }
+
+        with self._lock:
+            self._loaded[book_id] = index
+            while len(self._loaded) > LOADED_INDEX_LIMIT:
+                self._loaded.popitem(last=False)
+        return index
+
+    def index_version(self, book_id: int) -> Optional[float]:
+        """built_at of the book's index, or None if it has not been indexed"""
+        index = self._load(book_id)
+        return index['built_at'] if index else None
+
+    def retrieve(self, book_id: int, question: str, token_budget: int, top_k: int = 8) -> List[Dict[str, Any]]:
+        """Most relevant passages for the question, best first, whose combined size fits token_budget"""
+        index = self._load(book_id)
+        if not index or token_budget <= 0:
+            return []
+
+        query = index['vectorizer'].transform([question])
+        if index['components'] is not None:
+            query = query @ np.asarray(index['components']).T
+        else:
+            query = query.toarray()
+        query = self._normalize(np.asarray(query, dtype=np.float32))[0]
+        if not query.any():
+            return []
+
+        scores = np.asarray(index['vectors'] @ query)
+        best = np.argsort(-scores)[:top_k]
+
+        passages, used = [], 0
+        for position in best:
+            if scores[position] <= 0:
+                break
+            chunk = index['chunks'][int(position)]
+            cost = estimate_tokens(chunk['text'])
+            if used + cost > token_budget:
+                continue  # A shorter passage further down may still fit
+            passages.append({'page': chunk['page'], 'text': chunk['text'], 'score': round(float(scores[position]), 4)})
+            used += cost
+        return passages
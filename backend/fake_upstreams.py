@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Fake Upstream Servers for Library App
+Local stand-ins for the Google endpoints the backend calls, so the AI and push
+notification paths can be load-tested and benchmarked offline, without quota:
+
+- POST /v1beta/models/{model}:generateContent
+- POST /v1beta/models/{model}:streamGenerateContent?alt=sse
+- POST /v1/projects/{project}/messages:send   (FCM HTTP v1, needs a Bearer token from /token)
+- POST /fcm/send                               (legacy FCM, needs `Authorization: key=...`)
+- POST /token                                  (OAuth2 service-account token exchange)
+- GET  /stats                                  (per-endpoint counters)
+
+Latency, jitter, error rate and a per-endpoint rate limit are configurable. Every
+random decision comes from one seeded generator and answers are derived from a hash
+of the prompt, so the same request sequence always gets the same results.
+
+Usage:
+    python fake_upstreams.py --port 8090 --latency-ms 600 --error-rate 0.02 --rate-limit 20 \\
+        --latency gemini-1.5-flash=5000 --write-service-account /tmp/fake-sa.json
+
+    GEMINI_API_KEY=fake GEMINI_API_BASE=http://127.0.0.1:8090/v1beta \\
+    FCM_API_BASE=http://127.0.0.1:8090 FCM_SERVER_KEY=fake \\
+    FCM_PROJECT_ID=fake-project GOOGLE_APPLICATION_CREDENTIALS=/tmp/fake-sa.json \\
+    python app.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, Optional
+from urllib.parse import urlparse, parse_qs
+
+ENDPOINTS = ('generate', 'stream', 'fcm_v1', 'fcm_legacy', 'oauth')
+
+MODEL_PATH = re.compile(r'^/v1beta/models/([^/:]+):(generateContent|streamGenerateContent)$')
+FCM_V1_PATH = re.compile(r'^/v1/projects/([^/]+)/messages:send$')
+
+ANSWER_WORDS = (
+    'the library reader chapter theme character story author novel plot setting '
+    'history narrative voice conflict resolution journey memory family friendship '
+    'courage truth power society change hope loss discovery identity'
+).split()
+
+
+class FakeUpstreams:
+    def __init__(self, latency_ms: float = 300, jitter_ms: float = 50, error_rate: float = 0.0,
+                 rate_limit: float = 0.0, burst: Optional[int] = None, seed: int = 1234,
+                 answer_words: int = 120, stream_chunks: int = 5, chunk_delay_ms: float = 80,
+                 latency_overrides: Optional[Dict[str, float]] = None,
+                 error_rate_overrides: Optional[Dict[str, float]] = None):
+        """Overrides are keyed by endpoint name (see ENDPOINTS) or Gemini model name"""
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst = burst or max(1, int(rate_limit))
+        self.answer_words = answer_words
+        self.stream_chunks = stream_chunks
+        self.chunk_delay_ms = chunk_delay_ms
+        self.latency_overrides = latency_overrides or {}
+        self.error_rate_overrides = error_rate_overrides or {}
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._buckets = {endpoint: [float(self.burst), time.monotonic()] for endpoint in ENDPOINTS}
+        self._stats = {endpoint: {'requests': 0, 'ok': 0, 'errors': 0, 'throttled': 0, 'unauthorized': 0}
+                       for endpoint in ENDPOINTS}
+        self._issued_tokens: set = set()
+
+    # ---- Behaviour ----
+
+    def _latency(self, endpoint: str, model: Optional[str]) -> float:
+        base = self.latency_overrides.get(model, self.latency_overrides.get(endpoint, self.latency_ms))
+        with self._lock:
+            jitter = self._rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        return max(0.0, base + jitter) / 1000
+
+    def _should_fail(self, endpoint: str, model: Optional[str]) -> bool:
+        rate = self.error_rate_overrides.get(model, self.error_rate_overrides.get(endpoint, self.error_rate))
+        with self._lock:
+            return self._rng.random() < rate
+
+    def _take_token(self, endpoint: str) -> bool:
+        """Token bucket per endpoint; False means the request should be throttled"""
+        if self.rate_limit <= 0:
+            return True
+        with self._lock:
+            bucket = self._buckets[endpoint]
+            now = time.monotonic()
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate_limit)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def _count(self, endpoint: str, outcome: str) -> None:
+        with self._lock:
+            self._stats[endpoint]['requests'] += 1
+            self._stats[endpoint][outcome] += 1
+
+    def issue_token(self) -> str:
+        with self._lock:
+            token = f'fake-token-{len(self._issued_tokens) + 1}'
+            self._issued_tokens.add(token)
+        return token
+
+    def token_is_valid(self, token: str) -> bool:
+        with self._lock:
+            return token in self._issued_tokens
+
+    def answer_for(self, model: str, prompt: str) -> str:
+        """Deterministic answer text for a prompt"""
+        digest = hashlib.sha256(f'{model}\n{prompt}'.encode('utf-8')).digest()
+        rng = random.Random(digest)
+        words = [rng.choice(ANSWER_WORDS) for _ in range(self.answer_words)]
+        sentences = [' '.join(words[i:i + 12]).capitalize() + '.' for i in range(0, len(words), 12)]
+        return f"[fake {model}] " + ' '.join(sentences)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {endpoint: dict(counters) for endpoint, counters in self._stats.items()}
+            stats['oauth']['tokens_issued'] = len(self._issued_tokens)
+        return stats
+
+    # ---- Serving ----
+
+    def make_handler(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like the real endpoints
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+                raw = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(raw)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(raw)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True  # Client gave up (e.g. a cancelled hedge)
+
+            def _google_error(self, status: int, code: str, message: str, headers=None):
+                self._send_json(status, {'error': {'code': status, 'message': message, 'status': code}}, headers)
+
+            def _read_body(self) -> bytes:
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def do_GET(self):
+                if urlparse(self.path).path == '/stats':
+                    self._send_json(200, upstreams.stats())
+                else:
+                    self._google_error(404, 'NOT_FOUND', 'Not found')
+
+            def do_POST(self):
+                body = self._read_body()
+                url = urlparse(self.path)
+
+                match = MODEL_PATH.match(url.path)
+                if match:
+                    model, method = match.groups()
+                    endpoint = 'generate' if method == 'generateContent' else 'stream'
+                    if not parse_qs(url.query).get('key'):
+                        upstreams._count(endpoint, 'unauthorized')
+                        return self._google_error(403, 'PERMISSION_DENIED', 'Method doesn\'t allow unregistered callers')
+                    if not self._admit(endpoint, model):
+                        return
+                    try:
+                        payload = json.loads(body or b'{}')
+                    except ValueError:
+                        return self._google_error(400, 'INVALID_ARGUMENT', 'Invalid JSON payload')
+                    prompt = ' '.join(part.get('text', '')
+                                      for content in payload.get('contents', [])
+                                      for part in content.get('parts', []))
+                    answer = upstreams.answer_for(model, prompt)
+                    if endpoint == 'generate':
+                        return self._generate(model, prompt, answer)
+                    return self._stream(answer)
+
+                match = FCM_V1_PATH.match(url.path)
+                if match:
+                    auth = self.headers.get('Authorization', '')
+                    if not auth.startswith('Bearer ') or not upstreams.token_is_valid(auth[len('Bearer '):]):
+                        upstreams._count('fcm_v1', 'unauthorized')
+                        return self._google_error(401, 'UNAUTHENTICATED', 'Request had invalid authentication credentials.')
+                    if not self._admit('fcm_v1'):
+                        return
+                    message_id = hashlib.sha1(body).hexdigest()[:16]
+                    return self._send_json(200, {'name': f'projects/{match.group(1)}/messages/{message_id}'})
+
+                if url.path == '/fcm/send':
+                    if not self.headers.get('Authorization', '').startswith('key='):
+                        upstreams._count('fcm_legacy', 'unauthorized')
+                        return self._send_json(401, {'error': 'INVALID_KEY'})
+                    if not self._admit('fcm_legacy'):
+                        return
+                    message_id = int(hashlib.sha1(body).hexdigest()[:12], 16)
+                    return self._send_json(200, {'multicast_id': message_id, 'success': 1, 'failure': 0,
+                                                 'results': [{'message_id': f'0:{message_id}'}]})
+
+                if url.path == '/token':
+                    form = parse_qs(body.decode('utf-8'))
+                    if not form.get('assertion'):
+                        upstreams._count('oauth', 'unauthorized')
+                        return self._send_json(400, {'error': 'invalid_grant', 'error_description': 'Missing assertion'})
+                    if not self._admit('oauth'):
+                        return
+                    return self._send_json(200, {'access_token': upstreams.issue_token(),
+                                                 'expires_in': 3600, 'token_type': 'Bearer'})
+
+                self._google_error(404, 'NOT_FOUND', 'Not found')
+
+            def _admit(self, endpoint: str, model: Optional[str] = None) -> bool:
+                """Apply throttling, latency and injected errors; False if a response was already sent"""
+                if not upstreams._take_token(endpoint):
+                    upstreams._count(endpoint, 'throttled')
+                    self._google_error(429, 'RESOURCE_EXHAUSTED', 'Resource has been exhausted (e.g. check quota).',
+                                       {'Retry-After': '1'})
+                    return False
+                time.sleep(upstreams._latency(endpoint, model))
+                if upstreams._should_fail(endpoint, model):
+                    upstreams._count(endpoint, 'errors')
+                    if endpoint in ('generate', 'stream'):
+                        self._google_error(503, 'UNAVAILABLE', 'The model is overloaded. Please try again later.')
+                    else:
+                        self._google_error(500, 'INTERNAL', 'Internal error encountered.')
+                    return False
+                upstreams._count(endpoint, 'ok')
+                return True
+
+            def _generate(self, model: str, prompt: str, answer: str):
+                self._send_json(200, {
+                    'candidates': [{
+                        'content': {'parts': [{'text': answer}], 'role': 'model'},
+                        'finishReason': 'STOP',
+                        'index': 0
+                    }],
+                    'usageMetadata': {
+                        'promptTokenCount': len(prompt) // 4,
+                        'candidatesTokenCount': len(answer) // 4,
+                        'totalTokenCount': (len(prompt) + len(answer)) // 4
+                    },
+                    'modelVersion': model
+                })
+
+            def _stream(self, answer: str):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+
+                words = answer.split(' ')
+                size = max(1, -(-len(words) // upstreams.stream_chunks))
+                for start in range(0, len(words), size):
+                    if start:
+                        time.sleep(upstreams.chunk_delay_ms / 1000)
+                    text = ' '.join(words[start:start + size]) + (' ' if start + size < len(words) else '')
+                    chunk = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}]}
+                    try:
+                        self.wfile.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode('utf-8'))
+                        self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError):
+                        return  # Client cancelled mid-stream
+
+        return Handler
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8090) -> ThreadingHTTPServer:
+        """Start serving in a background thread and return the server (port 0 picks a free port)"""
+        server = ThreadingHTTPServer((host, port), self.make_handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='fake-upstreams', daemon=True).start()
+        return server
+
+
+def write_service_account(path: str, token_uri: str, project_id: str = 'fake-project') -> None:
+    """Write a service-account key file whose token_uri points at the fake OAuth endpoint"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode('ascii')
+    with open(path, 'w') as f:
+        json.dump({
+            'type': 'service_account',
+            'project_id': project_id,
+            'private_key_id': 'fake-key',
+            'private_key': pem,
+            'client_email': f'load-test@{project_id}.iam.gserviceaccount.com',
+            'client_id': '0',
+            'token_uri': token_uri
+        }, f, indent=2)
+
+
+def _overrides(values, cast):
+    result = {}
+    for value in values or []:
+        key, _, amount = value.partition('=')
+        if not key or not amount:
+            raise SystemExit(f'Expected KEY=VALUE, got {value!r}')
+        result[key] = cast(amount)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake Gemini, FCM and OAuth servers for load testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=300, help='Base latency before a response starts')
+    parser.add_argument('--jitter-ms', type=float, default=50, help='Uniform +/- jitter added to the latency')
+    parser.add_argument('--latency', action='append', metavar='KEY=MS',
+                        help=f'Latency override for an endpoint ({", ".join(ENDPOINTS)}) or a model name')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 5xx')
+    parser.add_argument('--error-rate-for', action='append', metavar='KEY=RATE',
+                        help='Error rate override for an endpoint or a model name')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='Requests per second per endpoint before 429s (0 = unlimited)')
+    parser.add_argument('--burst', type=int, default=None, help='Token bucket size (defaults to the rate limit)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--answer-words', type=int, default=120)
+    parser.add_argument('--stream-chunks', type=int, default=5)
+    parser.add_argument('--chunk-delay-ms', type=float, default=80)
+    parser.add_argument('--write-service-account', metavar='PATH',
+                        help='Write a fake service-account key file for GOOGLE_APPLICATION_CREDENTIALS')
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        rate_limit=args.rate_limit, burst=args.burst, seed=args.seed, answer_words=args.answer_words,
+        stream_chunks=args.stream_chunks, chunk_delay_ms=args.chunk_delay_ms,
+        latency_overrides=_overrides(args.latency, float),
+        error_rate_overrides=_overrides(args.error_rate_for, float)
+    )
+    server = upstreams.serve(args.host, args.port)
+    base = f'http://{args.host}:{server.server_port}'
+
+    if args.write_service_account:
+        write_service_account(args.write_service_account, f'{base}/token')
+        print(f'Wrote fake service account to {args.write_service_account}')
+
+    print(f'Fake upstreams listening on {base}')
+    print(f'  GEMINI_API_BASE={base}/v1beta')
+    print(f'  FCM_API_BASE={base}')
+    print(f'  GOOGLE_OAUTH_TOKEN_URI={base}/token')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
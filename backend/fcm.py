@@ -8,6 +8,9 @@ from google.auth.transport.requests import Request
 
 SCOPES = ["https://www.googleapis.com/auth/firebase.messaging"]
 PROJECT_ID = os.environ.get('FCM_PROJECT_ID')
+# Overridable so load tests can point at fake_upstreams.py instead of Google
+FCM_API_BASE = os.environ.get('FCM_API_BASE', 'https://fcm.googleapis.com').rstrip('/')
+OAUTH_TOKEN_URI = os.environ.get('GOOGLE_OAUTH_TOKEN_URI')  # Replaces the key file's token_uri when set
 
 
 def get_access_token() -> str:
@@ -16,6 +19,8 @@ def get_access_token() -> str:
         raise RuntimeError('FCM v1 is not configured: missing GOOGLE_APPLICATION_CREDENTIALS or FCM_PROJECT_ID')
 
     creds = service_account.Credentials.from_service_account_file(key_path, scopes=SCOPES)
+    if OAUTH_TOKEN_URI:
+        creds = creds.with_token_uri(OAUTH_TOKEN_URI)
     creds.refresh(Request())
     return creds.token
 
@@ -26,7 +31,7 @@ def send_fcm_v1(device_token: str, title: str, body: str, data: Dict[str, Any] |
     Raises an exception on HTTP error.
     """
     token = get_access_token()
-    url = f'https://fcm.googleapis.com/v1/projects/{PROJECT_ID}/messages:send'
+    url = f'{FCM_API_BASE}/v1/projects/{PROJECT_ID}/messages:send'
     message = {
         'message': {
             'token': device_token,
@@ -0,0 +1,36 @@
+"""
+Gemini Streaming Client for Library App
+Parses Gemini's streamGenerateContent Server-Sent Events body into the text of each
+chunk (the request itself is made by AIGateway.stream), plus a helper for re-emitting
+chunks to our own clients.
+"""
+import json
+import os
+from typing import Iterator, Dict, Any
+
+# Overridable so load tests can point at fake_upstreams.py
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta').rstrip('/')
+
+
+def stream_url(model: str, api_key: str) -> str:
+    return f"{GEMINI_API_BASE}/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
+
+
+def iter_stream_text(lines: Iterator[str]) -> Iterator[str]:
+    """Turn the `data:` lines of a streamGenerateContent SSE body into text fragments"""
+    for line in lines:
+        if not line or not line.startswith('data:'):
+            continue
+        chunk = json.loads(line[len('data:'):].strip())
+        candidates = chunk.get('candidates') or []
+        if not candidates:
+            continue
+        for part in candidates[0].get('content', {}).get('parts', []):
+            text = part.get('text')
+            if text:
+                yield text
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
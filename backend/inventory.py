@@ -0,0 +1,299 @@
+"""
+Inventory Service for Library App
+Copy-level stock: every physical copy is a book_copies row with a unique barcode, a
+branch and a state, and loans (book_issues) and collection holds (book_checkouts)
+point at the copy they took. books.total_copies and books.available_copies are kept
+as counters, adjusted in the same statement batch as every copy state change, so
+availability stays an O(1) column read and a desk scan is one unique-index lookup.
+
+A copy is taken with a guarded UPDATE (only succeeds while the copy is still
+'available') inside a BEGIN IMMEDIATE transaction, so concurrent reservations and
+issues cannot hand out the same copy or drive the counters below zero.
+
+Functions work on the caller's connection so the copy change commits or rolls back
+together with the reservation, checkout or issue rows that depend on it.
+"""
+import sqlite3
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+BUSY_TIMEOUT_SECONDS = 10  # How long a writer waits for another writer's lock before failing
+DEFAULT_BRANCH = 'main'
+
+COPY_STATES = ('available', 'on_hold', 'on_loan', 'damaged', 'lost', 'withdrawn')
+LENT_STATES = ('on_hold', 'on_loan')  # Held for collection or out with a reader
+OUT_OF_STOCK_STATES = ('lost', 'withdrawn')  # Not counted in total_copies
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Connection suitable for begin_immediate() under contention"""
+    return sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS)
+
+
+def begin_immediate(conn: sqlite3.Connection) -> None:
+    """Start a write transaction now, taking SQLite's RESERVED lock up front.
+
+    Reads made after this see a state no other writer can change before commit, and a
+    second writer waits here (up to the busy timeout) instead of failing at commit.
+    Must be called before the connection has made any uncommitted writes.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+
+
+def ensure_schema(cursor) -> None:
+    """Create book_copies, link loans to copies and backfill copies for existing books (called from init_db)"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS book_copies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            barcode TEXT,
+            branch TEXT NOT NULL DEFAULT '{DEFAULT_BRANCH}',
+            state TEXT NOT NULL DEFAULT 'available' CHECK(state IN ({', '.join(repr(s) for s in COPY_STATES)})),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (book_id) REFERENCES books (id)
+        )
+    ''')
+    # Desk scans
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_book_copies_barcode ON book_copies(barcode)')
+    # Picking a free copy, per-branch counts
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_copies_book_state ON book_copies(book_id, state, branch)')
+
+    for table in ('book_issues', 'book_checkouts'):
+        try:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN copy_id INTEGER REFERENCES book_copies (id)')
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_copy ON {table}(copy_id)')
+
+    backfill_copies(cursor)
+
+
+def _assign_barcodes(cursor) -> None:
+    """Give copies added without a barcode one derived from their id"""
+    cursor.execute("UPDATE book_copies SET barcode = 'LIB' || printf('%08d', id) WHERE barcode IS NULL")
+
+
+def backfill_copies(cursor) -> int:
+    """Create copy rows for books that only have counters (existing data, seed scripts).
+
+    The counters are preserved: total_copies copies are created, of which
+    total - available are marked lent and attached to the book's outstanding
+    checkouts and issues where there are any. Returns the number of copies created.
+    """
+    cursor.execute('''
+        SELECT b.id, COALESCE(b.total_copies, 0), COALESCE(b.available_copies, 0)
+        FROM books b
+        WHERE b.id IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM book_copies c WHERE c.book_id = b.id)
+    ''')
+    books = cursor.fetchall()
+    created = 0
+    for book_id, total, available in books:
+        total = max(total, 0)
+        available = min(max(available, 0), total)
+        if not total:
+            continue
+
+        cursor.execute('''
+            SELECT 'checkout', id FROM book_checkouts
+            WHERE book_id = ? AND status = 'pending_checkout' AND copy_id IS NULL
+            UNION ALL
+            SELECT 'issue', id FROM book_issues
+            WHERE book_id = ? AND status != 'returned' AND copy_id IS NULL
+        ''', (book_id, book_id))
+        loans = cursor.fetchall()
+
+        for index in range(total):
+            lent = index < total - available
+            loan = loans[index] if lent and index < len(loans) else None
+            state = 'on_hold' if loan and loan[0] == 'checkout' else ('on_loan' if lent else 'available')
+            cursor.execute('INSERT INTO book_copies (book_id, state) VALUES (?, ?)', (book_id, state))
+            if loan:
+                table = 'book_checkouts' if loan[0] == 'checkout' else 'book_issues'
+                cursor.execute(f'UPDATE {table} SET copy_id = ? WHERE id = ?', (cursor.lastrowid, loan[1]))
+        created += total
+
+    if created:
+        _assign_barcodes(cursor)
+        print(f'[Inventory] Created {created} copy records for {len(books)} books')
+    return created
+
+
+def add_copies(cursor, book_id: int, count: int = 1, branch: str = DEFAULT_BRANCH,
+               barcodes: Optional[Iterable[str]] = None) -> List[int]:
+    """Add available copies (barcodes generated unless given). Raises sqlite3.IntegrityError on a duplicate barcode."""
+    barcodes = list(barcodes or [])
+    count = max(count, len(barcodes))
+    copy_ids = []
+    for index in range(count):
+        cursor.execute('INSERT INTO book_copies (book_id, barcode, branch) VALUES (?, ?, ?)',
+                       (book_id, barcodes[index] if index < len(barcodes) else None, branch or DEFAULT_BRANCH))
+        copy_ids.append(cursor.lastrowid)
+    _assign_barcodes(cursor)
+    cursor.execute('''
+        UPDATE books SET total_copies = COALESCE(total_copies, 0) + ?, available_copies = COALESCE(available_copies, 0) + ?
+        WHERE id = ?
+    ''', (count, count, book_id))
+    return copy_ids
+
+
+def add_copies_bulk(cursor, entries: Iterable[Tuple[int, int, str]]) -> int:
+    """add_copies() for many books at once: entries are (book_id, count, branch).
+    One executemany for the copies, one for the counters. Returns copies created."""
+    entries = [(book_id, count, branch or DEFAULT_BRANCH) for book_id, count, branch in entries if count > 0]
+    cursor.executemany('INSERT INTO book_copies (book_id, branch) VALUES (?, ?)',
+                       [(book_id, branch) for book_id, count, branch in entries for _ in range(count)])
+    _assign_barcodes(cursor)
+    cursor.executemany('''
+        UPDATE books SET total_copies = COALESCE(total_copies, 0) + ?, available_copies = COALESCE(available_copies, 0) + ?
+        WHERE id = ?
+    ''', [(count, count, book_id) for book_id, count, _ in entries])
+    return sum(count for _, count, _ in entries)
+
+
+def set_state(cursor, copy_id: int, state: str, from_states: Optional[Iterable[str]] = None) -> bool:
+    """Move a copy to `state`, adjusting the book's counters. False if the copy does not
+    exist, is not in one of `from_states`, or changed under us."""
+    if state not in COPY_STATES:
+        raise ValueError(f'Unknown copy state: {state}')
+    cursor.execute('SELECT book_id, state FROM book_copies WHERE id = ?', (copy_id,))
+    row = cursor.fetchone()
+    if not row:
+        return False
+    book_id, current = row
+    if from_states is not None and current not in from_states:
+        return False
+    if current == state:
+        return True
+
+    cursor.execute('''
+        UPDATE book_copies SET state = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND state = ?
+    ''', (state, copy_id, current))
+    if cursor.rowcount != 1:
+        return False
+
+    available_delta = (state == 'available') - (current == 'available')
+    total_delta = (state not in OUT_OF_STOCK_STATES) - (current not in OUT_OF_STOCK_STATES)
+    if available_delta or total_delta:
+        cursor.execute('''
+            UPDATE books SET available_copies = available_copies + ?, total_copies = total_copies + ?
+            WHERE id = ?
+        ''', (available_delta, total_delta, book_id))
+    return True
+
+
+def take_copy(cursor, book_id: int, state: str = 'on_loan', barcode: Optional[str] = None,
+              branch: Optional[str] = None) -> Optional[int]:
+    """Take an available copy of the book (a specific one when `barcode` is given,
+    preferring `branch` otherwise). Returns its id, or None if none was free."""
+    while True:
+        if barcode:
+            cursor.execute('''
+                SELECT id FROM book_copies WHERE barcode = ? AND book_id = ? AND state = 'available'
+            ''', (barcode, book_id))
+        else:
+            cursor.execute('''
+                SELECT id FROM book_copies
+                WHERE book_id = ? AND state = 'available'
+                ORDER BY branch = ? DESC, id
+                LIMIT 1
+            ''', (book_id, branch))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        if set_state(cursor, row[0], state, ('available',)):
+            return row[0]
+        if barcode:
+            return None
+
+
+def release_copy(cursor, book_id: int, copy_id: Optional[int] = None) -> bool:
+    """Put a lent copy back (return, cancelled or expired checkout). Only lent copies are
+    released, so releasing the same loan twice is a no-op. Loans from before copies were
+    tracked (copy_id NULL) release any lent copy of the book that no open loan holds."""
+    if copy_id is None:
+        cursor.execute('''
+            SELECT c.id FROM book_copies c
+            WHERE c.book_id = ? AND c.state IN ('on_hold', 'on_loan')
+            AND NOT EXISTS (SELECT 1 FROM book_issues i WHERE i.copy_id = c.id AND i.status != 'returned')
+            AND NOT EXISTS (SELECT 1 FROM book_checkouts k WHERE k.copy_id = c.id AND k.status = 'pending_checkout')
+            ORDER BY c.id
+            LIMIT 1
+        ''', (book_id,))
+        row = cursor.fetchone()
+        if not row:
+            return False
+        copy_id = row[0]
+    return set_state(cursor, copy_id, 'available', LENT_STATES)
+
+
+def lend_held_copy(cursor, copy_id: Optional[int]) -> bool:
+    """A held copy was collected: on_hold -> on_loan (counters do not change)"""
+    return copy_id is not None and set_state(cursor, copy_id, 'on_loan', ('on_hold',))
+
+
+def _copy_dict(row) -> Dict[str, Any]:
+    return {
+        'id': row[0],
+        'book_id': row[1],
+        'barcode': row[2],
+        'branch': row[3],
+        'state': row[4],
+        'updated_at': row[5]
+    }
+
+
+def get_copies(cursor, book_id: int) -> List[Dict[str, Any]]:
+    cursor.execute('''
+        SELECT id, book_id, barcode, branch, state, updated_at
+        FROM book_copies WHERE book_id = ? ORDER BY branch, id
+    ''', (book_id,))
+    return [_copy_dict(row) for row in cursor.fetchall()]
+
+
+def branch_counts(cursor, book_id: int) -> Dict[str, Dict[str, int]]:
+    """Copies per branch and state for one book (served by the book/state/branch index)"""
+    cursor.execute('''
+        SELECT branch, state, COUNT(*) FROM book_copies WHERE book_id = ? GROUP BY branch, state
+    ''', (book_id,))
+    counts: Dict[str, Dict[str, int]] = {}
+    for branch, state, count in cursor.fetchall():
+        counts.setdefault(branch, {})[state] = count
+    return counts
+
+
+def find_by_barcode(cursor, barcode: str) -> Optional[Dict[str, Any]]:
+    """Copy, title and current loan or hold for a scanned barcode"""
+    cursor.execute('''
+        SELECT c.id, c.book_id, c.barcode, c.branch, c.state, c.updated_at, b.title, b.author
+        FROM book_copies c
+        JOIN books b ON c.book_id = b.id
+        WHERE c.barcode = ?
+    ''', (barcode,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    copy = _copy_dict(row)
+    copy['title'] = row[6]
+    copy['author'] = row[7]
+    copy['loan'] = None
+
+    if copy['state'] == 'on_loan':
+        cursor.execute('''
+            SELECT id, user_id, issue_date, due_date, status FROM book_issues
+            WHERE copy_id = ? AND status != 'returned' ORDER BY id DESC LIMIT 1
+        ''', (copy['id'],))
+        loan = cursor.fetchone()
+        if loan:
+            copy['loan'] = {'type': 'issue', 'id': loan[0], 'user_id': loan[1], 'issue_date': loan[2],
+                            'due_date': loan[3], 'status': loan[4]}
+    elif copy['state'] == 'on_hold':
+        cursor.execute('''
+            SELECT id, user_id, checkout_deadline FROM book_checkouts
+            WHERE copy_id = ? AND status = 'pending_checkout' ORDER BY id DESC LIMIT 1
+        ''', (copy['id'],))
+        hold = cursor.fetchone()
+        if hold:
+            copy['loan'] = {'type': 'checkout', 'id': hold[0], 'user_id': hold[1], 'checkout_deadline': hold[2]}
+    return copy
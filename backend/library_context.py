@@ -0,0 +1,272 @@
+"""
+Library Context Service for Library App
+In-memory snapshots of the data the library assistant puts in its prompt: global
+catalog statistics refreshed periodically, per-user account summaries cached until a
+loan, fine or reservation changes for that user, and per-user recommendations that are
+recomputed in the background instead of refitting TF-IDF on every question.
+
+Caches are per process; with several gunicorn workers an invalidation only reaches
+the worker that handled the write, so the TTLs bound how stale another worker can be.
+"""
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Callable
+
+
+class LibraryContextService:
+    def __init__(self, db_path: str, recommender: Callable[[int, int], List[Dict[str, Any]]],
+                 stats_refresh_seconds: int = 300, user_ttl_seconds: int = 900,
+                 recommendation_ttl_seconds: int = 3600):
+        self.db_path = db_path
+        self.recommender = recommender
+        self.stats_refresh_seconds = stats_refresh_seconds
+        self.user_ttl_seconds = user_ttl_seconds
+        self.recommendation_ttl_seconds = recommendation_ttl_seconds
+
+        self._lock = threading.Lock()
+        self._stats_text = ''
+        self._stats_loaded_at = 0.0
+        self._users: Dict[int, Dict[str, Any]] = {}
+        self._recommendations: Dict[int, Dict[str, Any]] = {}
+        self._refreshing: set = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='library-context')
+
+    def get_db_connection(self):
+        """Get SQLite database connection"""
+        return sqlite3.connect(self.db_path)
+
+    # ---- Global statistics ----
+
+    def refresh_library_stats(self) -> str:
+        """Rebuild the catalog statistics block (run by the scheduler and on first use)"""
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT
+                    COUNT(*) as total_books,
+                    SUM(available_copies) as available_copies,
+                    COUNT(CASE WHEN available_copies > 0 THEN 1 END) as available_titles
+                FROM books
+            """)
+            stats = cursor.fetchone()
+
+            library_stats = ''
+            if stats:
+                library_stats = f"""
+Library Statistics:
+- Total book titles: {stats[2] or 0}
+- Total book copies: {stats[0] or 0}
+- Currently available copies: {stats[1] or 0}
+"""
+
+            cursor.execute("""
+                SELECT category, COUNT(*) as count
+                FROM books
+                GROUP BY category
+                ORDER BY count DESC
+                LIMIT 5
+            """)
+            categories = cursor.fetchall()
+
+            if categories:
+                library_stats += "\nPopular Categories:\n" + "\n".join([
+                    f"- {cat}: {count} books" for cat, count in categories
+                ])
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._stats_text = library_stats
+            self._stats_loaded_at = time.time()
+        return library_stats
+
+    def get_library_stats(self) -> str:
+        with self._lock:
+            text, loaded_at = self._stats_text, self._stats_loaded_at
+        # The scheduler normally keeps this fresh; only refresh inline if it has fallen behind
+        if time.time() - loaded_at > self.stats_refresh_seconds * 2:
+            try:
+                text = self.refresh_library_stats()
+            except sqlite3.Error as e:
+                print(f"[LibraryContext] stats refresh failed: {e}")
+        return text
+
+    # ---- Per-user summaries ----
+
+    def invalidate_user(self, user_id: Optional[int]) -> None:
+        """Drop the cached summary after a loan, fine or reservation change and
+        recompute the user's recommendations in the background"""
+        if not user_id:
+            return
+        user_id = int(user_id)
+        with self._lock:
+            self._users.pop(user_id, None)
+            if user_id in self._recommendations:
+                self._recommendations[user_id]['stale'] = True
+        self._schedule_recommendations(user_id)
+
+    def invalidate_catalog(self) -> None:
+        """Books were added, edited or removed: rebuild the catalog statistics and let every
+        cached recommendation list be recomputed on its next use"""
+        with self._lock:
+            for cached in self._recommendations.values():
+                cached['stale'] = True
+        try:
+            self.refresh_library_stats()
+        except sqlite3.Error as e:
+            print(f"[LibraryContext] stats refresh failed: {e}")
+
+    def invalidate_issue(self, issue_id: int) -> None:
+        """Invalidate the owner of a book_issues row (for routes keyed by fine/issue id)"""
+        conn = self.get_db_connection()
+        try:
+            row = conn.execute('SELECT user_id FROM book_issues WHERE id = ?', (issue_id,)).fetchone()
+        finally:
+            conn.close()
+        if row:
+            self.invalidate_user(row[0])
+
+    def get_user_summary(self, user_id: int) -> Dict[str, Any]:
+        """Return {'history', 'account', 'has_history'} prompt blocks for a user"""
+        user_id = int(user_id)
+        with self._lock:
+            cached = self._users.get(user_id)
+        if cached and time.time() - cached['loaded_at'] <= self.user_ttl_seconds:
+            return cached
+
+        summary = self._load_user_summary(user_id)
+        summary['loaded_at'] = time.time()
+        with self._lock:
+            self._users[user_id] = summary
+        return summary
+
+    def _load_user_summary(self, user_id: int) -> Dict[str, Any]:
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            # Reading history: borrowed and purchased titles
+            cursor.execute("""
+                SELECT title, author, category
+                FROM books
+                WHERE id IN (
+                    SELECT book_id FROM book_issues WHERE user_id = ?
+                    UNION
+                    SELECT book_id FROM purchases WHERE user_id = ?
+                )
+                ORDER BY title
+            """, (user_id, user_id))
+            history_books = cursor.fetchall()
+
+            history = ''
+            if history_books:
+                history = "\n\nUser's Reading History:\n" + "\n".join([
+                    f"- {title} by {author} ({category})"
+                    for title, author, category in history_books[:10]
+                ])
+
+            account = ''
+
+            # Current loans
+            cursor.execute("""
+                SELECT bi.id, b.title, b.author, bi.due_date, bi.overdue_fee_per_day,
+                       CASE WHEN bi.due_date < date('now') THEN 1 ELSE 0 END as is_overdue
+                FROM book_issues bi
+                JOIN books b ON bi.book_id = b.id
+                WHERE bi.user_id = ? AND bi.return_date IS NULL
+                ORDER BY bi.due_date
+            """, (user_id,))
+            loans = cursor.fetchall()
+
+            overdue_fines = 0.0
+            if loans:
+                account += f"\n\nYour Current Loans ({len(loans)} books):\n"
+                overdue_count = 0
+                for issue_id, title, author, due_date, fee_per_day, is_overdue in loans:
+                    status = "⚠️ OVERDUE" if is_overdue else "✅ On time"
+                    if is_overdue:
+                        overdue_count += 1
+                        overdue_fines += self._outstanding_overdue(cursor, issue_id, due_date, fee_per_day)
+                    account += f"• {title} by {author} (Due: {due_date}) - {status}\n"
+
+                if overdue_count > 0:
+                    account += f"\n⚠️ You have {overdue_count} overdue book(s). Please return them to avoid fines."
+
+            # Outstanding fines: damage amounts on book_issues plus unpaid overdue fees
+            cursor.execute("""
+                SELECT COALESCE(SUM(fine_amount), 0), COUNT(*)
+                FROM book_issues
+                WHERE user_id = ? AND fine_amount > 0
+            """, (user_id,))
+            damage_total, damage_count = cursor.fetchone()
+            total_fines = float(damage_total or 0) + overdue_fines
+            if total_fines > 0:
+                fine_items = damage_count + sum(1 for loan in loans if loan[5])
+                account += f"\n\n💰 Outstanding Fines: R{total_fines:.2f} ({fine_items} items)"
+                account += "\n   Fines accrue at R5 per day for overdue books."
+
+            cursor.execute("""
+                SELECT COUNT(*) FROM book_reservations
+                WHERE user_id = ? AND status = 'pending'
+            """, (user_id,))
+            pending_reservations = cursor.fetchone()[0]
+            if pending_reservations > 0:
+                account += f"\n\n📋 Active Reservations: {pending_reservations}"
+                account += "\n   You can have up to 5 active reservations."
+
+            cursor.execute('SELECT COUNT(*) FROM book_issues WHERE user_id = ?', (user_id,))
+            total_borrowed = cursor.fetchone()[0]
+            if total_borrowed > 0:
+                account += f"\n\n📚 Total Books Borrowed: {total_borrowed}"
+
+            return {'history': history, 'account': account, 'has_history': bool(history_books)}
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _outstanding_overdue(cursor, issue_id: int, due_date: str, fee_per_day) -> float:
+        """Overdue fee for one loan, minus overdue payments (same rule as the fines endpoints)"""
+        if not due_date or float(fee_per_day or 0) <= 0:
+            return 0.0
+        try:
+            days_overdue = (datetime.now().date() - datetime.strptime(due_date[:10], '%Y-%m-%d').date()).days
+        except ValueError:
+            return 0.0
+        cursor.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM fine_payments WHERE fine_id = ? AND payment_type = 'overdue'",
+            (issue_id,))
+        paid = float(cursor.fetchone()[0] or 0)
+        return max(0.0, days_overdue * float(fee_per_day) - paid)
+
+    # ---- Recommendations ----
+
+    def get_recommendations(self, user_id: int, n: int = 3) -> List[Dict[str, Any]]:
+        """Cached recommendations; a missing or stale list is recomputed in the background
+        and whatever is cached (possibly nothing) is returned immediately"""
+        user_id = int(user_id)
+        with self._lock:
+            cached = self._recommendations.get(user_id)
+        if cached is None or cached['stale'] or time.time() - cached['loaded_at'] > self.recommendation_ttl_seconds:
+            self._schedule_recommendations(user_id)
+        return cached['items'][:n] if cached else []
+
+    def _schedule_recommendations(self, user_id: int) -> None:
+        with self._lock:
+            if user_id in self._refreshing:
+                return
+            self._refreshing.add(user_id)
+        self._executor.submit(self._refresh_recommendations, user_id)
+
+    def _refresh_recommendations(self, user_id: int) -> None:
+        try:
+            items = self.recommender(user_id, 5) or []
+            with self._lock:
+                self._recommendations[user_id] = {'items': items, 'loaded_at': time.time(), 'stale': False}
+        except Exception as e:
+            print(f"[LibraryContext] recommendations for user {user_id} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(user_id)
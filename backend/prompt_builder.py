@@ -0,0 +1,144 @@
+"""
+Prompt Builder for Library App
+Assembles AI prompts from named sections under a token budget. Sections keep the
+order they were added in, but when the budget is tight the lowest-priority ones are
+trimmed or dropped first, so the prompt (and the latency and cost of each call) stays
+bounded however long a conversation or a user's account history gets.
+
+Also keeps rolling per-route prompt size statistics for the admin metrics endpoint.
+"""
+import threading
+from collections import deque
+from typing import List, Dict, Any, Optional, Tuple
+
+
+CHARS_PER_TOKEN = 4  # Rough average for English text
+SECTION_SEPARATOR = '\n\n'
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token for English text)"""
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class PromptSection:
+    """A block of prompt text.
+
+    `items` are the droppable units of the section (conversation turns, passages,
+    list entries). When the section does not fit, items are dropped from the end
+    (keep='first') or from the start (keep='last', for most-recent-wins content such
+    as conversation turns) until it does. Required sections are always included.
+    """
+
+    def __init__(self, name: str, items: List[str], priority: int, header: str = '',
+                 separator: str = '\n', required: bool = False, keep: str = 'first'):
+        self.name = name
+        self.items = [item for item in items if item and item.strip()]
+        self.priority = priority
+        self.header = header
+        self.separator = separator
+        self.required = required
+        self.keep = keep
+
+    def render(self, items: Optional[List[str]] = None) -> str:
+        items = self.items if items is None else items
+        if not items:
+            return ''
+        return self.header + self.separator.join(items)
+
+    def fit(self, max_chars: int) -> Tuple[str, int]:
+        """Largest rendering of this section within `max_chars`; returns (text, items_kept)"""
+        items = list(self.items)
+        while items:
+            text = self.render(items)
+            if len(text) <= max_chars:
+                return text, len(items)
+            if self.keep == 'last':
+                items.pop(0)
+            else:
+                items.pop()
+        return '', 0
+
+
+class PromptBuilder:
+    def __init__(self, token_budget: int):
+        self.token_budget = token_budget
+        self._sections: List[PromptSection] = []
+
+    def add(self, name: str, text: str, priority: int, required: bool = False) -> 'PromptBuilder':
+        """Add a section that is either included whole or dropped"""
+        self._sections.append(PromptSection(name, [text], priority, required=required))
+        return self
+
+    def add_items(self, name: str, items: List[str], priority: int, header: str = '',
+                  separator: str = '\n', keep: str = 'first') -> 'PromptBuilder':
+        """Add a section that may be shortened item by item to fit"""
+        self._sections.append(PromptSection(name, items, priority, header, separator, keep=keep))
+        return self
+
+    def build(self) -> Tuple[str, Dict[str, Any]]:
+        """Return (prompt, report). Required sections are placed first regardless of
+        budget, then the rest in priority order (lower number = more important)."""
+        rendered: Dict[int, str] = {}
+        report_sections: Dict[str, Dict[str, Any]] = {}
+        max_chars = self.token_budget * CHARS_PER_TOKEN
+        used = 0  # Characters, including the separators between sections
+
+        ordered = sorted(enumerate(self._sections), key=lambda pair: (not pair[1].required, pair[1].priority))
+        for position, section in ordered:
+            if not section.items:
+                continue
+            if section.required:
+                text, kept = section.render(), len(section.items)
+            else:
+                text, kept = section.fit(max_chars - used - (len(SECTION_SEPARATOR) if rendered else 0))
+            report_sections[section.name] = {
+                'tokens': estimate_tokens(text) if text else 0,
+                'items': kept,
+                'dropped_items': len(section.items) - kept
+            }
+            if text:
+                used += len(text) + (len(SECTION_SEPARATOR) if rendered else 0)
+                rendered[position] = text
+
+        prompt = SECTION_SEPARATOR.join(rendered[position] for position in sorted(rendered))
+        report = {
+            'tokens': estimate_tokens(prompt),
+            'budget': self.token_budget,
+            'sections': report_sections,
+            'truncated': any(s['dropped_items'] for s in report_sections.values())
+        }
+        return prompt, report
+
+
+class PromptStats:
+    """Rolling prompt sizes per route, for GET /api/admin/ai-gateway/metrics"""
+
+    def __init__(self, window: int = 500):
+        self._lock = threading.Lock()
+        self._window = window
+        self._routes: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, route: str, report: Dict[str, Any]) -> None:
+        with self._lock:
+            stats = self._routes.setdefault(route, {'requests': 0, 'truncated': 0, 'tokens': deque(maxlen=self._window)})
+            stats['requests'] += 1
+            if report['truncated']:
+                stats['truncated'] += 1
+            stats['tokens'].append(report['tokens'])
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            routes = {route: (stats['requests'], stats['truncated'], sorted(stats['tokens']))
+                      for route, stats in self._routes.items()}
+
+        result = {}
+        for route, (requests, truncated, tokens) in routes.items():
+            result[route] = {
+                'requests': requests,
+                'truncated': truncated,
+                'avg_tokens': round(sum(tokens) / len(tokens), 1) if tokens else None,
+                'p95_tokens': tokens[min(len(tokens) - 1, int(0.95 * len(tokens)))] if tokens else None,
+                'max_tokens': tokens[-1] if tokens else None
+            }
+        return result
@@ -0,0 +1,190 @@
+"""
+Report Export Service for Library App
+Streams admin reports (catalog, loans, fines, reservations) as CSV or NDJSON, optionally
+gzip-compressed, from a generator so memory stays flat however large the table is.
+
+Rows are read in keyset-paginated batches (WHERE id > last_id ORDER BY id LIMIT n) and
+each batch is fully fetched before it is encoded and sent. The database has no WAL, so a
+single cursor held open for the whole download would keep a read lock that stops every
+writer from committing until a slow client finished; between batches no lock is held.
+The trade-off is that an export is not a point-in-time snapshot.
+"""
+import csv
+import io
+import json
+import sqlite3
+import zlib
+from datetime import datetime, date
+from typing import Dict, Any, Iterator, List, Optional, Callable
+
+EXPORT_BATCH_ROWS = 1000  # Rows per query and per chunk sent to the client
+GZIP_LEVEL = 6
+
+_json_encoder = json.JSONEncoder(default=str)
+
+
+def _outstanding_overdue(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Same overdue amount as GET /api/admin/fines: days late x daily fee, less overdue payments"""
+    overdue = 0.0
+    if row['status'] == 'issued' and row['due_date']:
+        try:
+            due = datetime.strptime(str(row['due_date'])[:10], '%Y-%m-%d').date()
+        except ValueError:
+            due = None
+        if due and date.today() > due:
+            overdue = (date.today() - due).days * float(row['overdue_fee_per_day'] or 5.00)
+            overdue = max(0.0, overdue - float(row.pop('paid_overdue') or 0))
+    row.pop('paid_overdue', None)
+    row['overdue_fine'] = round(overdue, 2)
+    row['damage_fine'] = float(row['damage_fine'] or 0)
+    return row
+
+
+# name -> query (keyed by `key`, with {where} for filters), output columns, optional
+# query-string filters (param -> SQL condition) and a per-row transform
+EXPORTS: Dict[str, Dict[str, Any]] = {
+    'catalog': {
+        'key': 'b.id',
+        'query': '''
+            SELECT b.id, b.title, b.author, b.isbn, b.category, b.description, b.price, b.is_free,
+                   b.is_ebook, b.total_copies, b.available_copies, b.publish_date, b.created_at
+            FROM books b
+            WHERE {where}
+        ''',
+        'columns': ['id', 'title', 'author', 'isbn', 'category', 'description', 'price', 'is_free',
+                    'is_ebook', 'total_copies', 'available_copies', 'publish_date', 'created_at'],
+        'filters': {'category': 'b.category = ?'}
+    },
+    'loans': {
+        'key': 'bi.id',
+        'query': '''
+            SELECT bi.id, bi.book_id, b.title AS book_title, b.author AS book_author, c.barcode,
+                   bi.user_id, u.username AS user_name, u.email AS user_email,
+                   bi.issue_date, bi.due_date, bi.return_date, bi.status, bi.fine_amount, bi.overdue_fee_per_day
+            FROM book_issues bi
+            LEFT JOIN books b ON bi.book_id = b.id
+            LEFT JOIN users u ON bi.user_id = u.id
+            LEFT JOIN book_copies c ON bi.copy_id = c.id
+            WHERE {where}
+        ''',
+        'columns': ['id', 'book_id', 'book_title', 'book_author', 'barcode', 'user_id', 'user_name',
+                    'user_email', 'issue_date', 'due_date', 'return_date', 'status', 'fine_amount',
+                    'overdue_fee_per_day'],
+        'filters': {
+            'status': 'bi.status = ?',
+            'since': 'bi.issue_date >= ?',
+            'until': 'bi.issue_date < ?'
+        }
+    },
+    'fines': {
+        'key': 'bi.id',
+        'query': '''
+            SELECT bi.id, u.username AS member_name, u.email AS member_email,
+                   b.title AS book_title, b.author AS book_author,
+                   bi.fine_amount AS damage_fine, bi.damage_description, bi.issue_date, bi.due_date,
+                   bi.status, bi.overdue_fee_per_day,
+                   (SELECT COALESCE(SUM(fp.amount), 0) FROM fine_payments fp
+                    WHERE fp.fine_id = bi.id AND fp.payment_type = 'overdue') AS paid_overdue
+            FROM book_issues bi
+            LEFT JOIN books b ON bi.book_id = b.id
+            LEFT JOIN users u ON bi.user_id = u.id
+            WHERE (
+                bi.fine_amount > 0
+                OR (
+                    bi.status = 'issued'
+                    AND bi.due_date < date('now')
+                    AND COALESCE(bi.overdue_fee_per_day, 0) > 0
+                )
+            )
+            AND {where}
+        ''',
+        'columns': ['id', 'member_name', 'member_email', 'book_title', 'book_author', 'damage_fine',
+                    'overdue_fine', 'damage_description', 'issue_date', 'due_date', 'status'],
+        'filters': {},
+        'transform': _outstanding_overdue
+    },
+    'reservations': {
+        'key': 'br.id',
+        'query': '''
+            SELECT br.id, br.book_id, b.title AS book_title, b.author AS book_author,
+                   br.user_id, u.username AS user_name, u.email AS user_email,
+                   br.status, br.requested_at, br.approved_at, br.rejection_reason
+            FROM book_reservations br
+            LEFT JOIN books b ON br.book_id = b.id
+            LEFT JOIN users u ON br.user_id = u.id
+            WHERE {where}
+        ''',
+        'columns': ['id', 'book_id', 'book_title', 'book_author', 'user_id', 'user_name', 'user_email',
+                    'status', 'requested_at', 'approved_at', 'rejection_reason'],
+        'filters': {'status': 'br.status = ?'}
+    }
+}
+
+
+def iter_batches(db_path: str, name: str, params: Optional[Dict[str, str]] = None,
+                 batch_rows: int = EXPORT_BATCH_ROWS) -> Iterator[List[Dict[str, Any]]]:
+    """Yield the export's rows as lists of dicts, one keyset page at a time"""
+    spec = EXPORTS[name]
+    conditions, values = [f"{spec['key']} > ?"], []
+    for param, condition in spec['filters'].items():
+        if params and params.get(param):
+            conditions.append(condition)
+            values.append(params[param])
+    sql = spec['query'].format(where=' AND '.join(conditions)) + f" ORDER BY {spec['key']} LIMIT ?"
+    transform: Optional[Callable] = spec.get('transform')
+
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        last_id = 0
+        while True:
+            rows = conn.execute(sql, [last_id] + values + [batch_rows]).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            batch = [dict(row) for row in rows]
+            if transform:
+                batch = [transform(row) for row in batch]
+            yield batch
+            if len(rows) < batch_rows:
+                return
+    finally:
+        conn.close()
+
+
+def iter_csv(columns: List[str], batches: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_ndjson(columns: List[str], batches: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    for batch in batches:
+        yield ''.join(_json_encoder.encode({column: row.get(column) for column in columns}) + '\n'
+                      for row in batch).encode('utf-8')
+
+
+def gzip_chunks(chunks: Iterator[bytes], level: int = GZIP_LEVEL) -> Iterator[bytes]:
+    """Compress a byte stream incrementally into gzip format"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(db_path: str, name: str, fmt: str = 'csv', gzip: bool = False,
+                  params: Optional[Dict[str, str]] = None) -> Iterator[bytes]:
+    """Encoded (and optionally compressed) body of an export"""
+    columns = EXPORTS[name]['columns']
+    encode = iter_ndjson if fmt == 'ndjson' else iter_csv
+    chunks = encode(columns, iter_batches(db_path, name, params))
+    return gzip_chunks(chunks) if gzip else chunks
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for book inventory
+Hammers one title from many threads, both through inventory.take_copy directly and
+through the reserve / issue / approve-reservation endpoints, and verifies that no more
+copies are handed out than exist, that no copy is handed out twice, and that
+available_copies never goes negative and matches the copy rows. Also checks that copies
+added by an admin go to members already on the waitlist before new reservations.
+
+Runs against a throwaway copy of library.db, never the file itself:
+    python test_inventory_concurrency.py [threads] [copies]
+"""
+import os
+import shutil
+import sys
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SOURCE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "library.db")
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix='inventory_test_'), 'library.db')
+shutil.copy(SOURCE_DB, DB_PATH)
+# The app reads DATABASE_PATH at import time
+os.environ['DATABASE_PATH'] = DB_PATH
+
+import inventory
+
+
+def run_concurrently(threads, fn):
+    """Start every call at the same moment and return their results"""
+    barrier = threading.Barrier(threads)
+
+    def worker(i):
+        barrier.wait()
+        return fn(i)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(worker, range(threads)))
+
+
+def add_book(copies):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO books (title, author, category, total_copies, available_copies)
+        VALUES ('Stress Test Title', 'Test Author', 'Testing', 0, 0)
+    ''')
+    book_id = cursor.lastrowid
+    inventory.add_copies(cursor, book_id, copies)
+    conn.commit()
+    conn.close()
+    return book_id
+
+
+def available_copies(book_id):
+    conn = sqlite3.connect(DB_PATH)
+    value = conn.execute('SELECT available_copies FROM books WHERE id = ?', (book_id,)).fetchone()[0]
+    conn.close()
+    return value
+
+
+def shelved_copies(book_id):
+    conn = sqlite3.connect(DB_PATH)
+    value = conn.execute("SELECT COUNT(*) FROM book_copies WHERE book_id = ? AND state = 'available'", (book_id,)).fetchone()[0]
+    conn.close()
+    return value
+
+
+def check(label, ok):
+    print(f"  {'PASS' if ok else 'FAIL'}: {label}")
+    return ok
+
+
+def stress_take_copy(threads, copies):
+    print(f"inventory.take_copy: {threads} threads, {copies} copies")
+    book_id = add_book(copies)
+
+    def take(_):
+        conn = inventory.connect(DB_PATH)
+        try:
+            inventory.begin_immediate(conn)
+            taken = inventory.take_copy(conn.cursor(), book_id)
+            conn.commit()
+            return taken
+        finally:
+            conn.close()
+
+    results = [copy_id for copy_id in run_concurrently(threads, take) if copy_id]
+    return all([
+        check(f"{len(results)} copies taken (expected {copies})", len(results) == copies),
+        check(f"{len(set(results))} distinct copies taken (expected {copies})", len(set(results)) == copies),
+        check(f"available_copies is {available_copies(book_id)} (expected 0)", available_copies(book_id) == 0),
+        check(f"{shelved_copies(book_id)} copies still shelved (expected 0)", shelved_copies(book_id) == 0)
+    ])
+
+
+def stress_endpoints(app_module, threads, copies):
+    print(f"reserve / issue / approve endpoints: {threads} threads, {copies} copies")
+    book_id = add_book(copies)
+    client = app_module.app.test_client()
+
+    # Pending requests for the approve path
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    request_ids = []
+    for user_id in range(2000, 2000 + threads // 3 + 1):
+        cursor.execute("INSERT INTO book_reservations (book_id, user_id, status) VALUES (?, ?, 'pending')", (book_id, user_id))
+        request_ids.append(cursor.lastrowid)
+    conn.commit()
+    conn.close()
+
+    def hit(i):
+        kind = i % 3
+        if kind == 0:
+            response = client.post(f'/api/books/{book_id}/reserve', json={'user_id': 1000 + i})
+            return response.status_code == 200 and response.get_json().get('status') == 'approved_checkout'
+        if kind == 1:
+            response = client.post(f'/api/admin/books/{book_id}/issue', json={'user_id': 1000 + i})
+            return response.status_code == 200
+        response = client.post(f'/api/admin/reservation-requests/{request_ids[i // 3]}/approve', json={'admin_id': 1})
+        return response.status_code == 200
+
+    results = run_concurrently(threads, hit)
+
+    conn = sqlite3.connect(DB_PATH)
+    issues = conn.execute('SELECT COUNT(*) FROM book_issues WHERE book_id = ?', (book_id,)).fetchone()[0]
+    checkouts = conn.execute('SELECT COUNT(*) FROM book_checkouts WHERE book_id = ?', (book_id,)).fetchone()[0]
+    linked = conn.execute('''
+        SELECT COUNT(DISTINCT copy_id) FROM (
+            SELECT copy_id FROM book_issues WHERE book_id = ?
+            UNION ALL SELECT copy_id FROM book_checkouts WHERE book_id = ?
+        )
+    ''', (book_id, book_id)).fetchone()[0]
+    conn.close()
+
+    return all([
+        check(f"{sum(results)} requests succeeded (expected {copies})", sum(results) == copies),
+        check(f"{issues} issues + {checkouts} checkouts recorded (expected {copies})", issues + checkouts == copies),
+        check(f"{linked} distinct copies linked to them (expected {copies})", linked == copies),
+        check(f"available_copies is {available_copies(book_id)} (expected 0)", available_copies(book_id) == 0)
+    ])
+
+
+def check_copies_promote_waitlist(app_module):
+    print("added copies go to the waitlist first")
+    book_id = add_book(1)
+    client = app_module.app.test_client()
+
+    def reserve(user_id):
+        return client.post(f'/api/books/{book_id}/reserve', json={'user_id': user_id}).get_json().get('status')
+
+    def waitlist_status(user_id):
+        conn = sqlite3.connect(DB_PATH)
+        row = conn.execute('SELECT status FROM book_waitlist WHERE book_id = ? AND user_id = ? ORDER BY id DESC LIMIT 1',
+                           (book_id, user_id)).fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def pending_checkout(user_id):
+        conn = sqlite3.connect(DB_PATH)
+        row = conn.execute("""SELECT copy_id FROM book_checkouts
+                              WHERE book_id = ? AND user_id = ? AND status = 'pending_checkout'""",
+                           (book_id, user_id)).fetchone()
+        conn.close()
+        return row is not None and row[0] is not None
+
+    statuses = [reserve(user_id) for user_id in (3001, 3002, 3003)]
+    scheduled = app_module.checkout_deadlines.stats()['pending']
+    added = client.post(f'/api/admin/books/{book_id}/copies', json={'count': 1}).get_json()
+    late_status = reserve(3004)
+    client.put(f'/api/admin/books/{book_id}', json={'title': 'Stress Test Title', 'author': 'Test Author',
+                                                    'category': 'Testing', 'total_copies': 3})
+
+    return all([
+        check(f"reservations were {statuses} (expected first approved, then two waitlisted)",
+              statuses == ['approved_checkout', 'waitlisted', 'waitlisted']),
+        check(f"POST copies promoted {added.get('waitlist_promoted')} member (expected 1)", added.get('waitlist_promoted') == 1),
+        check("first waiting member was promoted with a held copy",
+              waitlist_status(3002) == 'promoted' and pending_checkout(3002)),
+        check(f"a new reserve after that was {late_status!r} (expected waitlisted, not the new copy)", late_status == 'waitlisted'),
+        check("raising total_copies promoted the next member", waitlist_status(3003) == 'promoted' and pending_checkout(3003)),
+        check("the member who joined last is still waiting", waitlist_status(3004) == 'waiting'),
+        check(f"{app_module.checkout_deadlines.stats()['pending'] - scheduled} collection deadlines scheduled (expected 2)",
+              app_module.checkout_deadlines.stats()['pending'] - scheduled == 2),
+        check(f"{shelved_copies(book_id)} copies still shelved (expected 0)", shelved_copies(book_id) == 0)
+    ])
+
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 48
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    import app as app_module
+    print(f"Using throwaway database {DB_PATH}\n")
+
+    passed = stress_take_copy(threads, copies)
+    print()
+    passed = stress_endpoints(app_module, threads, copies) and passed
+    print()
+    passed = check_copies_promote_waitlist(app_module) and passed
+
+    print("\nInventory concurrency test " + ("passed" if passed else "FAILED"))
+    if not passed:
+        sys.exit(1)
@@ -0,0 +1,224 @@
+"""
+Typeahead Index Service for Library App
+In-memory prefix index over book titles and authors for search-as-you-type, so a
+keystroke is answered from memory without touching SQLite.
+
+Text is normalized (accents folded, lowercased, punctuation removed) and every word
+position of a title or author becomes a key ("brief history of time", "history of
+time", ...), so a query can match from the start or from any later word. Keys are held
+in sorted lists of (key, book_id, field) tuples searched with bisect: one list of
+whole-title/whole-author keys and one of later-word keys, scanned in that order so
+"starts with" matches rank first.
+
+Single-book writes update the lists in place (refresh_books); bulk changes rebuild
+them. Other worker processes do not see in-place updates, so the index is also rebuilt
+in the background once it is older than max_age_seconds.
+"""
+import bisect
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, Any, List, Optional, Tuple, Iterable
+
+MAX_SCAN = 200  # Index entries examined per list per query; keeps a keystroke well under 1 ms
+SKIP_WORDS = {'a', 'an', 'the', 'of', 'and', 'to', 'in', 'on', 'for'}  # Not indexed as a starting word
+FIELD_WEIGHT = {'title': 2, 'author': 1}
+REBUILD_WAIT_SECONDS = 30  # Longest a query with no index yet waits for another caller's rebuild
+
+_WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text: Optional[str]) -> str:
+    """Lowercase ASCII words separated by single spaces"""
+    if not text:
+        return ''
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(_WORD_PATTERN.findall(text.lower()))
+
+
+def _keys(text: str) -> Tuple[Optional[str], List[str]]:
+    """(whole key, later-word keys) for a normalized title or author"""
+    if not text:
+        return None, []
+    words = text.split(' ')
+    later = [' '.join(words[i:]) for i in range(1, len(words)) if words[i] not in SKIP_WORDS]
+    return text, later
+
+
+class TypeaheadIndex:
+    def __init__(self, db_path: str, max_age_seconds: int = 300):
+        self.db_path = db_path
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._books: Dict[int, Tuple[str, str]] = {}  # book_id -> (title, author) as displayed
+        self._starts: List[Tuple[str, int, str]] = []  # Whole-title / whole-author keys, sorted
+        self._words: List[Tuple[str, int, str]] = []  # Keys starting at a later word, sorted
+        self._built_at = 0.0
+        self._version = 0  # Bumped by in-place updates and invalidate(), so a rebuild that raced one is not kept
+        self._rebuilding = False
+        self._rebuilt = threading.Condition(self._lock)  # Notified when a rebuild finishes, applied or not
+
+    def get_db_connection(self):
+        """Get SQLite database connection"""
+        return sqlite3.connect(self.db_path)
+
+    @staticmethod
+    def _entries(book_id: int, title: str, author: str):
+        starts, words = [], []
+        for field, text in (('title', title), ('author', author)):
+            whole, later = _keys(normalize(text))
+            if whole:
+                starts.append((whole, book_id, field))
+            words.extend((key, book_id, field) for key in later)
+        return starts, words
+
+    # ---- Building ----
+
+    def rebuild(self) -> int:
+        """Rebuild both lists from the books table; returns the number of books indexed"""
+        with self._lock:
+            version = self._version
+        try:
+            conn = self.get_db_connection()
+            try:
+                rows = conn.execute('SELECT id, title, author FROM books').fetchall()
+            finally:
+                conn.close()
+
+            books, starts, words = {}, [], []
+            for book_id, title, author in rows:
+                books[book_id] = (title or '', author or '')
+                book_starts, book_words = self._entries(book_id, title, author)
+                starts.extend(book_starts)
+                words.extend(book_words)
+            starts.sort()
+            words.sort()
+
+            with self._lock:
+                if version == self._version:
+                    self._books, self._starts, self._words = books, starts, words
+                    self._built_at = time.time()
+            return len(books)
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._rebuilt.notify_all()
+
+    def warm(self) -> None:
+        """Build the index in the background (at startup) so the first keystroke does not wait"""
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self.rebuild, name='typeahead-rebuild', daemon=True).start()
+
+    def invalidate(self) -> None:
+        """Rebuild on next use (after bulk changes)"""
+        with self._lock:
+            self._built_at = 0.0
+            self._version += 1  # A rebuild already reading the old rows must not be applied
+
+    def _remove(self, book_id: int) -> None:
+        """Drop a book's entries. Caller holds the lock."""
+        book = self._books.pop(book_id, None)
+        if not book:
+            return
+        starts, words = self._entries(book_id, *book)
+        for entries, keys in ((self._starts, starts), (self._words, words)):
+            for entry in keys:
+                position = bisect.bisect_left(entries, entry)
+                if position < len(entries) and entries[position] == entry:
+                    del entries[position]
+
+    def refresh_books(self, book_ids: Iterable[int]) -> None:
+        """Re-read the given books and update the index in place (removing deleted ones)"""
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+        conn = self.get_db_connection()
+        try:
+            rows = conn.execute(f"SELECT id, title, author FROM books WHERE id IN ({','.join('?' * len(book_ids))})",
+                                book_ids).fetchall()
+        finally:
+            conn.close()
+        found = {row[0]: row for row in rows}
+
+        with self._lock:
+            self._version += 1
+            if not self._built_at:
+                return  # Not built yet (or a rebuild is due); it will read these rows itself
+            for book_id in book_ids:
+                self._remove(book_id)
+                if book_id in found:
+                    _, title, author = found[book_id]
+                    self._books[book_id] = (title or '', author or '')
+                    starts, words = self._entries(book_id, title, author)
+                    for entry in starts:
+                        bisect.insort(self._starts, entry)
+                    for entry in words:
+                        bisect.insort(self._words, entry)
+
+    def _ensure_fresh(self) -> None:
+        """Start a rebuild if one is due. Only one runs at a time: while it does, other callers
+        answer from the current lists, or wait for it if there are none yet."""
+        with self._lock:
+            if self._rebuilding:
+                if not self._books:
+                    self._rebuilt.wait(timeout=REBUILD_WAIT_SECONDS)
+                return
+            if not self._built_at:
+                run = 'wait'  # First use or after invalidate(): this caller waits once
+            elif time.time() - self._built_at > self.max_age_seconds:
+                run = 'background'
+            else:
+                return
+            self._rebuilding = True
+        if run == 'wait':
+            self.rebuild()
+        else:
+            threading.Thread(target=self.rebuild, name='typeahead-rebuild', daemon=True).start()
+
+    # ---- Lookup ----
+
+    def suggest(self, query: str, limit: int = 8) -> List[Dict[str, Any]]:
+        """Books whose title or author has a word sequence starting with the query, best first"""
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        self._ensure_fresh()
+
+        best: Dict[int, Tuple[tuple, str]] = {}
+        with self._lock:
+            for rank, entries in enumerate((self._starts, self._words)):
+                position = bisect.bisect_left(entries, (prefix,))
+                end = min(position + MAX_SCAN, len(entries))
+                while position < end and entries[position][0].startswith(prefix):
+                    key, book_id, field = entries[position]
+                    # Whole-key matches first, then exact matches, title over author, shorter keys
+                    score = (rank, key != prefix, -FIELD_WEIGHT[field], len(key), key)
+                    if book_id not in best or score < best[book_id][0]:
+                        best[book_id] = (score, field)
+                    position += 1
+                if len(best) >= limit and rank == 0:
+                    break
+            ranked = sorted(best.items(), key=lambda item: item[1][0])[:limit]
+            books = {book_id: self._books.get(book_id, ('', '')) for book_id, _ in ranked}
+
+        return [{
+            'id': book_id,
+            'title': books[book_id][0],
+            'author': books[book_id][1],
+            'matched': field
+        } for book_id, (_, field) in ranked]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'books': len(self._books),
+                'keys': len(self._starts) + len(self._words),
+                'built_at': self._built_at or None
+            }
@@ -0,0 +1,219 @@
+"""
+Waitlist Service for Library App
+FIFO queue per book for users who try to reserve a title with no free copies. When a
+copy comes back (return, cancelled or expired checkout) the first waiting user is
+promoted straight to an approved checkout, with its notification, in the same
+transaction that freed the copy. Users are told once instead of retrying the reserve
+endpoint and polling their reservations.
+
+Like inventory, functions work on the caller's cursor; promotion expects to run
+inside an inventory.begin_immediate() transaction.
+"""
+import json
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional, Tuple
+
+import inventory
+
+CHECKOUT_WINDOW_DAYS = 2  # Same collection window as an auto-approved reservation
+
+
+def ensure_schema(cursor) -> None:
+    """Create the waitlist table (called from init_db)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS book_waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'waiting' CHECK(status IN ('waiting', 'promoted', 'fulfilled', 'cancelled')),
+            reservation_id INTEGER,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            resolved_at TIMESTAMP,
+            FOREIGN KEY (book_id) REFERENCES books (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # Queue order and position counts per book
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_waitlist_queue ON book_waitlist(book_id, status, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_waitlist_user ON book_waitlist(user_id, status)')
+    # One live entry per user and book
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_book_waitlist_waiting
+        ON book_waitlist(book_id, user_id) WHERE status = 'waiting'
+    ''')
+
+
+def join(cursor, book_id: int, user_id: int) -> int:
+    """Add the user to the book's queue (no-op if already waiting); returns their 1-based position"""
+    cursor.execute('''
+        INSERT OR IGNORE INTO book_waitlist (book_id, user_id, status)
+        VALUES (?, ?, 'waiting')
+    ''', (book_id, user_id))
+    return position(cursor, book_id, user_id)
+
+
+def position(cursor, book_id: int, user_id: int) -> Optional[int]:
+    """1-based queue position, or None if the user is not waiting for the book"""
+    cursor.execute('''
+        SELECT COUNT(*) FROM book_waitlist w
+        WHERE w.book_id = ? AND w.status = 'waiting'
+        AND w.id <= (
+            SELECT id FROM book_waitlist
+            WHERE book_id = ? AND user_id = ? AND status = 'waiting'
+        )
+    ''', (book_id, book_id, user_id))
+    count = cursor.fetchone()[0]
+    return count or None
+
+
+def resolve(cursor, book_id: int, user_id: int, status: str = 'fulfilled') -> bool:
+    """Take the user off the queue ('fulfilled' when they got a copy another way, 'cancelled' when they left)"""
+    cursor.execute('''
+        UPDATE book_waitlist SET status = ?, resolved_at = CURRENT_TIMESTAMP
+        WHERE book_id = ? AND user_id = ? AND status = 'waiting'
+    ''', (status, book_id, user_id))
+    return cursor.rowcount > 0
+
+
+def resolve_many(cursor, pairs: List[Tuple[int, int]], status: str = 'fulfilled') -> None:
+    """resolve() for many (book_id, user_id) pairs in one executemany"""
+    cursor.executemany('''
+        UPDATE book_waitlist SET status = ?, resolved_at = CURRENT_TIMESTAMP
+        WHERE book_id = ? AND user_id = ? AND status = 'waiting'
+    ''', [(status, book_id, user_id) for book_id, user_id in pairs])
+
+
+def user_entries(cursor, user_id: int) -> List[Dict[str, Any]]:
+    """Every book the user is waiting for, with their position and the queue length"""
+    cursor.execute('''
+        SELECT w.book_id, b.title, b.author, w.joined_at,
+               (SELECT COUNT(*) FROM book_waitlist q
+                WHERE q.book_id = w.book_id AND q.status = 'waiting' AND q.id <= w.id) as position,
+               (SELECT COUNT(*) FROM book_waitlist q
+                WHERE q.book_id = w.book_id AND q.status = 'waiting') as queue_length
+        FROM book_waitlist w
+        JOIN books b ON w.book_id = b.id
+        WHERE w.user_id = ? AND w.status = 'waiting'
+        ORDER BY w.joined_at
+    ''', (user_id,))
+    return [{
+        'book_id': row[0],
+        'title': row[1],
+        'author': row[2],
+        'joined_at': row[3],
+        'position': row[4],
+        'queue_length': row[5]
+    } for row in cursor.fetchall()]
+
+
+def promote_next(cursor, book_id: int, timestamp: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Give a free copy of the book to the first waiting user.
+
+    Creates the approved reservation, the pending checkout and the in-app notification
+    and takes the copy, all on the caller's transaction. Returns the promotion (for a
+    push after commit) or None if nobody is waiting or no copy is free. Users who
+    already hold an active reservation for the book are skipped.
+    """
+    timestamp = timestamp or datetime.now().isoformat()
+
+    while True:
+        cursor.execute('''
+            SELECT id, user_id FROM book_waitlist
+            WHERE book_id = ? AND status = 'waiting'
+            ORDER BY id
+            LIMIT 1
+        ''', (book_id,))
+        entry = cursor.fetchone()
+        if not entry:
+            return None
+        entry_id, user_id = entry
+
+        cursor.execute('''
+            SELECT id FROM book_reservations
+            WHERE book_id = ? AND user_id = ? AND status IN ('pending', 'approved_checkout')
+        ''', (book_id, user_id))
+        if cursor.fetchone():
+            cursor.execute('''
+                UPDATE book_waitlist SET status = 'fulfilled', resolved_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (entry_id,))
+            continue
+
+        copy_id = inventory.take_copy(cursor, book_id, 'on_hold')
+        if not copy_id:
+            return None
+
+        cursor.execute('SELECT title FROM books WHERE id = ?', (book_id,))
+        book_title = cursor.fetchone()[0]
+        checkout_deadline = (datetime.now() + timedelta(days=CHECKOUT_WINDOW_DAYS)).isoformat()
+
+        cursor.execute('''
+            INSERT INTO book_reservations (book_id, user_id, status, approved_at)
+            VALUES (?, ?, 'approved_checkout', ?)
+        ''', (book_id, user_id, timestamp))
+        reservation_id = cursor.lastrowid
+
+        cursor.execute('''
+            INSERT INTO book_checkouts (reservation_id, book_id, user_id, status, checkout_deadline, approved_at, copy_id)
+            VALUES (?, ?, ?, 'pending_checkout', ?, ?, ?)
+        ''', (reservation_id, book_id, user_id, checkout_deadline, timestamp, copy_id))
+        checkout_id = cursor.lastrowid
+
+        cursor.execute('''
+            UPDATE book_waitlist
+            SET status = 'promoted', reservation_id = ?, resolved_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (reservation_id, entry_id))
+
+        message = (f'A copy of "{book_title}" is now available for you from the waitlist. '
+                   f'Please collect it within {CHECKOUT_WINDOW_DAYS} days.')
+        cursor.execute('''
+            INSERT INTO notifications (user_id, type, title, message, data, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+            user_id,
+            'reservation_approved',
+            'Reservation Approved',
+            message,
+            json.dumps({'reservationId': reservation_id, 'bookTitle': book_title, 'bookId': book_id,
+                        'fromWaitlist': True, 'timestamp': timestamp}),
+            timestamp
+        ))
+
+        return {
+            'user_id': user_id,
+            'book_id': book_id,
+            'book_title': book_title,
+            'reservation_id': reservation_id,
+            'checkout_id': checkout_id,
+            'checkout_deadline': checkout_deadline,
+            'message': message
+        }
+
+
+def promote_for_copies(cursor, book_id: int, count: int, timestamp: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Offer `count` newly shelved copies to the head of the waitlist, one promotion per copy,
+    so members already waiting get them before the next reserve_book caller"""
+    promotions = []
+    for _ in range(count):
+        promotion = promote_next(cursor, book_id, timestamp)
+        if not promotion:
+            break
+        promotions.append(promotion)
+    return promotions
+
+
+def promotion_push(promotion: Dict[str, Any]) -> Dict[str, Any]:
+    """Push for a waitlist.promote_next() result"""
+    return {
+        'user_id': promotion['user_id'],
+        'title': 'Reservation Approved',
+        'message': promotion['message'],
+        'data': {
+            'type': 'reservation_approved',
+            'book_id': promotion['book_id'],
+            'book_title': promotion['book_title'],
+            'reservation_id': promotion['reservation_id'],
+            'checkout_deadline': promotion['checkout_deadline'],
+            'from_waitlist': True
+        }
+    }